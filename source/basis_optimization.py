@@ -5,6 +5,11 @@ import sys
 import time
 import subprocess
 import shlex
+import shutil
+import zlib
+import copy
+import concurrent.futures
+import multiprocessing
 import numpy as np
 
 from sklearn import preprocessing
@@ -13,10 +18,14 @@ from sklearn.gaussian_process.kernels import Matern, RBF, WhiteKernel,\
 	ConstantKernel as C,\
 	RationalQuadratic as RQ,\
 	ExpSineSquared as ESS,\
-	DotProduct as DP
+	DotProduct as DP, Product
 from sklearn.metrics import mean_squared_error as mse 
 
 from scipy.optimize import minimize, rosen, rosen_der,shgo, differential_evolution,basinhopping
+from scipy.spatial import cKDTree
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from scipy.special import erfcx, log_ndtr, ndtr
+from threadpoolctl import threadpool_limits
 
 
 #---------------------------------------------------------------------
@@ -44,6 +53,8 @@ PROGRAM_HOME = "/scratch/gpfs/SHS/cm4542/ml_basis_opt"
 #  collect_training: Collect training info from directories
 #  run_gpr:          Run GPR
 #  all:              gen_training, gen_testing, (collect_training), run_gpr
+#  predict:          Predict P(x) at the points of PREDICT_FILE with the GP
+#                    model in GP_MODEL_FILE
 JOBTYPE = "run_gpr"
 
 # Minimization type: Global / Local
@@ -63,12 +74,51 @@ TEST_RSEED  = 200001
 # 0 = Matern
 # 1 = RBF
 # 2 = RQ
+# 3 = automatic selection from KERNEL_CANDIDATES
 MLKERNEL = 1
 
+# Candidate kernels of the automatic selection (see kernel_select.py), and
+# the score of the selection:
+#  loo: leave-one-out log predictive probability
+#  lml: log marginal likelihood
+# The candidates are fit in GP_FIT_PROCS processes, with
+# KERNEL_SELECT_RESTARTS random restarts each. The scores and the selected
+# kernel are written to KERNEL_SELECT_FILE, and the kernel is selected
+# again whenever the training data change (each iteration that adds
+# points).
+KERNEL_CANDIDATES = ["rbf", "rbf_ard", "matern15_ard", "matern25_ard", "rq", "rbf_ard+white",
+                     "matern25_ard+white", "rbf_ard+rq", "rbf_ard*rq"]
+KERNEL_SCORE = "loo"
+KERNEL_SELECT_RESTARTS = 2
+KERNEL_SELECT_FILE = "kernel_select.dat"
+
 # Systems used to train model. 
 #  [Name, # of density pts, cubedata jobtype, # states]
+# An optional fifth entry offsets the x and y density lines from the grid
+# center (cubedata xy_disp, in grid points).
 MOLEC_SYS = [["hcn", 64, 2, 1], ["hehhe", 64, 2, 1]]
 
+# Cheaper fidelities of P(x), cheapest first. Each is P(x) computed from a
+# subset of the systems of MOLEC_SYS (entries as in MOLEC_SYS, e.g. with
+# fewer states), and optionally its cost relative to the other fidelities
+# ("cost", default: the predicted QChem time of its systems). The values of
+# the cheaper fidelities are kept in training.<name>.dat, and are also
+# computed from the output of each full evaluation. P(x) is then modelled
+# as f_l(x) = rho_l f_(l-1)(x) + delta_l(x) over the fidelities, and each
+# iteration evaluates the proposed points at the cheapest fidelity that is
+# still uncertain there (see choose_fidelity). [] = full P(x) only.
+#  e.g. [{"name" : "hcn", "systems" : [["hcn", 64, 2, 1]]}]
+FIDELITIES = []
+
+# A fidelity is evaluated while its standard deviation at the proposed point
+# exceeds MF_THRESHOLD * sqrt(cost / cost of the next fidelity) times the
+# standard deviation of its training values
+MF_THRESHOLD = 0.1
+
+# Points of the initial data set evaluated at full cost (the rest are
+# evaluated at the cheapest fidelity). 0 = all points.
+MF_INIT_TOP = 0
+
 # Number of parameters being optimized
 NUM_PARAM = 2
 
@@ -100,9 +150,47 @@ BUILD_TESTING_SET = True
 # Size of testing data set
 TEST_DATA_SIZE = 3
 
+# Electronic structure program
+#  qchem: QChem
+#  mock:  Synthetic stand-in (source/mock_qchem.py). Writes a QChem-like
+#         output and den_p_0.cube without running QChem.
+QC_ENGINE = "qchem"
+
+# Artificial single thread wall time of the mock engine (seconds)
+MOCK_LATENCY = 0.0
+
 # Compute penalty function in parallel
 PARALLEL = "n"
 
+# Cores shared by QChem jobs run in parallel (0 = OMP_NUM_THREADS)
+PJOB_CORES = 0
+
+# Maximum number of QChem jobs running at once (0 = no limit)
+PJOB_MAX_JOBS = 0
+
+# Seconds between checks on running QChem jobs
+PJOB_POLL_TIME = 1.0
+
+# File of measured QChem wall times (molecule, threads, seconds). Used to
+# model how each system scales with threads when splitting the cores.
+PJOB_TIMING_FILE = "pjob_timing.dat"
+
+# Fraction of a QChem job assumed not to speed up with threads, used until
+# a system has been timed at two or more thread counts
+PJOB_SERIAL_FRACTION = 0.1
+
+# Start QChem jobs from the scratch files (SCF/CI guess) of the nearest
+# point already computed for the system (distance between log parameters).
+# QChem is run with -save, and SCF_GUESS = READ is added to the $rem section
+# of the input when a guess is staged.
+GUESS_REUSE = False
+
+# Directory of stored scratch files, one subdirectory per system
+GUESS_STORE_DIR = "guess_store"
+
+# Number of points stored per system. The least recently used are removed.
+GUESS_STORE_SIZE = 10
+
 # Use inverse of X (1/X)
 USE_XINV = False
 
@@ -116,21 +204,180 @@ LININD_PFCNVAL = 30000
 # at edge of range.
 NOEDGE_MINIMA = False
 
+# Weight density errors by w(x) = 1 + tanh{(Max[f] - f(x))/ Max[f]} - tanh{(Max[f]-Min[f])/Max[f]}
+# (f = benchmark density). Otherwise all points have weight one.
+DENS_TANH_WEIGHTS = False
+
+# Also write the density of each QChem job to '<molec>_dens.data'
+SAVE_DENS_DATA = False
+
 # Check P(x) function
 CHECK_PENFCN = False
 
+# Reuse P(x) for points that were already evaluated. Parameters are rounded
+# to the precision written to training.dat (5 decimals) before comparing.
+EVAL_CACHE = True
+
+# Points that differ by no more than this in every parameter are treated as
+# the same point
+EVAL_CACHE_TOL = 0.0
+
+# Fingerprint of the configuration (input decks, nbox and benchmark files,
+# MOLEC_SYS, PENFCN_WEIGHTS, basis) that the P(x) values of training.dat,
+# testing.dat and CENSORED_FILE were computed with. It is written at the
+# first run. If the configuration has changed since, these values (and
+# the journal's P(x) values of the other configuration) are not reused;
+# remove the file to reuse them anyway.
+EVAL_CACHE_CONFIG = "eval_config.dat"
+
+# Stop the QChem jobs of a point once the systems already finished give a
+# P(x) above a cutoff. The partial P(x), a lower bound, is kept as the value
+# of the point and the point is written to CENSORED_FILE. It is fit as
+# max(partial P(x), GP mean), is never accepted as the minimum, and is run
+# again in full if it is proposed again. Testing points always run every
+# system. Systems are run cheapest first. Only used when every weighted
+# component is non-negative (not with MINIMIZE_ABSE and ground state/states
+# weights).
+#  none:      Always run every system
+#  worst:     Cutoff is the largest P(x) evaluated so far
+#  incumbent: Cutoff is ABORT_FACTOR (> 1) times the smallest P(x) evaluated so far
+EARLY_ABORT = "none"
+ABORT_FACTOR = 2.0
+
+# Number of (uncensored) P(x) values needed before jobs are stopped early
+ABORT_MIN_POINTS = 5
+
+# File of points whose P(x) is a partial value (parameters, partial P(x), cutoff)
+CENSORED_FILE = "censored.dat"
+
 # Penalty function tolerance for convergence
 PF_TOL = 1.0
 
 # Global optimization searches
 NMIN_SEARCH = 5
 
+# Processes running the global optimization searches (0 = number of cores)
+SEARCH_PROCS = 0
+
 # Start one search from minimum of data set
 START_FROM_MIN = False
 
+# Function of the GP minimized to propose points
+#  mean:  GP mean (predicted P(x))
+#  ei:    Expected improvement over the smallest P(x) in training data
+#  logei: Logarithm of the expected improvement (same optimum as ei, but
+#         with useful gradients far from the training minimum)
+#  lcb:   Lower confidence bound, mean - kappa * sigma
+#  pi:    Probability of improvement (its logarithm)
+ACQUISITION = "mean"
+
+# Improvement required by ei, logei and pi (units of P(x))
+ACQ_XI = 0.0
+
+# kappa of lcb
+#  constant: LCB_KAPPA
+#  gpucb:    sqrt(2 log(n^(d/2+2) pi^2 / (3 LCB_DELTA))) for n training
+#            points in d dimensions (Srinivas et al.), growing with n
+LCB_SCHEDULE = "constant"
+LCB_KAPPA = 2.0
+LCB_DELTA = 0.1
+
+# Number of points proposed (and evaluated in parallel) per iteration
+BATCH_SIZE = 1
+
+# Value assumed for proposed points while the rest of the batch is chosen
+#  max:      Largest P(x) in training data (constant liar)
+#  believer: GP prediction at the point (kriging believer)
+BATCH_LIAR = "max"
+
+# Trust regions (TuRBO, Eriksson et al. 2019). With TRUST_REGIONS > 0, the
+# points of each iteration are searched within TRUST_REGIONS boxes around
+# the best points found, each with a GP model of the training points near
+# it, instead of over PBOUNDS with a GP model of all training points. The
+# batch is shared between the boxes by acquisition value. The side of a
+# box is a fraction of the range of each parameter (scaled by the length
+# scales of its GP model), starting at TR_LENGTH_INIT. It is doubled (up to
+# TR_LENGTH_MAX) after TR_SUCC_TOL iterations improving the best point of
+# the box, and halved after TR_FAIL_TOL iterations that do not (0 =
+# max(4, NUM_PARAM) / BATCH_SIZE). A box smaller than TR_LENGTH_MIN is
+# restarted around a random point. The boxes are kept in TR_STATE_FILE.
+# The GP models of the boxes are exact GP models of P(x) (FIDELITIES,
+# SURROGATE and GP_BACKEND are not used).
+TRUST_REGIONS = 0
+TR_LENGTH_INIT = 0.8
+TR_LENGTH_MIN = 0.0078125
+TR_LENGTH_MAX = 1.6
+TR_SUCC_TOL = 3
+TR_FAIL_TOL = 0
+TR_STATE_FILE = "trust_region.dat"
+
+# Training points of the GP model of a box: those within twice the box, and
+# at least the TR_MIN_POINTS nearest ones
+TR_MIN_POINTS = 20
+
 # Scaling of P(x)
 YSCALE = 1.0
 
+# Refit the GP hyperparameters every GP_REFIT_EVERY iterations (1 = every
+# iteration). In between, the Cholesky factor of the last model is extended
+# with the points added to training.dat.
+GP_REFIT_EVERY = 1
+
+# Also refit when the log marginal likelihood per training point has dropped
+# by more than this since the last refit
+GP_LML_DRIFT = 0.5
+
+# Random restarts of the GP hyperparameter optimization (both backends). The
+# first fit starts from the hyperparameters of the last model (or coeff.dat).
+GP_RESTARTS = 12
+
+# Processes running the hyperparameter fits (0 = number of cores)
+GP_FIT_PROCS = 0
+
+# Stop the restarts once GP_RESTART_AGREE fits reach the best log marginal
+# likelihood (within GP_RESTART_TOL). 0 = always run all restarts.
+GP_RESTART_AGREE = 3
+GP_RESTART_TOL = 1.0e-3
+
+# GP model
+#  exact:  sklearn GaussianProcessRegressor, O(n^3) in the training points
+#  sparse: inducing point approximation (see sparse_gp.py), O(n m^2) for
+#          m = SPARSE_GP_INDUCING inducing points. For large training sets.
+GP_BACKEND = "exact"
+
+# Inducing points of the sparse GP model
+SPARSE_GP_INDUCING = 500
+
+# Training points per chunk of the sparse GP kernel matrix
+SPARSE_GP_CHUNK = 5000
+
+# Surrogate model of P(x)
+#  sum:        one GP model of P(x)
+#  components: one GP model of each component of each system (e.g.
+#              "hcn:density"), combined with PENFCN_WEIGHTS at prediction.
+#              The components are computed from the output of each
+#              evaluation and kept in COMPONENT_FILE. Not used with
+#              FIDELITIES.
+SURROGATE = "sum"
+COMPONENT_FILE = "training.components.dat"
+
+# Fraction of the training points that must have all components for the
+# components model to be used. Until then the GP model of P(x) is trained.
+COMPONENT_MIN_COVERAGE = 0.95
+
+# Trained GP model (binary). It is read back instead of refitting when the
+# training data has not changed, and used by JOBTYPE = "predict".
+GP_MODEL_FILE = "gp_model.npz"
+
+# Also write the Cholesky factor and weights of the GP model as text
+# (k.dat, alpha.dat). Slow and large for big training sets.
+GP_TEXT_DUMP = False
+
+# Points (parameters, one per row) predicted by JOBTYPE = "predict", and the
+# output (parameters, P(x), standard deviation)
+PREDICT_FILE = "predict.dat"
+PREDICT_OUTPUT = "predict.output"
+
 # String for beginning of basis
 BASBEGINSTR="$neo_basis\nH    3\n"
 
@@ -141,14 +388,584 @@ ET_BASIS_NUM_FCNS = [5, 4, 3, 2, 1]
 # Build directories (relevant for training generation)
 MAKE_TRAINING_DIRS = False
 
+# Hard-link the nbox and benchmark files into the training directories
+# instead of writing copies
+TRAINING_TREE_LINKS = False
+
+# Keep QChem outputs
+#  archive: Compressed and indexed by molecule and parameters in
+#           OUTPUT_ARCHIVE_DIR (see source/output_archive.py)
+#  log:     Appended to qc.<molec>.log
+#  none:    Not kept
+OUTPUT_ARCHIVE = "archive"
+OUTPUT_ARCHIVE_DIR = "qc_archive"
+
+# Also archive den_p_0.cube
+OUTPUT_ARCHIVE_CUBE = False
+
+# Maximum size of the archive in MB (0 = no limit). The oldest outputs are
+# removed first.
+OUTPUT_ARCHIVE_MAX_MB = 0
+
+# Run id stored with archived outputs ("" = SLURM_JOB_ID, or the start time)
+OUTPUT_ARCHIVE_RUN_ID = ""
+
+# Append-only journal of proposed points, QChem jobs and P(x) values. A run
+# that was interrupted resumes from it: P(x) values are taken from the
+# journal (with EVAL_CACHE), finished QChem outputs are reused, and the
+# points proposed in an unfinished iteration are evaluated without
+# retraining the GP if training.dat has not changed. Each time results are
+# added to the training data, the journal is compacted to the last state
+# of each work directory and the P(x) values of points not in the training
+# data (see journal_commit). "" to disable.
+RUN_JOURNAL = "run_journal.dat"
+
+# Binary store of the training data (see training_store.py), with the full
+# precision parameters, P(x), censored flag and penalty function components
+# of each point. Points are appended to it, and training.dat is kept as a
+# text export. It is rebuilt from training.dat if that file is changed by
+# other programs. "" to use training.dat only.
+TRAINING_STORE = "training.bin"
+
 #######################################################################
 ### GLOBAL VAR FROM INPUT ###
 
 
 # Number of OMP Threads
 NTHREADS = os.getenv("OMP_NUM_THREADS")
+
+# Modules from source/
+sys.path.insert(0, PROGRAM_HOME+"/source")
+import cubedata
+import density_rmse
+import qchem_output
+import run_journal
+import output_archive
+import sparse_gp
+import training_store
+import multi_fidelity
+import component_gp
+import kernel_select
+
+# Density of the last QChem job of each molecular system
+DENS_DATA = {}
+
+# Measured QChem wall times: molecule -> list of (threads, seconds)
+JOB_TIMING = None
+
+# Stored guesses: molecule -> list of (id, parameters), least recently used first
+GUESS_STORE = None
+
+# Run journal state (see load_run_journal)
+JOURNAL = None
+
+# Fingerprint of the configuration (see config_fingerprint)
+CONFIG_FINGERPRINT = None
+
+# Contents of the input deck of each molecular system
+DECK_CACHE = {}
+
+# GP model of the last iteration (see train_gp_model)
+GP_STATE = None
+
+# Open training data store (see load_training_store)
+TRAIN_STORE = None
+
+# Points of each fidelity of P(x) (see read_fidelity_data)
+FIDELITY_DATA = {}
+
+# Multi-fidelity GP model of the last iteration, and GP models of the
+# cheaper fidelities: {level : {"fingerprint", "gp"}} (see train_mf_model)
+MF_MODEL = None
+MF_LEVELS = {}
+
+# Components of P(x) at the evaluated points, and the GP model of each
+# component: {name : {"fingerprint", "nfit", "iters", "gp"}} (see
+# train_component_model)
+COMPONENT_DATA = None
+COMPONENT_MODELS = {}
+
+# Penalty function components kept in the training data store
+PENFCN_COMPONENTS = ["density", "excited states", "ground state", "states"]
+
+# Version of GP_MODEL_FILE
+GP_MODEL_VERSION = 1
+
+# Attributes of the GP models stored in GP_MODEL_FILE
+GP_MODEL_ATTRS = {"exact" : ["X_train_", "y_train_", "L_", "alpha_", "alpha", "_y_train_mean", "_y_train_std",
+                             "log_marginal_likelihood_value_"],
+                  "sparse" : ["X_train_", "Z_", "Luu_", "LB_", "c_", "alpha_", "noise_", "_y_train_mean",
+                              "_y_train_std", "log_marginal_likelihood_value_"]}
+
+# Kernel selected automatically: {"name", "theta", "fingerprint"} (see
+# select_kernel)
+KERNEL_CHOICE = None
+
+# GP model searched by the processes of basinhopping_searches
+SEARCH_GP = None
+
+# Smallest P(x) in training data and kappa, for the acquisition function
+# (set by search_gp_minimum)
+ACQ_STATE = {"ybest" : 0.0, "kappa" : LCB_KAPPA}
+
+# Stored P(x) evaluations (see cache_lookup / cache_store)
+PENFCN_CACHE = {"index" : {}, "X" : [], "val" : [], "comp" : [], "tree" : None,
+                "hits" : 0, "misses" : 0, "censored" : set()}
 #---------------------------------------------------------------------
 
+#
+# acquisition_value: Acquisition function (ACQUISITION) from the GP mean and
+# standard deviation. Smaller is better for all of them.
+# Input:
+#  y_mean      = GP mean
+#  sigma       = GP standard deviation
+#  derivatives = also return the derivatives
+# Output:
+#  acq   = acquisition function
+#  dmean = (derivatives) derivative with respect to y_mean
+#  dstd  = (derivatives) derivative with respect to sigma
+#
+def acquisition_value(y_mean, sigma, derivatives=False):
+
+    y_mean = np.asarray(y_mean, dtype=float)
+    sigma = np.maximum(np.asarray(sigma, dtype=float), 1.0e-12)
+    ones = np.ones_like(y_mean)
+
+    if (ACQUISITION == "lcb"):
+        kappa = ACQ_STATE["kappa"]
+        acq, dmean, dstd = y_mean - kappa * sigma, ones, -kappa * ones
+    elif (ACQUISITION in ["ei", "logei", "pi"]):
+        # z = improvement / sigma. For z < 0, Phi(z) = phi(z) r with
+        # r = sqrt(pi/2) erfcx(-z/sqrt(2)), which avoids the cancellation in
+        # h(z) = phi(z) + z Phi(z) = phi(z) (1 + z r).
+        z = (ACQ_STATE["ybest"] - ACQ_XI - y_mean) / sigma
+        neg = z < 0.0
+        phi = np.exp(-0.5 * z**2) / np.sqrt(2.0 * np.pi)
+        Phi = ndtr(z)
+        r = np.sqrt(np.pi / 2.0) * erfcx(-np.minimum(z, 0.0) / np.sqrt(2.0))
+        g = np.maximum(1.0 + z * r, 1.0e-300)
+        h = np.where(neg, phi * g, phi + z * Phi)
+        if (ACQUISITION == "pi"):
+            # -log Phi(z)
+            phi_Phi = np.where(neg, 1.0 / r, phi / np.maximum(Phi, 1.0e-300))
+            acq, dmean, dstd = -log_ndtr(z), phi_Phi / sigma, z * phi_Phi / sigma
+        elif (ACQUISITION == "ei"):
+            # -EI = -sigma h(z)
+            acq, dmean, dstd = -sigma * h, Phi, -phi
+        else:
+            # -log EI
+            logh = np.where(neg, -0.5 * z**2 - 0.5 * np.log(2.0 * np.pi) + np.log(g),
+                            np.log(np.maximum(h, 1.0e-300)))
+            acq = -(np.log(sigma) + logh)
+            dmean = np.where(neg, r / g, Phi / np.maximum(h, 1.0e-300)) / sigma
+            dstd = -np.where(neg, 1.0 / g, phi / np.maximum(h, 1.0e-300)) / sigma
+    else:
+        acq, dmean, dstd = y_mean, ones, 0.0 * ones
+
+    if (derivatives):
+        return acq, dmean, dstd
+    return acq
+
+#
+# add_rem_variable: Add a variable to the $rem section of a QChem input
+# Input:
+#  flname = QChem input file
+#  name   = variable
+#  value  = value
+# Output:
+#  found = True if the input has a $rem section
+#
+def add_rem_variable(flname, name, value):
+
+    qfile = open(flname, "r")
+    lines = qfile.read().splitlines(True)
+    qfile.close()
+
+    for i in range(len(lines)):
+        if (lines[i].strip().lower() == "$rem"):
+            lines.insert(i + 1, "   "+name+" "+value+"\n")
+            qfile = open(flname, "w")
+            qfile.writelines(lines)
+            qfile.close()
+            return True
+
+    return False
+
+#
+# append_training_data: Add points to the training data (TRAINING_STORE and
+# training.dat). The components and censored flag of each point are taken
+# from the P(x) cache. Points already in the training data with the same
+# P(x) (a point proposed again) are skipped.
+# Input:
+#  new_var = list of parameters
+#  new_val = P(x) for each set of parameters
+#
+def append_training_data(new_var, new_val):
+
+    f_training = "training.dat"
+    X, Y = read_training_data()
+    known = {}
+    for i in range(len(Y)):
+        known[cache_key(X[i])] = Y[i]
+    keep = [k for k in range(len(new_var)) if abs(known.get(cache_key(new_var[k]), np.inf) - new_val[k]) > 1.0e-6]
+    if (len(keep) < len(new_var)):
+        print("Skipping %d points already in the training data" % (len(new_var) - len(keep)))
+        new_var = [new_var[k] for k in keep]
+        new_val = [new_val[k] for k in keep]
+    if (len(new_var) == 0):
+        journal_commit()
+        return
+
+    if (TRAINING_STORE == ""):
+        # Add new parameters and results
+        X = np.concatenate((X, np.atleast_2d(new_var)), axis=0)
+        Y = np.concatenate((Y, np.array(new_val)), axis=0)
+        data = np.column_stack((X,Y))
+        # Build format string
+        fmtstr = ""
+        for v in range(NUM_PARAM):
+            fmtstr = fmtstr+" %10.5f"
+
+        fmtstr = fmtstr+" %12.8f"
+        # save old training data file
+        if os.path.isfile(f_training):
+            shutil.copy(f_training, f_training+"_prev")
+        # save results
+        np.savetxt(f_training+".new", data, fmt=fmtstr)
+        run_journal.replace_file(f_training+".new", f_training)
+        journal_commit()
+        return
+
+    rows = np.full((len(new_var), NUM_PARAM + 2 + len(PENFCN_COMPONENTS)), np.nan)
+    for k in range(len(new_var)):
+        rows[k,0:NUM_PARAM] = new_var[k][0:NUM_PARAM]
+        rows[k,NUM_PARAM] = new_val[k]
+        rows[k,NUM_PARAM+1] = 0.0
+        if (EVAL_CACHE):
+            stored = cache_lookup(new_var[k])
+            if (stored is not None and stored[1] is not None):
+                for i in range(len(PENFCN_COMPONENTS)):
+                    rows[k,NUM_PARAM+2+i] = stored[1].get(PENFCN_COMPONENTS[i], np.nan)
+            if cache_censored(new_var[k]):
+                rows[k,NUM_PARAM+1] = 1.0
+
+    store = load_training_store(True)
+    start = store["nrows"]
+    training_store.append_rows(store, rows)
+    write_training_text(store, start)
+    journal_commit()
+
+#
+# append_fidelity_data: Add points to the training data of a cheaper
+# fidelity (training.<name>.dat). Points already there are skipped.
+# Input:
+#  level   = fidelity (index in FIDELITIES)
+#  new_var = list of parameters
+#  new_val = P(x) at this fidelity for each set of parameters
+#
+def append_fidelity_data(level, new_var, new_val):
+
+    data = read_fidelity_data(level)
+    lines = []
+    for k in range(len(new_var)):
+        key = cache_key(new_var[k])
+        if key in data["keys"]:
+            continue
+        data["keys"].add(key)
+        data["X"].append(list(new_var[k][0:NUM_PARAM]))
+        data["Y"].append(new_val[k])
+        lines.append("".join(" %10.5f" % v for v in new_var[k][0:NUM_PARAM]) + " %12.8f\n" % new_val[k])
+
+    dfile = open(fidelity_data_file(level), "a")
+    dfile.writelines(lines)
+    dfile.flush()
+    os.fsync(dfile.fileno())
+    dfile.close()
+
+#
+# archive_qchem_output: Keep the output of a QChem job (see OUTPUT_ARCHIVE)
+# Input:
+#  molec = molecule
+#  wdir  = work directory of the job
+#  var   = parameters of the job
+#
+def archive_qchem_output(molec, wdir, var):
+
+    if (OUTPUT_ARCHIVE == "log"):
+        with open("qc."+molec+".log", "a") as logf, open(wdir+"/"+molec+".output", "r") as qfile:
+            shutil.copyfileobj(qfile, logf)
+        return
+    elif (OUTPUT_ARCHIVE != "archive"):
+        return
+
+    global OUTPUT_ARCHIVE_RUN_ID
+    if (OUTPUT_ARCHIVE_RUN_ID == ""):
+        OUTPUT_ARCHIVE_RUN_ID = os.getenv("SLURM_JOB_ID", time.strftime("%Y%m%d-%H%M%S"))
+
+    archive = output_archive.open_archive(OUTPUT_ARCHIVE_DIR)
+    key = " ".join(journal_words(var))
+    files = [("output", wdir+"/"+molec+".output")]
+    if (OUTPUT_ARCHIVE_CUBE):
+        files.append(("cube", wdir+"/den_p_0.cube"))
+    for kind, flname in files:
+        if not os.path.isfile(flname):
+            continue
+        qfile = open(flname, "rb")
+        output_archive.add_entry(archive, OUTPUT_ARCHIVE_RUN_ID, molec, kind, key, qfile.read())
+        qfile.close()
+
+    if (OUTPUT_ARCHIVE_MAX_MB > 0):
+        output_archive.evict_entries(archive, int(OUTPUT_ARCHIVE_MAX_MB * 1024 * 1024))
+
+#
+# allocate_job_threads: Split the available cores between QChem jobs.
+# Jobs are placed in lanes; lanes run at the same time and the jobs of a
+# lane run one after another. The number of lanes, the placement of jobs
+# (longest first) and the cores of each lane are chosen to minimize the
+# predicted time to finish all jobs (see job_cost_model).
+# Input:
+#  jobs        = list of jobs from create_pjob_dir
+#  ncores      = number of cores available
+#  cheap_first = run the jobs of each lane shortest first
+# Output:
+#  lanes    = list of lanes, each a list of job indices
+#  nthreads = number of threads of each lane
+#
+def allocate_job_threads(jobs, ncores, cheap_first=False):
+
+    njobs = len(jobs)
+    models = []
+    for job in jobs:
+        models.append(job_cost_model(job["molec"]))
+
+    # Maximum number of lanes
+    kmax = max(1, min(njobs, ncores))
+    if (PJOB_MAX_JOBS > 0):
+        kmax = min(kmax, PJOB_MAX_JOBS)
+
+    best_time = 0.0
+    for k in range(1, kmax + 1):
+
+        # Place jobs, longest first, in the lane with the least work
+        nk = max(1, ncores // k)
+        order = sorted(range(njobs), key=lambda j: -predict_job_time(models[j], nk))
+        lanes = [[] for l in range(k)]
+        load = [0.0] * k
+        for j in order:
+            l = int(np.argmin(load))
+            lanes[l].append(j)
+            load[l] = load[l] + predict_job_time(models[j], nk)
+
+        # Give each core to the lane that would otherwise finish last
+        nthreads = [1] * k
+        for c in range(ncores - k):
+            times = [sum(predict_job_time(models[j], nthreads[l]) for j in lanes[l]) for l in range(k)]
+            nthreads[int(np.argmax(times))] += 1
+        times = [sum(predict_job_time(models[j], nthreads[l]) for j in lanes[l]) for l in range(k)]
+
+        if (k == 1 or max(times) < best_time):
+            best_time = max(times)
+            best_lanes = lanes
+            best_threads = nthreads
+
+    if (cheap_first):
+        for l in range(len(best_lanes)):
+            best_lanes[l].sort(key=lambda j: predict_job_time(models[j], best_threads[l]))
+
+    return best_lanes, best_threads
+
+#
+# basinhopping_search: Global search for the minimum of SEARCH_GP
+# Input:
+#  args = (x0, seed, nthreads)
+#   x0       = starting point
+#   seed     = random seed of basinhopping
+#   nthreads = BLAS threads (None = no limit)
+# Output:
+#  x = minimum found
+#
+def basinhopping_search(args):
+    x0, seed, nthreads = args
+    bnds = get_param_bounds()
+    fun, jac = gp_search_objective(SEARCH_GP)
+    minimizer = {"method": "L-BFGS-B", "jac":jac, "args":SEARCH_GP,"bounds":bnds}
+    with threadpool_limits(limits=nthreads):
+        res = basinhopping(fun,x0,minimizer_kwargs=minimizer,niter=1000,seed=seed)
+    return res.x
+
+#
+# basinhopping_searches: Run the global searches of the GP minimum in
+# SEARCH_PROCS processes. The processes are forked, so the GP model is
+# shared with them rather than copied to each search.
+# Input:
+#  gp     = trained GP model
+#  starts = starting points
+# Output:
+#  xs = minimum found from each starting point
+#
+def basinhopping_searches(gp, starts):
+
+    global SEARCH_GP
+    SEARCH_GP = gp
+    seeds = np.random.randint(0, 2**31 - 1, len(starts))
+
+    nproc = SEARCH_PROCS
+    if (nproc <= 0):
+        nproc = os.cpu_count()
+    nproc = max(1, min(nproc, len(starts)))
+
+    if (nproc > 1 and "fork" in multiprocessing.get_all_start_methods()):
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = nproc,
+                                                      mp_context = multiprocessing.get_context("fork"))
+        xs = list(pool.map(basinhopping_search, [(x0, seed, 1) for x0, seed in zip(starts, seeds)]))
+        pool.shutdown()
+    else:
+        xs = list(map(basinhopping_search, [(x0, seed, None) for x0, seed in zip(starts, seeds)]))
+
+    SEARCH_GP = None
+    return xs
+
+#
+# build_kernel: GP kernel selected by MLKERNEL (or by select_kernel), with
+# its initial hyperparameters
+# Output:
+#  k = kernel
+#
+def build_kernel():
+    d = NUM_PARAM
+    ck = C(1.0, (1e-5, 1e+5))
+    kernels_m = [RBF(length_scale=np.ones(d), length_scale_bounds=(1e-5, 1e+5)),
+                 RQ(length_scale=1.0, alpha=0.1,length_scale_bounds=(1e-5, 1e+5), alpha_bounds=(1e-5, 1e+5)),
+                 Matern(length_scale=np.ones(d), length_scale_bounds=(1e-5, 1e+5),nu=2.5)]
+    ks = kernel_user()
+    if ks == "auto":
+        return select_kernel()
+    if ks == "mat":
+        k = ck * kernels_m[2]
+    elif ks == "rbf":
+        k = ck * kernels_m[0]
+    elif ks == "rq":
+        k = ck * kernels_m[1]
+    wk_bool = "no"
+    if wk_bool == "yes" or wk_bool == "YES":
+        k = k + ck * WhiteKernel(0.1)
+    return k
+
+#
+# cache_censored: Check if the stored P(x) of the parameters is a partial
+# value (see EARLY_ABORT).
+# Input:
+#  var = parameters
+#
+def cache_censored(var):
+    i = cache_index(var)
+    return i is not None and PENFCN_CACHE["X"][i] in PENFCN_CACHE["censored"]
+
+#
+# cache_check: Look up parameters in the cache before running QChem.
+# Hits and misses are counted for print_cache_stats. Partial values are
+# counted as misses, as the point is then evaluated in full.
+# Input:
+#  var = parameters
+# Output:
+#  (val, comp) if found, None otherwise
+#
+def cache_check(var):
+
+    if not (EVAL_CACHE):
+        return None
+
+    stored = cache_lookup(var)
+    if (stored is not None and cache_censored(var)):
+        print("Stored P(x) = %15.8f is a partial value, evaluating the point again" % stored[0])
+        stored = None
+    if stored is None:
+        PENFCN_CACHE["misses"] = PENFCN_CACHE["misses"] + 1
+        return None
+
+    PENFCN_CACHE["hits"] = PENFCN_CACHE["hits"] + 1
+    print("Using stored P(x) = %15.8f" % stored[0])
+    if stored[1] is not None:
+        for name in stored[1]:
+            print("  %-15s %15.8f" % (name, stored[1][name]))
+    sys.stdout.flush()
+    return stored
+
+#
+# cache_key: Round parameters to the precision written to disk.
+# Input:
+#  var = parameters
+# Output:
+#  key = tuple of parameters in units of 1.0e-5
+#
+def cache_key(var):
+    return tuple(int(v) for v in np.rint(np.asarray(var, dtype=float) * 1.0e5))
+
+#
+# cache_index: Find the stored P(x) evaluation of the parameters.
+# Input:
+#  var = parameters
+# Output:
+#  i = index of the evaluation in the cache, None if not found
+#
+def cache_index(var):
+
+    key = cache_key(var)
+    if key in PENFCN_CACHE["index"]:
+        return PENFCN_CACHE["index"][key]
+
+    if (EVAL_CACHE_TOL <= 0.0 or len(PENFCN_CACHE["X"]) == 0):
+        return None
+
+    # Search nearby points. The tree is rebuilt only after new points are stored.
+    if PENFCN_CACHE["tree"] is None:
+        PENFCN_CACHE["tree"] = cKDTree(np.array(PENFCN_CACHE["X"]))
+    dist, i = PENFCN_CACHE["tree"].query(np.array(key, dtype=float), p=np.inf,
+                                         distance_upper_bound=EVAL_CACHE_TOL * 1.0e5 + 0.5)
+    if np.isinf(dist):
+        return None
+    return i
+
+#
+# cache_lookup: Find a stored P(x) evaluation for the parameters.
+# Input:
+#  var = parameters
+# Output:
+#  (val, comp) if found, None otherwise
+#
+def cache_lookup(var):
+    i = cache_index(var)
+    if i is None:
+        return None
+    return PENFCN_CACHE["val"][i], PENFCN_CACHE["comp"][i]
+
+#
+# cache_store: Store a P(x) evaluation.
+# Input:
+#  var  = parameters
+#  val  = P(x)
+#  comp     = dictionary of penalty function components (None if unknown)
+#  censored = P(x) is a partial value (see EARLY_ABORT)
+#
+def cache_store(var, val, comp, censored=False):
+
+    key = cache_key(var)
+    if (censored):
+        PENFCN_CACHE["censored"].add(key)
+    else:
+        PENFCN_CACHE["censored"].discard(key)
+    if key in PENFCN_CACHE["index"]:
+        i = PENFCN_CACHE["index"][key]
+        PENFCN_CACHE["val"][i] = val
+        PENFCN_CACHE["comp"][i] = comp
+        return
+
+    PENFCN_CACHE["index"][key] = len(PENFCN_CACHE["X"])
+    PENFCN_CACHE["X"].append(key)
+    PENFCN_CACHE["val"].append(val)
+    PENFCN_CACHE["comp"].append(comp)
+    PENFCN_CACHE["tree"] = None
+
 #
 # check_for_error: Check if error occured in QChem job.
 # Input:
@@ -156,18 +973,62 @@ NTHREADS = os.getenv("OMP_NUM_THREADS")
 # Returns:
 #  eflag = Error occurred (1) or not (0)
 def check_for_error(flname):
-    qfile = open(flname,"r")
-    qf_lines = (qfile.read().splitlines())
-    qfile.close()
-    nlines = len(qf_lines)
     eflag = 0
-    for i in range(nlines):
-        if "Error: in the serial run" in str(qf_lines[i]):
-            eflag = 1
-            break
+    if qchem_output.parse_qchem_output(flname)["error"]:
+        eflag = 1
     return eflag
 
 
+#
+# check_fidelities: Check that the systems of each fidelity are in MOLEC_SYS
+#
+def check_fidelities():
+    names = [msys[0] for msys in MOLEC_SYS]
+    for fid in FIDELITIES:
+        for msys in fid["systems"]:
+            if msys[0] not in names:
+                print("ERROR: System "+msys[0]+" of fidelity "+fid["name"]+" is not in MOLEC_SYS!\n")
+                sys.exit("Error message")
+
+#
+# choose_fidelity: Fidelity at which to evaluate a proposed point: the
+# cheapest one whose standard deviation at the point is larger than
+#  MF_THRESHOLD * sqrt(cost / cost of the next fidelity) * std(values)
+# (Kandasamy et al., MF-GP-UCB). Fidelities without training data are
+# evaluated first, and fidelities already computed at the point are skipped.
+# Input:
+#  gp  = multi-fidelity GP model (see train_mf_model)
+#  var = parameters
+# Output:
+#  level = index in FIDELITIES, len(FIDELITIES) for the full P(x)
+#
+def choose_fidelity(gp, var):
+
+    top = len(FIDELITIES)
+    if gp is None:
+        return top
+    key = cache_key(var[0:NUM_PARAM])
+    for level in range(top):
+        if (level not in gp.levels and key not in read_fidelity_data(level)["keys"]):
+            return level
+
+    x = np.atleast_2d(var[0:NUM_PARAM])
+    if (USE_XINV):
+        x = np.divide(1, x)
+    for i in range(len(gp.levels) - 1):
+        level = gp.levels[i]
+        data = read_fidelity_data(level)
+        if key in data["keys"]:
+            continue
+        y_mean, y_std = gp.predict_level(x, i, return_std=True)
+        gamma = (MF_THRESHOLD * np.sqrt(fidelity_cost(level) / fidelity_cost(gp.levels[i+1]))
+                 * np.std(np.multiply(data["Y"], YSCALE)))
+        print(" Fidelity %-10s std %12.6f, threshold %12.6f" % (FIDELITIES[level]["name"], y_std[0], gamma))
+        if (y_std[0] > gamma):
+            return level
+    return top
+
+#
 # check_linind: Check linear independence of functions
 # Returns:
 #  False = functions could be linearly independent
@@ -183,9 +1044,23 @@ def check_linind(X):
         if ORBITAL_TYPE[i] == ORBITAL_TYPE[i+1]:
             if abs(X[i] - X[i+1]) < LININD_COEFTOL:
                 return True
-    
+
     return False
 
+#
+# check_qchem_job: Stop if a QChem job failed, before its output and cube
+# file are read
+# Input:
+#  molec  = molecule
+#  wdir   = work directory of the job
+#  status = exit status of the program
+#
+def check_qchem_job(molec, wdir, status):
+    flname = wdir+"/"+qchem_stdout(molec)
+    if (status != 0 or check_for_error(wdir+"/"+molec+".output") != 0):
+        print("ERROR: QChem job of "+molec+" in "+wdir+" failed (exit status %d). See %s\n" % (status, flname))
+        sys.exit("Error message")
+
 #
 # collect_training_dataset: Collect training data from subdirectories
 # Input:
@@ -225,7 +1100,9 @@ def collect_training_dataset(data_size, num_param):
             os.chdir(curr_dir+"/"+str(i)+"/"+MOLEC_SYS[j][0])
             process_qchem_job(MOLEC_SYS[j][0], PENFCN_WEIGHTS, MOLEC_SYS[j][2], MOLEC_SYS[j][3])
             # Copy processed files to data directory (where objective function is eval)
-            command_line("cp "+MOLEC_SYS[j][0]+"* "+idata_dir)
+            for fname in os.listdir("."):
+                if (fname.startswith(MOLEC_SYS[j][0]) and os.path.isfile(fname)):
+                    shutil.copy(fname, idata_dir)
         # Compute objective function
         os.chdir(idata_dir)
         val = np.array([compute_objective_function_in_dir()])
@@ -254,6 +1131,21 @@ def command_line(command):
     print (output)
     return output
 
+#
+# component_terms: Components of P(x) modelled with SURROGATE = components:
+# each component of PENFCN_COMPONENTS with a nonzero weight, for each
+# system, named <molecule>:<component> (spaces replaced by _)
+# Output:
+#  names = list of names
+#
+def component_terms():
+    names = []
+    for msys in MOLEC_SYS:
+        for comp in PENFCN_COMPONENTS:
+            if (PENFCN_WEIGHTS[comp] != 0.0):
+                names.append(msys[0]+":"+comp.replace(" ", "_"))
+    return names
+
 #
 # compute_objective_function_in_dir: compute the objective function based
 # on files in current directory
@@ -280,6 +1172,34 @@ def compute_objective_function_in_dir():
 
     return val
 
+#
+# config_fingerprint: Checksum of everything that P(x) depends on besides
+# the parameters: the input decks, nbox and benchmark files of each system,
+# MOLEC_SYS, PENFCN_WEIGHTS, the density and energy options and the basis
+# functions. Computed once.
+# Output:
+#  fingerprint = checksum, as a string
+#
+def config_fingerprint():
+
+    global CONFIG_FINGERPRINT
+    if CONFIG_FINGERPRINT is not None:
+        return CONFIG_FINGERPRINT
+
+    text = [repr(MOLEC_SYS), repr(sorted(PENFCN_WEIGHTS.items())), repr(MINIMIZE_ABSE),
+            repr(DENS_TANH_WEIGHTS), repr(ORBITAL_TYPE), repr(EVEN_TEMPERED_BASIS)]
+    if (EVEN_TEMPERED_BASIS):
+        text.append(repr(ET_BASIS_NUM_FCNS))
+    for msys in MOLEC_SYS:
+        for flname in [msys[0]+".input_deck", msys[0]+".nbox_data.txt", msys[0]+".nbox_npts.txt",
+                       msys[0]+"_dens.benchmark.data", msys[0]+"_states.benchmark.data"]:
+            if os.path.isfile(flname):
+                dfile = open(flname, "rb")
+                text.append(flname+" %08x" % zlib.crc32(dfile.read()))
+                dfile.close()
+    CONFIG_FINGERPRINT = "%08x" % zlib.crc32("\n".join(text).encode())
+    return CONFIG_FINGERPRINT
+
 #
 # create_nbox_files: Create the nbox_data.txt and nbox_npts.txt files the
 # given molecule
@@ -287,10 +1207,8 @@ def compute_objective_function_in_dir():
 #  molec = System  
 #
 def create_nbox_files(molec):
-    cmdl_arg = "cp "+molec+".nbox_npts.txt nbox_npts.txt"
-    command_line(cmdl_arg)
-    cmdl_arg = "cp "+molec+".nbox_data.txt nbox_data.txt"
-    command_line(cmdl_arg)
+    shutil.copy(molec+".nbox_npts.txt", "nbox_npts.txt")
+    shutil.copy(molec+".nbox_data.txt", "nbox_data.txt")
 
 
 #
@@ -300,93 +1218,189 @@ def create_nbox_files(molec):
 #  var   = parameters
 #
 def create_qchem_file(molec, var):
+    input_file = open(molec+".input", "w")
+    input_file.write(qchem_input_text(molec, var))
+    input_file.close()
 
-    # Create name as string to open input file deck and input file to make.
-    # Copy deck file to make new file. Append basis set information to
-    # this file.
-    deck_fname = molec+".input_deck"
-    qcin_fname = molec+".input"
-    
-    command_line('''cp '''+deck_fname+''' '''+qcin_fname)
-    input_file = open(qcin_fname, "a")
-    
-    input_file.write(BASBEGINSTR)
+#
+# create_pjob_dir: Create the work directory for a QChem job that is run in
+# parallel with others.
+# Input:
+#  var  = basis set parameters
+#  msys = molecular system entry from MOLEC_SYS
+#  wdir = work directory
+# Output:
+#  job = job description used by run_pjobs
+#
+def create_pjob_dir(var, msys, wdir):
 
-    if EVEN_TEMPERED_BASIS == False:
+    molec = msys[0]
+    os.makedirs(wdir, exist_ok=True)
 
-        for i in range(len(var)):
-            input_file.write(str(ORBITAL_TYPE[i])+"   1   1.0\n")
-            input_file.write(" %.5f   1.0000D+00\n" % var[i])
+    # Create the input file and copy it, with the nbox files, into the
+    # work directory
+    create_qchem_file(molec, var)
+    shutil.copy(molec+".input", wdir+"/"+molec+".input")
+    shutil.copy(molec+".nbox_npts.txt", wdir+"/nbox_npts.txt")
+    shutil.copy(molec+".nbox_data.txt", wdir+"/nbox_data.txt")
+    stage_guess(molec, var, wdir)
 
-    else:
+    job = {"molec" : molec, "dir" : wdir, "cjobtype" : msys[2], "nstates" : msys[3], "msys" : msys,
+           "var" : np.array(var)}
+    return job
 
-        vix = 0 # start var indexing, we will jump by two for each a,b pair
-        for i in range(len(ET_BASIS_NUM_FCNS)):
-            for j in range(ET_BASIS_NUM_FCNS[i]):
-                expcoef = var[vix]*math.pow(var[vix+1],j) # j = n-1 = 0 .. n-1
-                input_file.write(str(ORBITAL_TYPE[i])+"   1   1.0\n")
-                input_file.write(" %.5f   1.0000D+00\n" % expcoef)
+#
+# data_config_matches: True if the P(x) values of the data files were
+# computed with the current configuration (see EVAL_CACHE_CONFIG). The
+# fingerprint of the configuration is written at the first call.
+#
+def data_config_matches():
+
+    if not os.path.isfile(EVAL_CACHE_CONFIG):
+        cfile = open(EVAL_CACHE_CONFIG, "w")
+        cfile.write(config_fingerprint()+"\n")
+        cfile.close()
+        return True
+
+    cfile = open(EVAL_CACHE_CONFIG, "r")
+    saved = cfile.read().strip()
+    cfile.close()
+    if (saved == config_fingerprint()):
+        return True
+    print("The configuration has changed since the data files were computed (see "+EVAL_CACHE_CONFIG+
+          "). Their P(x) values are not reused.")
+    return False
 
-            vix = vix + 2 # increment to next a,b pair
+#
+# deck_checksum: Checksum of the input deck of a molecule
+#
+def deck_checksum(molec):
+    dfile = open(molec+".input_deck", "rb")
+    checksum = "%08x" % zlib.crc32(dfile.read())
+    dfile.close()
+    return checksum
+
+#
+# evaluate_penalty_function: Compute the objective function and its
+# components for the parameters. Points already evaluated are taken from
+# the cache when EVAL_CACHE is set. A point whose stored P(x) is a partial
+# value (see EARLY_ABORT) is evaluated again without a cutoff.
+# Input:
+#  var       = parameters
+#  use_cache = look up the parameters in the cache before running QChem
+#  full      = run every system (no cutoff)
+# Output:
+#  val  = P(x)
+#  comp = dictionary of (unweighted) penalty function components
+#
+def evaluate_penalty_function(var, use_cache=True, full=False):
 
+    if (use_cache):
+        stored = cache_check(var)
+        if stored is not None:
+            return stored
 
-    input_file.write("****\n$end\n")        
-    input_file.close()
+    cutoff = None
+    if not (full or cache_censored(var)):
+        cutoff = get_penalty_cutoff()
+
+    # Compute QChem job with values and extract densities and states
+    if (PARALLEL == "n"):
+        systems = list(MOLEC_SYS)
+        if cutoff is not None:
+            nthreads = int(NTHREADS) if NTHREADS is not None else 1
+            systems.sort(key=lambda msys: predict_job_time(job_cost_model(msys[0]), nthreads))
+        censored = False
+        for i in range(len(systems)):
+            qchem_job(var, systems[i][0], systems[i][2], systems[i][3])
+            if (cutoff is not None and i < len(systems) - 1):
+                val, comp = penalty_function_from_files(var, systems[0:i+1])
+                if (val > cutoff):
+                    censored = True
+                    break
+        if not (censored):
+            val, comp = penalty_function_from_files(var)
+            record_fidelity_values(var)
+            record_component_values(var)
+    else:
+        val, comp, censored = qchem_pjobs([var], cutoff)[0]
+
+    if (censored):
+        save_censored_point(var, val, cutoff)
+    if (EVAL_CACHE):
+        cache_store(var, val, comp, censored)
+    journal_result(var, val, censored)
+
+    return val, comp
 
 #
-# create_pjob_shell_script: Create a shell script to execute jobs in
-# parallel
+# evaluate_penalty_fidelity: Compute a cheaper fidelity of P(x) for a batch
+# of parameters, and add the values to its training data
+# Input:
+#  batch_var = list of parameters
+#  level     = fidelity (index in FIDELITIES)
+# Output:
+#  batch_val = P(x) at this fidelity for each set of parameters
 #
-def create_pjob_shell_script(fname):
+def evaluate_penalty_fidelity(batch_var, level):
 
+    systems = FIDELITIES[level]["systems"]
+    print("Evaluating %d point(s) at fidelity %s" % (len(batch_var), FIDELITIES[level]["name"]))
+    batch_val = []
+    if (PARALLEL == "n"):
+        for var in batch_var:
+            for msys in systems:
+                qchem_job(var, msys[0], msys[2], msys[3])
+            batch_val.append(penalty_function_from_files(var, systems)[0])
+    else:
+        for result in qchem_pjobs(batch_var, None, systems):
+            batch_val.append(result[0])
 
-    shell_file = open(fname, "w")
+    append_fidelity_data(level, batch_var, batch_val)
+    for k in range(len(batch_var)):
+        print("  P(x) [%s] = %15.8f" % (FIDELITIES[level]["name"], batch_val[k]))
+    return batch_val
 
-    PCTHREADS = int(NTHREADS) // 2 # Only two jobs in parallel
-    
-    shell_file.write("#!/bin/bash\n")
-
-    # First system
-    mname = MOLEC_SYS[0][0]
-    shell_file.write("cd "+mname+"\n")
-    shell_file.write("qchem -nt "+str(NTHREADS)+" "+mname+".input > "+mname+".output\n")
-    shell_file.write("cd ../\n")
-
-    # Parallel systems
-    mname = MOLEC_SYS[1][0]
-    shell_file.write("cd "+mname+"\n")
-    shell_file.write("qchem -nt "+str(PCTHREADS)+" "+mname+".input > "+mname+".output &\n")
-    shell_file.write("cd ../\n")
-    mname = MOLEC_SYS[2][0]
-    shell_file.write("cd "+mname+"\n")
-    shell_file.write("qchem -nt "+str(PCTHREADS)+" "+mname+".input > "+mname+".output &\n")
-    shell_file.write("cd ../\n")
-
-    shell_file.write("wait\n")
-
-    # After jobs finish, extract density information and copy output files to parent directory
-    for i in range(len(MOLEC_SYS)):
-        mname = MOLEC_SYS[i][0]
-        cjtype= MOLEC_SYS[i][2]
-        shell_file.write("cd "+mname+"\n")
-
-        # Compute density and copy to parent directory
-        cdxz_prog = PROGRAM_HOME+"/bin/cubedata_into_training_data.x"
-        cdxz_cmdl = cdxz_prog+" den_p_0.cube "+str(cjtype)+" > "+mname+"_dens.data"    
-        shell_file.write(cdxz_cmdl+"\n")
-        shell_file.write("cp "+mname+"_dens.data ../\n")
-        
-        # Copy output file to parent directory
-        shell_file.write("cp "+mname+".output ../\n")
+#
+# evaluate_penalty_batch: Compute the objective function for a batch of
+# parameters. The QChem jobs of all points are run concurrently.
+# Input:
+#  batch_var = list of parameters
+# Output:
+#  batch_val = P(x) for each set of parameters
+#
+def evaluate_penalty_batch(batch_var):
 
-        # Leave directory, returning to parent directory
-        shell_file.write("cd ../\n")
-        
-    shell_file.close()
+    batch_val = [0.0] * len(batch_var)
+
+    todo = []
+    for k in range(len(batch_var)):
+        stored = cache_check(batch_var[k])
+        if stored is not None:
+            batch_val[k] = stored[0]
+        else:
+            todo.append(k)
+    if (len(todo) == 0):
+        return batch_val
+
+    # Run QChem for the points not yet evaluated. Points with a partial
+    # P(x) are run without a cutoff.
+    cutoff = get_penalty_cutoff()
+    todo_var = [batch_var[k] for k in todo]
+    todo_cutoff = [None if cache_censored(v) else cutoff for v in todo_var]
+    results = qchem_pjobs(todo_var, todo_cutoff)
+
+    for k in range(len(todo)):
+        val, comp, censored = results[k]
+        if (censored):
+            save_censored_point(todo_var[k], val, todo_cutoff[k])
+        if (EVAL_CACHE):
+            cache_store(todo_var[k], val, comp, censored)
+        journal_result(todo_var[k], val, censored)
+        batch_val[todo[k]] = val
+
+    return batch_val
 
-    # Make executable
-    command_line("chmod +x "+fname)
-    
 #
 # generate_initial_dataset: Generate an initial set of training
 # data. This will be properties from QChem jobs for different
@@ -399,7 +1413,7 @@ def create_pjob_shell_script(fname):
 def generate_initial_dataset(init_data_size, num_param, run):
     
     # See if training file exists, if it does return.
-    if os.path.isfile("training.dat"):
+    if (os.path.isfile("training.dat") or (TRAINING_STORE != "" and os.path.isfile(TRAINING_STORE))):
         print("Training data file found! Aborting...\n")
         return
 
@@ -421,41 +1435,25 @@ def generate_initial_dataset(init_data_size, num_param, run):
     print("\n")
     sys.stdout.flush()
 
-    rmse_val = []
-    for i in range(init_data_size):
-
-        if (run):
-            rmse_val.append(objective_function_value(var[i]))
-        else:
-            # save var[i] info
-            save_var_to_indexed_file(var[i], i)
-            for j in range(len(MOLEC_SYS)):
-                create_qchem_file(MOLEC_SYS[j][0], var[i])
-                command_line("cp "+MOLEC_SYS[j][0]+".input "+MOLEC_SYS[j][0]+".input."+str(i))
-        
-
-    # Place inputs in directories
-    if (MAKE_TRAINING_DIRS):
-        if not (run):
-            for i in range(init_data_size):
-                command_line("mkdir "+str(i))
-                command_line("mv "+"var."+str(i)+" "+str(i))
-                for j in range(len(MOLEC_SYS)):
-                    command_line("mkdir "+str(i)+"/"+MOLEC_SYS[j][0])
-                    command_line("mv "+MOLEC_SYS[j][0]+".input."+str(i)+" "+str(i)+"/"+MOLEC_SYS[j][0]+"/"+MOLEC_SYS[j][0]+".input")
-
-                    
-    # If all we require is inputs, leave
+    # If all we require is inputs, write them and leave
     if not (run):
+        write_training_inputs(var)
         return
+
+    # With FIDELITIES, only the first MF_INIT_TOP points are evaluated at
+    # full cost, the others at the cheapest fidelity.
+    ntop = init_data_size
+    if (len(FIDELITIES) > 0 and MF_INIT_TOP > 0):
+        ntop = min(MF_INIT_TOP, init_data_size)
+        check_fidelities()
+        evaluate_penalty_fidelity(var[ntop:].tolist(), 0)
+
+    rmse_val = []
+    for i in range(ntop):
+        rmse_val.append(objective_function_value(var[i]))
         
-    # Process and save data
-    training_data_file = open("training.dat", "w")
-    for i in range(init_data_size):
-        training_data_file.write(" %10.5f" % var[i][0])
-        training_data_file.write(" %10.5f" % var[i][1])
-        training_data_file.write(" %15.8f\n" % rmse_val[i])
-    training_data_file.close()
+    # Save data (with their components and censored flags in TRAINING_STORE)
+    append_training_data(var[0:ntop].tolist(), rmse_val)
 
             
 #
@@ -488,10 +1486,11 @@ def generate_testing_dataset(test_data_size, num_param):
     print("\n")
     sys.stdout.flush()
     
-    # Evaluate function at these points
+    # Evaluate function at these points. Every system is run, as a
+    # partial P(x) (see EARLY_ABORT) is not a test value.
     rmse_val = []
     for i in range(test_data_size):
-            rmse_val.append(objective_function_value(var[i]))
+            rmse_val.append(objective_function_value(var[i], full=True))
 
     # Process and save data
     testing_data_file = open("testing.dat", "w")
@@ -503,17 +1502,379 @@ def generate_testing_dataset(test_data_size, num_param):
     testing_data_file.close()
 
 #
-# gp_objfcn: Evaluate the GP objective function
+# fidelity_cost: Cost of a fidelity of P(x), from its "cost" entry or the
+# predicted QChem time of its systems
 # Input:
-#  gp = GP object
-#  X  = parameters
-def gp_objfcn(X, gp):
-    if (check_linind(X)):
-        y_pred = LININD_PFCNVAL
+#  level = index in FIDELITIES, len(FIDELITIES) for the full P(x)
+#
+def fidelity_cost(level):
+    if (level < len(FIDELITIES)):
+        if "cost" in FIDELITIES[level]:
+            return FIDELITIES[level]["cost"]
+        systems = FIDELITIES[level]["systems"]
+    else:
+        systems = MOLEC_SYS
+    nthreads = int(NTHREADS) if NTHREADS is not None else 1
+    return sum(predict_job_time(job_cost_model(msys[0]), nthreads) for msys in systems)
+
+#
+# fidelity_data_file: Training data file of a cheaper fidelity
+#
+def fidelity_data_file(level):
+    return "training."+FIDELITIES[level]["name"]+".dat"
+
+#
+# fidelity_name: Name of a fidelity ("full" for the full P(x))
+#
+def fidelity_name(level):
+    if (level < len(FIDELITIES)):
+        return FIDELITIES[level]["name"]
+    return "full"
+
+#
+# fit_gp_from_theta: Optimize the GP hyperparameters from one starting point
+# Input:
+#  args = (X, Y, kernel, theta). theta is the starting point (log of the
+#         hyperparameters).
+# Output:
+#  theta = optimized hyperparameters
+#  lml   = log marginal likelihood
+#
+def fit_gp_from_theta(args):
+    X, Y, kernel, theta = args
+    gp = GaussianProcessRegressor(kernel = kernel.clone_with_theta(theta), n_restarts_optimizer = 0,
+                                  normalize_y = True)
+    gp.fit(X, Y)
+    return gp.kernel_.theta, gp.log_marginal_likelihood_value_
+
+#
+# fit_gp_hyperparameters: Train a GP model, optimizing the hyperparameters
+# from several starting points. The first starts from theta0, the others
+# are drawn at random within the bounds of the kernel. Fits run in rounds of
+# GP_FIT_PROCS processes, until GP_RESTARTS restarts are done or
+# GP_RESTART_AGREE fits agree on the best optimum.
+# Input:
+#  X      = training points
+#  Y      = training values
+#  kernel = kernel
+#  theta0 = first starting point (None = hyperparameters of kernel)
+# Output:
+#  gp = trained GP model
+#
+def fit_gp_hyperparameters(X, Y, kernel, theta0=None):
+
+    bounds = kernel.bounds
+    if theta0 is None or len(theta0) != len(kernel.theta):
+        theta0 = kernel.theta
+    starts = [np.clip(theta0, bounds[:,0], bounds[:,1])]
+    for i in range(GP_RESTARTS):
+        starts.append(np.random.uniform(bounds[:,0], bounds[:,1]))
+
+    nproc = GP_FIT_PROCS
+    if (nproc <= 0):
+        nproc = os.cpu_count()
+    nproc = max(1, min(nproc, len(starts)))
+
+    results = []
+    pool = None
+    if (nproc > 1):
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = nproc)
+    while (len(results) < len(starts)):
+        batch = [(X, Y, kernel, theta) for theta in starts[len(results):len(results) + nproc]]
+        if pool is None:
+            results.extend(map(fit_gp_from_theta, batch))
+        else:
+            results.extend(pool.map(fit_gp_from_theta, batch))
+
+        best = max(r[1] for r in results)
+        nbest = sum(1 for r in results if r[1] >= best - GP_RESTART_TOL * max(1.0, abs(best)))
+        if (GP_RESTART_AGREE > 0 and nbest >= GP_RESTART_AGREE):
+            break
+    if pool is not None:
+        pool.shutdown()
+
+    theta = max(results, key=lambda r: r[1])[0]
+    print("Hyperparameter fits: %d of %d (best reached by %d)" % (len(results), len(starts), nbest))
+
+    gp = GaussianProcessRegressor(kernel = kernel.clone_with_theta(theta), optimizer = None, normalize_y = True)
+    gp.fit(X, Y)
+    return gp
+
+#
+# gp_data_fingerprint: Fingerprint of the data a GP model is trained on
+# Input:
+#  X = training points
+#  Y = training values
+#
+def gp_data_fingerprint(X, Y):
+    X = np.ascontiguousarray(X, dtype=float)
+    Y = np.ascontiguousarray(Y, dtype=float)
+    return "%s:%d:%08x" % (GP_BACKEND, X.shape[0], zlib.crc32(Y.tobytes(), zlib.crc32(X.tobytes())))
+
+#
+# gp_extend: Add training points to a GP model, keeping its hyperparameters.
+# The Cholesky factor is extended by the new rows, O(n^2 q) for q new points.
+# Input:
+#  gp = trained GP model
+#  X  = all training points. The first rows are the training points of gp.
+#  Y  = all training values
+# Output:
+#  gpn = new GP model, None if the first rows of X are not the training
+#        points of gp or the factor cannot be extended
+#
+def gp_extend(gp, X, Y):
+
+    X = np.atleast_2d(X)
+    n = gp.X_train_.shape[0]
+    if (X.shape[0] < n or not np.array_equal(X[0:n], gp.X_train_)):
+        return None
+
+    # Component model: split each new value into its components (see
+    # ComponentSumGP.split_values), and extend the model of each component
+    if isinstance(gp, component_gp.ComponentSumGP):
+        Xt = np.vstack((gp.X_terms_, X[n:]))
+        Yt = np.vstack((gp.Y_terms_, gp.split_values(X[n:], np.asarray(Y)[n:])))
+        models = []
+        for j in range(len(gp.models)):
+            model = gp_extend(gp.models[j], Xt, Yt[:,j])
+            if model is None:
+                return None
+            models.append(model)
+        return component_gp.ComponentSumGP(models, gp.names, gp.weights, np.copy(X), Xt, Yt)
+
+    # Multi-fidelity model: extend the model of the full P(x) with the
+    # differences from the scaled prediction of the cheaper fidelities
+    if isinstance(gp, multi_fidelity.AutoregressiveGP):
+        lower = gp.predict_level(X, len(gp.models) - 2)
+        top = gp_extend(gp.models[-1], X, np.asarray(Y) - gp.rhos[-1] * lower)
+        if top is None:
+            return None
+        return gp.with_top(top)
+
+    # Sparse model: refit to all points with the same inducing points, O(n m^2)
+    if isinstance(gp, sparse_gp.SparseGPRegressor):
+        return gp.with_data(X, Y)
+
+    # [[L, 0], [L21, L22]] is the factor of [[K11, K12], [K21, K22]]
+    Xa = X[n:]
+    K12 = gp.kernel_(gp.X_train_, Xa)
+    K22 = gp.kernel_(Xa)
+    K22[np.diag_indices_from(K22)] += gp.alpha
+    L21 = solve_triangular(gp.L_, K12, lower=True, check_finite=False).T
+    try:
+        L22 = cholesky(K22 - L21 @ L21.T, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        return None
+    L = np.block([[gp.L_, np.zeros((n, Xa.shape[0]))], [L21, L22]])
+
+    gpn = copy.copy(gp)
+    gpn.X_train_ = np.copy(X)
+    if (gp.normalize_y):
+        gpn._y_train_mean = np.mean(Y, axis=0)
+        gpn._y_train_std = np.std(Y, axis=0)
+        if (gpn._y_train_std == 0.0):
+            gpn._y_train_std = 1.0
+    gpn.y_train_ = (np.asarray(Y) - gpn._y_train_mean) / gpn._y_train_std
+    gpn.L_ = L
+    gpn.alpha_ = cho_solve((L, True), gpn.y_train_, check_finite=False)
+    return gpn
+
+#
+# gp_input: GP input of parameters (1/x with USE_XINV)
+#
+def gp_input(x):
+    if (USE_XINV):
+        return np.divide(1, x)
+    return np.asarray(x, dtype=float)
+
+#
+# gp_log_marginal_likelihood: Log marginal likelihood of a GP model at its
+# hyperparameters, from its Cholesky factor (the lower bound for a sparse
+# model, the sum over the models of a multi-fidelity or component model)
+# Input:
+#  gp = trained GP model
+#
+def gp_log_marginal_likelihood(gp):
+    if isinstance(gp, (multi_fidelity.AutoregressiveGP, component_gp.ComponentSumGP)):
+        return sum(gp_log_marginal_likelihood(model) for model in gp.models)
+    if isinstance(gp, sparse_gp.SparseGPRegressor):
+        return gp.log_marginal_likelihood_value_
+    n = gp.X_train_.shape[0]
+    return (-0.5 * np.dot(gp.y_train_, gp.alpha_) - np.sum(np.log(np.diag(gp.L_)))
+            - 0.5 * n * np.log(2.0 * np.pi))
+
+#
+# gp_objfcn: Evaluate the GP objective function (the acquisition function,
+# see acquisition_value)
+# Input:
+#  gp = GP object
+#  X  = parameters
+def gp_objfcn(X, gp):
+    if (check_linind(X)):
+        y_pred = LININD_PFCNVAL
     if (USE_XINV):
         Xinv = np.divide(1, X)
+    if (ACQUISITION == "mean"):
+        y_pred = gp.predict(np.atleast_2d(X))
+        return y_pred
     y_pred, sigma = gp.predict(np.atleast_2d(X), return_std=True)
-    return y_pred
+    return acquisition_value(y_pred, sigma)[0]
+
+#
+# gp_objfcn_grad: Evaluate the GP objective function and its gradient
+# Input:
+#  gp = GP object (with a kernel supported by gp_mean_gradient)
+#  X  = parameters
+# Output:
+#  acq  = acquisition function
+#  grad = gradient of the acquisition function
+#
+def gp_objfcn_grad(X, gp):
+    if (ACQUISITION == "mean"):
+        y_pred, grad = gp_mean_gradient(gp, X)
+        return y_pred[0], grad[0]
+    y_pred, grad, sigma, dsigma = gp_mean_gradient(gp, X, return_std=True)
+    acq, dmean, dstd = acquisition_value(y_pred, sigma, True)
+    return acq[0], dmean[0] * grad[0] + dstd[0] * dsigma[0]
+
+#
+# gp_search_objective: Objective function used to search a GP model, with
+# the analytic gradient when the kernel is supported by gp_mean_gradient
+# Input:
+#  gp = trained GP model
+# Output:
+#  fun = objective function
+#  jac = True if fun also returns the gradient, None otherwise
+#
+def gp_search_objective(gp):
+    if gp_mean_gradient(gp, np.zeros((1, gp.X_train_.shape[1]))) is None:
+        return gp_objfcn, None
+    return gp_objfcn_grad, True
+
+#
+# gp_mean_gradient: GP mean and its gradient at a set of points, from one
+# evaluation of the kernel between the points and the training points.
+# Supported kernels: C * RBF, C * Matern (nu = 0.5, 1.5, 2.5), C * RQ.
+# Input:
+#  gp         = trained GP model (exact, sparse, multi-fidelity or component)
+#  X          = points, one per row
+#  return_std = also return the standard deviation and its gradient
+# Output:
+#  y_mean = GP mean at each point
+#  grad   = gradient of the GP mean at each point, one per row
+#  sigma  = (return_std) GP standard deviation at each point
+#  dsigma = (return_std) gradient of the standard deviation, one per row
+#  None if the kernel is not supported
+#
+def gp_mean_gradient(gp, X, return_std=False):
+
+    # Component model: mean sum w_j m_j, variance sum w_j^2 s_j^2
+    if isinstance(gp, component_gp.ComponentSumGP):
+        parts = [gp_mean_gradient(model, X, return_std) for model in gp.models]
+        if any(part is None for part in parts):
+            return None
+        w = gp.weights
+        y_mean = sum(w[j] * parts[j][0] for j in range(len(parts)))
+        grad = sum(w[j] * parts[j][1] for j in range(len(parts)))
+        if not (return_std):
+            return y_mean, grad
+        sigma = np.sqrt(sum(w[j]**2 * parts[j][2]**2 for j in range(len(parts))))
+        dvar = sum(2.0 * w[j]**2 * parts[j][2][:, np.newaxis] * parts[j][3] for j in range(len(parts)))
+        return y_mean, grad, sigma, dvar / (2.0 * np.where(sigma > 0.0, sigma, np.inf))[:, np.newaxis]
+
+    # Multi-fidelity model: mean rho m_(l-1) + m_l, variance
+    # rho^2 s_(l-1)^2 + s_l^2
+    if isinstance(gp, multi_fidelity.AutoregressiveGP):
+        parts = [gp_mean_gradient(model, X, return_std) for model in gp.models]
+        if any(part is None for part in parts):
+            return None
+        y_mean, grad = parts[0][0], parts[0][1]
+        if (return_std):
+            var, dvar = parts[0][2]**2, 2.0 * parts[0][2][:, np.newaxis] * parts[0][3]
+        for l in range(1, len(parts)):
+            rho = gp.rhos[l - 1]
+            y_mean = rho * y_mean + parts[l][0]
+            grad = rho * grad + parts[l][1]
+            if (return_std):
+                var = rho**2 * var + parts[l][2]**2
+                dvar = rho**2 * dvar + 2.0 * parts[l][2][:, np.newaxis] * parts[l][3]
+        if not (return_std):
+            return y_mean, grad
+        sigma = np.sqrt(var)
+        return y_mean, grad, sigma, dvar / (2.0 * np.where(sigma > 0.0, sigma, np.inf))[:, np.newaxis]
+
+    kernel = gp.kernel_
+    if not (isinstance(kernel, Product) and isinstance(kernel.k1, C)):
+        return None
+    c = kernel.k1.constant_value
+    base = kernel.k2
+
+    # Mean = k(X, P) w (normalized)
+    sparse = isinstance(gp, sparse_gp.SparseGPRegressor)
+    if (sparse):
+        P = gp.Z_
+    else:
+        P = gp.X_train_
+    w = gp.alpha_
+
+    X = np.atleast_2d(X)
+    D = X[:, np.newaxis, :] - P[np.newaxis, :, :]
+    if isinstance(base, Matern):
+        ls = base.length_scale
+        r = np.sqrt(np.sum((D / ls)**2, axis=2))
+        if (base.nu == 0.5):
+            K = c * np.exp(-r)
+            dK = -K / np.where(r > 0.0, r, np.inf)
+        elif (base.nu == 1.5):
+            K = c * (1.0 + np.sqrt(3.0) * r) * np.exp(-np.sqrt(3.0) * r)
+            dK = -3.0 * c * np.exp(-np.sqrt(3.0) * r)
+        elif (base.nu == 2.5):
+            K = c * (1.0 + np.sqrt(5.0) * r + 5.0 / 3.0 * r**2) * np.exp(-np.sqrt(5.0) * r)
+            dK = -5.0 / 3.0 * c * (1.0 + np.sqrt(5.0) * r) * np.exp(-np.sqrt(5.0) * r)
+        else:
+            return None
+    elif isinstance(base, RBF):
+        ls = base.length_scale
+        r2 = np.sum((D / ls)**2, axis=2)
+        K = c * np.exp(-0.5 * r2)
+        dK = -K
+    elif isinstance(base, RQ):
+        ls = base.length_scale
+        b = 1.0 + np.sum(D**2, axis=2) / (2.0 * base.alpha * ls**2)
+        K = c * b**(-base.alpha)
+        dK = -c * b**(-base.alpha - 1.0)
+    else:
+        return None
+
+    # dk(x, p)/dx = dK * (x - p) / l^2
+    dKdx = dK[:, :, np.newaxis] * D / np.asarray(ls)**2
+    y_mean = gp._y_train_std * (K @ w) + gp._y_train_mean
+    grad = gp._y_train_std * np.einsum("mnd,n->md", dKdx, w)
+    if not (return_std):
+        return y_mean, grad
+
+    # Variance = c - k^T M k, with M = K^-1 (exact) or
+    # Kuu^-1 - Luu^-T B^-1 Luu^-1 (sparse). Its gradient is -2 (M k)^T dk/dx.
+    if (sparse):
+        t1 = solve_triangular(gp.Luu_, K.T, lower=True, check_finite=False)
+        t2 = solve_triangular(gp.LB_, t1, lower=True, check_finite=False)
+        Mk = solve_triangular(gp.Luu_.T, t1 - solve_triangular(gp.LB_.T, t2, lower=False, check_finite=False),
+                              lower=False, check_finite=False)
+    else:
+        Mk = cho_solve((gp.L_, True), K.T, check_finite=False)
+    var = np.maximum(c - np.sum(K.T * Mk, axis=0), 0.0)
+    dvar = -2.0 * np.einsum("mnd,nm->md", dKdx, Mk)
+    sigma = np.sqrt(var)
+    dsigma = dvar / (2.0 * np.where(sigma > 0.0, sigma, np.inf))[:, np.newaxis]
+    return y_mean, grad, gp._y_train_std * sigma, gp._y_train_std * dsigma
+
+#
+# gp_output: Parameters of a GP input (inverse of gp_input)
+#
+def gp_output(u):
+    if (USE_XINV):
+        return np.divide(1, u)
+    return np.asarray(u, dtype=float)
 
 #
 # gp_prediction: Return prediction from GP
@@ -524,46 +1885,261 @@ def gp_prediction(gp, X):
     y_pred, sigma = gp.predict(np.atleast_2d(X), return_std=True)
     return y_pred, sigma
 
+#
+# impute_censored_values: Replace the partial P(x) of censored training
+# points (see EARLY_ABORT), which are lower bounds, by max(partial P(x),
+# GP mean), with the GP model trained on the other points.
+# Input:
+#  X      = training points
+#  Y      = P(x) of the training points (scaled)
+#  kernel = kernel
+# Output:
+#  Y = P(x) with the censored values replaced
+#
+def impute_censored_values(X, Y, kernel):
+
+    censored = np.array([cache_censored(x) for x in X], dtype=bool)
+    if (np.sum(censored) == 0 or np.sum(censored) == len(Y)):
+        return Y
+
+    theta0 = None
+    if os.path.isfile("coeff.dat"):
+        theta0 = np.atleast_1d(np.loadtxt("coeff.dat"))
+    U = gp_input(X)
+    if (GP_BACKEND == "sparse"):
+        gp = sparse_gp.SparseGPRegressor(kernel, n_inducing = SPARSE_GP_INDUCING, chunk_size = SPARSE_GP_CHUNK,
+                                           n_restarts = GP_RESTARTS)
+        gp.fit(U[~censored], Y[~censored], theta0)
+    else:
+        gp = fit_gp_hyperparameters(U[~censored], Y[~censored], kernel, theta0)
+    y_mean = gp.predict(U[censored])
+
+    Y = np.array(Y, dtype=float)
+    nraised = np.sum(y_mean > Y[censored])
+    Y[censored] = np.maximum(Y[censored], y_mean)
+    print("Censored points: %d of %d partial P(x) values raised to the GP mean" % (nraised, np.sum(censored)))
+    return Y
+
+#
+# job_cost_model: Model of the QChem wall time of a system,
+#  t(n) = a + b / n  (n = number of threads)
+# fit to the times in JOB_TIMING. With times at a single thread count,
+# a fraction PJOB_SERIAL_FRACTION of the time is assumed not to scale.
+# Systems without times are assumed to cost the same as the average system.
+# Input:
+#  molec = molecule
+# Output:
+#  (a, b) = model parameters (seconds)
+#
+def job_cost_model(molec):
+
+    load_job_timing()
+    f = PJOB_SERIAL_FRACTION
+
+    if molec not in JOB_TIMING:
+        # Average single thread time of the timed systems
+        t1 = []
+        for m in JOB_TIMING:
+            a, b = job_cost_model(m)
+            t1.append(a + b)
+        if (len(t1) == 0):
+            t1 = [1.0]
+        return f * np.mean(t1), (1.0 - f) * np.mean(t1)
+
+    n = np.array([x[0] for x in JOB_TIMING[molec]], dtype=float)
+    t = np.array([x[1] for x in JOB_TIMING[molec]])
+
+    if (len(np.unique(n)) > 1):
+        # Least squares fit of t = a + b / n
+        A = np.column_stack((np.ones(len(n)), 1.0 / n))
+        a, b = np.linalg.lstsq(A, t, rcond=None)[0]
+        if (a >= 0.0 and b > 0.0):
+            return a, b
+
+    # Single thread count (or unphysical fit)
+    t1 = np.mean(t / (f + (1.0 - f) / n))
+    return f * t1, (1.0 - f) * t1
+
+#
+# journal_commit: Record that results were added to the training data, and
+# compact RUN_JOURNAL. The proposals of the earlier iterations and the
+# results of the training points are dropped; the last state of each work
+# directory and the results of other points (testing points, for example)
+# of the current configuration are kept.
+#
+def journal_commit():
+    if (RUN_JOURNAL == ""):
+        return
+    load_run_journal()
+    JOURNAL["proposal"] = None
+
+    train = set(cache_key(x) for x in read_training_data()[0])
+    events = []
+    for key in JOURNAL["jobs"]:
+        events.append(["job", JOURNAL["jobs"][key][0], key[0], key[1], JOURNAL["jobs"][key][1]] +
+                      JOURNAL["jobs"][key][2])
+    for words in run_journal.read_events(RUN_JOURNAL):
+        if (words[0] != "result" or len(words) != NUM_PARAM + 4 or words[3] != config_fingerprint()):
+            continue
+        try:
+            if cache_key(np.array(words[4:], dtype=float)) in train:
+                continue
+        except ValueError:
+            continue
+        events.append(words)
+    events.append(["append", training_fingerprint()])
+    run_journal.rewrite_events(RUN_JOURNAL, events)
+
+#
+# journal_event: Add an event to RUN_JOURNAL
+# Input:
+#  words = event, as a list of strings
+#
+def journal_event(words):
+    if (RUN_JOURNAL == ""):
+        return
+    run_journal.append_event(RUN_JOURNAL, words)
+
+#
+# journal_job: Record the state of a QChem job
+# Input:
+#  state = start, done or failed
+#  molec = molecule
+#  wdir  = work directory of the job
+#  var   = parameters of the job
+#
+def journal_job(state, molec, wdir, var):
+    if (RUN_JOURNAL == ""):
+        return
+    load_run_journal()
+    key = (os.path.normpath(wdir), molec)
+    JOURNAL["jobs"][key] = (state, deck_checksum(molec), journal_words(var))
+    journal_event(["job", state, key[0], molec, JOURNAL["jobs"][key][1]] + JOURNAL["jobs"][key][2])
+
+#
+# journal_job_done: True if the last QChem job of the work directory was run
+# for these parameters and input deck, and terminated normally
+# Input:
+#  molec = molecule
+#  wdir  = work directory of the job
+#  var   = parameters
+#
+def journal_job_done(molec, wdir, var):
+    if (RUN_JOURNAL == ""):
+        return False
+    load_run_journal()
+    key = (os.path.normpath(wdir), molec)
+    if key not in JOURNAL["jobs"]:
+        return False
+    state, checksum, words = JOURNAL["jobs"][key]
+    if (state != "done" or checksum != deck_checksum(molec) or words != journal_words(var)):
+        return False
+    qout = qchem_output.parse_qchem_output(wdir+"/"+molec+".output")
+    return (qout["normal_termination"] and not qout["error"])
+
+#
+# journal_job_end: Record the end of a QChem job (done or failed, from its
+# output)
+# Input:
+#  molec = molecule
+#  wdir  = work directory of the job
+#  var   = parameters of the job
+#
+def journal_job_end(molec, wdir, var):
+    qout = qchem_output.parse_qchem_output(wdir+"/"+molec+".output")
+    if (qout["normal_termination"] and not qout["error"]):
+        journal_job("done", molec, wdir, var)
+    else:
+        journal_job("failed", molec, wdir, var)
+
+#
+# journal_pending_proposal: Points proposed in an iteration that did not
+# add its results to training.dat, if training.dat has not changed since.
+# A proposal is returned once.
+# Output:
+#  proposal = dictionary with "var" (GP minimum), "gp" (predicted P(x)) and
+#             "batch" (list of (parameters, predicted P(x))), or None
+#
+def journal_pending_proposal():
+    if (RUN_JOURNAL == ""):
+        return None
+    load_run_journal()
+    proposal = JOURNAL["proposal"]
+    JOURNAL["proposal"] = None
+    if proposal is None:
+        return None
+    if (proposal["train"] != training_fingerprint() or len(proposal["batch"]) != proposal["nbatch"]):
+        return None
+    return proposal
+
+#
+# journal_proposal: Record the points proposed in an iteration
+# Input:
+#  var       = GP minimum
+#  gpmin     = predicted P(x) at the minimum
+#  batch_var = batch points (empty without batches)
+#  batch_gp  = predicted P(x) of the batch points
+#
+def journal_proposal(var, gpmin, batch_var, batch_gp):
+    journal_event(["iter", training_fingerprint(), "%.8f" % gpmin, str(len(batch_var))] + journal_words(var))
+    for k in range(len(batch_var)):
+        journal_event(["point", "%.8f" % batch_gp[k]] + journal_words(batch_var[k]))
+
+#
+# journal_result: Record a computed P(x)
+# Input:
+#  var      = parameters
+#  val      = P(x)
+#  censored = P(x) is a partial value (see EARLY_ABORT)
+#
+def journal_result(var, val, censored):
+    journal_event(["result", "%.8f" % val, "1" if censored else "0", config_fingerprint()] + journal_words(var))
+
+#
+# journal_words: Parameters as journal words
+#
+def journal_words(var):
+    return ["%.5f" % v for v in var]
+
 #
 # kernel_user: User selects kernel
 #
 def kernel_user():
-    k_ = ['mat','rbf','rq']
-    kt_ = ['Matern kernel', 'Radial-basis function kernel', 'Rational Quadratic kernel']
+    k_ = ['mat','rbf','rq','auto']
+    kt_ = ['Matern kernel', 'Radial-basis function kernel', 'Rational Quadratic kernel', 'Automatic selection']
     print ('Select kernel type')
     print ('Select kernel type')
     print ('For Mattern function, enter 0')
     print ('For Radial-basis function kernel, enter 1')
     print ('For Rational Quadratic kernel, enter 2')
+    print ('For automatic selection, enter 3')
     var = MLKERNEL
     i = int(var)
     ks = k_[i]
     print ('You selected --->', i, kt_[i])
     return ks
 
-    
 #
-# objective_function_value: Compute the objective function for the parameters
+# mf_scale: Scale rho of a fidelity, by least squares fit of its values
+# to rho times the prediction of the cheaper fidelities (1 if the
+# prediction is constant)
+# Input:
+#  lower = prediction of the cheaper fidelities
+#  Y     = values
 #
-def objective_function_value(var):
-
-    # Compute QChem job with values and extract densities and states
-    if (PARALLEL == "n"):
-        for i in range(len(MOLEC_SYS)):
-            qchem_job(var, MOLEC_SYS[i][0], MOLEC_SYS[i][2], MOLEC_SYS[i][3])
-    else:
-        qchem_pjobs(var)
-    
-    wt = PENFCN_WEIGHTS
-    
-    val = 0.0
-    if (wt["density"] > 0.0):
-        val = val + wt["density"] * objective_function_value_density(var)
+def mf_scale(lower, Y):
+    dl = lower - np.mean(lower)
+    if (np.dot(dl, dl) == 0.0):
+        return 1.0
+    return np.dot(dl, Y - np.mean(Y)) / np.dot(dl, dl)
 
-    val = val + wt["excited states"] * objective_function_value_excited_states(var)
-    val = val + wt["ground state"] * objective_function_value_groundstate(var)
-    val = val + wt["states"] * objective_function_value_all_states(var)
     
+#
+# objective_function_value: Compute the objective function for the parameters
+# (with full, every system is run; see evaluate_penalty_function)
+#
+def objective_function_value(var, full=False):
+    val, comp = evaluate_penalty_function(var, full=full)
     return val
 
 #
@@ -574,23 +2150,26 @@ def objective_function_value(var):
 # FGH energies.
 #
 # Input:
-#  var = parameters
+#  var     = parameters
+#  systems = molecular systems (default MOLEC_SYS)
 # Output:
 #  RMSE for all states
 #
-def objective_function_value_all_states(var):
+def objective_function_value_all_states(var, systems=None):
 
     if (PENFCN_WEIGHTS["states"] == 0.0):
         val = 0.0
         return val
 
+    if systems is None:
+        systems = MOLEC_SYS
     
     # Compute RMSE value for each system
     rmse = []
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         # Name of system and number of states.
-        name = MOLEC_SYS[i][0]
-        nsts = MOLEC_SYS[i][3]
+        name = systems[i][0]
+        nsts = systems[i][3]
         
         # Read in excited states. Arrive converted in au
         states = get_all_states_from_file(name+"_states.data", nsts)
@@ -619,7 +2198,7 @@ def objective_function_value_all_states(var):
         
     # Sum errors
     rmse_val = 0.0
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         rmse_val = rmse_val + rmse[i]
 
     return rmse_val
@@ -629,34 +2208,38 @@ def objective_function_value_all_states(var):
 # objective_function_value_density: Compute the density component of the objective
 # function for the parameters.
 #
-# Info: This objective function calls program to compute RMSE between
-# QChem and FGH densities.
+# Info: This objective function computes the RMSE between QChem and FGH
+# densities. Benchmark densities are read once per system.
 #
 # Input:
-#  var    = parameters
+#  var     = parameters
+#  systems = molecular systems (default MOLEC_SYS)
 # Output:
 #  val = f(x,y,...,z)
-def objective_function_value_density(var):
+def objective_function_value_density(var, systems=None):
 
     if (PENFCN_WEIGHTS["density"] == 0.0):
         val = 0.0
         return val
+
+    if systems is None:
+        systems = MOLEC_SYS
     
     # Compute RMSE value for each system
-    rmse_prog = PROGRAM_HOME+"/bin/compute_rmse_density.x"
     rmse = []
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         # Name of system and number of points. Stored as local variables for convenience
-        name = MOLEC_SYS[i][0]
-        npts = MOLEC_SYS[i][1]
+        name = systems[i][0]
+        npts = systems[i][1]
 
-        if (MOLEC_SYS[i][2] == 4):
-            rmse_prog = PROGRAM_HOME+"/bin/compute_rmse_density_3D.x"
+        # Density from the last QChem job, or from file if there is none
+        if name in DENS_DATA:
+            dens = DENS_DATA[name][0:npts,-1]
+        else:
+            dens = density_rmse.read_density_file(name+"_dens.data", npts)
 
-        command_line(rmse_prog+" "+name+"_dens.data "+name+"_dens.benchmark.data "+str(npts)+" > "+name+".rmse")
-        rmse_file = open(name+".rmse", "r")
-        rmse.append(float(rmse_file.read()))
-        rmse_file.close()
+        ref, wts = density_rmse.get_benchmark(name+"_dens.benchmark.data", npts, DENS_TANH_WEIGHTS)
+        rmse.append(density_rmse.compute_rms_error(dens, ref, wts))
 
     # Compute RMSE value
     val = 0.0
@@ -673,23 +2256,26 @@ def objective_function_value_density(var):
 # FGH energies.
 #
 # Input:
-#  var  = parameters
+#  var     = parameters
+#  systems = molecular systems (default MOLEC_SYS)
 # output:
 #  RMSE for excited states
 #
-def objective_function_value_excited_states(var):
+def objective_function_value_excited_states(var, systems=None):
 
     if (PENFCN_WEIGHTS["excited states"] == 0.0):
         val = 0.0
         return val
 
+    if systems is None:
+        systems = MOLEC_SYS
     
     # Compute RMSE value for each system
     rmse = []
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         # Name of system and number of states.
-        name = MOLEC_SYS[i][0]
-        nsts = MOLEC_SYS[i][3]
+        name = systems[i][0]
+        nsts = systems[i][3]
         nxst = nsts - 1
 
         if (nxst == 0):
@@ -729,22 +2315,25 @@ def objective_function_value_excited_states(var):
 # objective_function_value_groundstate: Compute the RMSE for the ground state 
 # energy.
 # Input:
-#  var = parameter values
+#  var     = parameter values
+#  systems = molecular systems (default MOLEC_SYS)
 # Output:
 #  RMSE for zero point energy
 #
-def objective_function_value_groundstate(var):
+def objective_function_value_groundstate(var, systems=None):
 
     if (PENFCN_WEIGHTS["ground state"] == 0.0):
         val = 0.0
         return val
 
+    if systems is None:
+        systems = MOLEC_SYS
     
     rmse = []
     # Compute RMSE value fo each system
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         # Name of system
-        name = MOLEC_SYS[i][0]
+        name = systems[i][0]
         # Read in ground states. Arrive in au
         e0_qch = get_ground_state_from_file(name+"_states.data")
 
@@ -762,11 +2351,100 @@ def objective_function_value_groundstate(var):
         
     # Sum errors
     rmse_val = 0.0
-    for i in range(len(MOLEC_SYS)):
+    for i in range(len(systems)):
         rmse_val = rmse_val + rmse[i]
 
     return rmse_val
 
+#
+# penalty_function_from_files: Compute the objective function and its
+# components from the data files of the last QChem jobs.
+# Input:
+#  var     = parameters
+#  systems = molecular systems to include (default MOLEC_SYS)
+# Output:
+#  val  = P(x)
+#  comp = dictionary of (unweighted) penalty function components
+#
+def penalty_function_from_files(var, systems=None):
+
+    wt = PENFCN_WEIGHTS
+
+    comp = {}
+    if (wt["density"] > 0.0):
+        comp["density"] = objective_function_value_density(var, systems)
+    comp["excited states"] = objective_function_value_excited_states(var, systems)
+    comp["ground state"] = objective_function_value_groundstate(var, systems)
+    comp["states"] = objective_function_value_all_states(var, systems)
+
+    val = 0.0
+    for name in comp:
+        val = val + wt[name] * comp[name]
+
+    return val, comp
+
+#
+# predict_job_time: Predicted QChem wall time from job_cost_model
+# Input:
+#  model    = (a, b) from job_cost_model
+#  nthreads = number of threads
+#
+def predict_job_time(model, nthreads):
+    return model[0] + model[1] / nthreads
+
+#
+# predict_gp_model: Predict P(x) at the points of PREDICT_FILE with the GP
+# model in GP_MODEL_FILE, and write them to PREDICT_OUTPUT
+#
+def predict_gp_model():
+
+    if not os.path.isfile(PREDICT_FILE):
+        print("ERROR: Missing prediction points file "+PREDICT_FILE+"!\n")
+        sys.exit("Error message")
+    gp = None
+    source = GP_MODEL_FILE
+    if (SURROGATE == "components"):
+        # The models of the components are refit from COMPONENT_FILE
+        Xt, Yt = read_training_data()
+        if (USE_XINV):
+            Xt = np.divide(1, Xt)
+        gp = train_component_model(np.atleast_2d(Xt), np.multiply(Yt, YSCALE), build_kernel())
+        source = COMPONENT_FILE
+    if gp is None:
+        state = load_gp_model(build_kernel())
+        if state is None:
+            print("ERROR: No GP model in "+GP_MODEL_FILE+" for this kernel and GP_BACKEND!\n")
+            sys.exit("Error message")
+        gp = state["gp"]
+        source = GP_MODEL_FILE
+
+    if (len(FIDELITIES) > 0 and source == GP_MODEL_FILE):
+        # The saved model is that of the difference from the cheaper
+        # fidelities, which are refit from their data
+        Xt, Yt = read_training_data()
+        if (USE_XINV):
+            Xt = np.divide(1, Xt)
+        gp = train_mf_model(np.atleast_2d(Xt), np.multiply(Yt, YSCALE), build_kernel())
+
+    X = np.atleast_2d(np.loadtxt(PREDICT_FILE, usecols=range(NUM_PARAM)))
+    if (USE_XINV):
+        y_pred, sigma = gp_prediction(gp, np.divide(1, X))
+    else:
+        y_pred, sigma = gp_prediction(gp, X)
+    np.savetxt(PREDICT_OUTPUT, np.column_stack((X, y_pred, sigma)), fmt="%15.8f")
+    print("Predicted %d points with the GP model in %s (%d training points)" %
+          (X.shape[0], source, gp.X_train_.shape[0]))
+
+#
+# print_cache_stats: Print the number of P(x) cache hits and misses.
+#
+def print_cache_stats():
+    if not (EVAL_CACHE):
+        return
+    print("P(x) cache: %d hits, %d misses, %d points stored (%d censored)" %
+          (PENFCN_CACHE["hits"], PENFCN_CACHE["misses"], len(PENFCN_CACHE["X"]),
+           len(PENFCN_CACHE["censored"])))
+
 #
 # process_qchem_job: Create data from output of qchem job
 # for evaluation of penalty function
@@ -781,37 +2459,13 @@ def process_qchem_job(molec, wt, cjobtype, nstates):
     # should be created.
     if (wt["density"] > 0.0):
         if (os.path.exists("./nbox_data.txt") and os.path.exists("./nbox_npts.txt")):
-            cdxz_prog = PROGRAM_HOME+"/bin/cubedata_into_training_data.x"
-            command_line(cdxz_prog+" den_p_0.cube "+str(cjobtype)+" > "+molec+"_dens.data")
+            save_density_data(molec, cjobtype)
         else:
             print("Missing nbox files. Aborting!\n")
             sys.exit(1)
 
     if (wt["excited states"] > 0.0 or wt["ground state"] > 0.0 or wt["states"] > 0.0):
-        qfile = open(molec+".output","r")
-        qf_lines = (qfile.read().splitlines())
-        qfile.close()
-        nlines = len(qf_lines)
-        estart_line = 0
-        for i in range(nlines):
-            # Loop through qchem output file to find the Final CI Energy
-            if "==== Final CI Energy ====" in str(qf_lines[i]):
-                estart_line = i
-                break
-        estart_line = estart_line + 1 # Adjust for first entry
-        # Now read data for each state
-        energy = []
-        for i in range(nstates):
-            e_line = qf_lines[estart_line + i]
-            e_line = e_line.replace(" CI Energy (au) Root #   "+str(i),"").strip()
-            energy.append(e_line)
-
-        efile = open(molec+"_states.data", "w")
-        for i in range(nstates):
-            efile.write("%s\n" % energy[i])
-        efile.close()
-
-    
+        save_states_data(molec, nstates)
 
 #
 # get_all_states_from_file: Get state energies from
@@ -935,239 +2589,1006 @@ def get_ground_state_from_file(flname):
     return e0
 
 #
-# get_param_bounds: Get lower and upper bounds for each parameter.
+# load_guess_store: Read the index of stored guesses
 #
-def get_param_bounds():
-    return PBOUNDS
+def load_guess_store():
+
+    global GUESS_STORE
+    if GUESS_STORE is not None:
+        return
+
+    GUESS_STORE = {}
+    flname = GUESS_STORE_DIR+"/index.dat"
+    if not os.path.isfile(flname):
+        return
+    gfile = open(flname, "r")
+    for line in gfile:
+        words = line.split()
+        if (len(words) > 2 and os.path.isdir(GUESS_STORE_DIR+"/"+words[0]+"/"+words[1])):
+            GUESS_STORE.setdefault(words[0], []).append((int(words[1]), np.array(words[2:], dtype=float)))
+    gfile.close()
 
 #
-# qchem_job: Compute a QChem job with basis set parameters given by
-# input. 
-#
-# This function also handles processing file for density / excited states
-#
+# load_gp_model: Read the GP model saved by save_gp_model
 # Input:
-#  var = basis set parameters
-#  molec = moelcule to run Qchem for
-#  cjobtype = cubedata_into*x jobetype (1=x, 2=x+z, 3=xyz)
+#  kernel = kernel (initial hyperparameters). The model is only read if it
+#           was trained with the same kernel and GP_BACKEND.
+# Output:
+#  state = GP_STATE of the saved model, None if there is none
 #
-def qchem_job(var, molec, cjobtype, nstates):
-    # Create the input file and run QChem. Then extract the
-    # density information, and print to file '*_dens.data'
-    # After this, get energy information and save it to '*_states.data'
-    create_qchem_file(molec, var)
-    create_nbox_files(molec)
-
-    command_line("qchem -nt "+str(NTHREADS)+" "+molec+".input > "+molec+".output")
-    cdxz_prog = PROGRAM_HOME+"/bin/cubedata_into_training_data.x"
-    command_line(cdxz_prog+" den_p_0.cube "+str(cjobtype)+" > "+molec+"_dens.data")    
+def load_gp_model(kernel):
+
+    if not os.path.isfile(GP_MODEL_FILE):
+        return None
+    try:
+        data = np.load(GP_MODEL_FILE, allow_pickle=False)
+    except (OSError, ValueError):
+        print("Cannot read "+GP_MODEL_FILE)
+        return None
+    if (int(data["version"]) != GP_MODEL_VERSION or str(data["backend"]) != GP_BACKEND
+        or str(data["kernel"]) != str(kernel)):
+        return None
+
+    if (GP_BACKEND == "sparse"):
+        gp = sparse_gp.SparseGPRegressor(kernel, n_inducing = SPARSE_GP_INDUCING, chunk_size = SPARSE_GP_CHUNK)
+    else:
+        gp = GaussianProcessRegressor(kernel = kernel, optimizer = None, normalize_y = True)
+    gp.kernel_ = kernel.clone_with_theta(data["theta"])
+    for attr in GP_MODEL_ATTRS[GP_BACKEND]:
+        value = data[attr]
+        if (value.ndim == 0):
+            value = float(value)
+        setattr(gp, attr, value)
+    gp.n_features_in_ = gp.X_train_.shape[1]
+
+    return {"gp" : gp, "kernel" : str(kernel), "iters" : int(data["iters"]), "nfit" : int(data["nfit"]),
+            "lml" : float(data["lml"]), "fingerprint" : str(data["fingerprint"]), "saved" : True}
 
+#
+# load_job_timing: Read measured QChem wall times from PJOB_TIMING_FILE
+# (once per run).
+#
+def load_job_timing():
 
-    qfile = open(molec+".output", "r")
-    qf_lines = (qfile.read().splitlines())
-    qfile.close()
-    nlines = len(qf_lines)
-    estart_line = 0
-    for i in range(nlines):
-        # Loop through qchem output file to find the Final CI Energy
-        if "==== Final CI Energy ====" in str(qf_lines[i]):
-            estart_line = i
-            break
-    estart_line = estart_line + 1 # Adjust for first entry
-    # Now read data for each state
-    energy = []
-    for i in range(nstates):
-        e_line = qf_lines[estart_line + i]
-        e_line = e_line.replace(" CI Energy (au) Root #   "+str(i),"").strip()
-        energy.append(e_line)
-
-    efile = open(molec+"_states.data", "w")
-    for i in range(nstates):
-        efile.write("%s\n" % energy[i])
-    efile.close()
+    global JOB_TIMING
+    if JOB_TIMING is not None:
+        return
 
-    # Save logs
-    command_line("cat "+molec+".output >> qc."+molec+".log")
+    JOB_TIMING = {}
+    if not os.path.isfile(PJOB_TIMING_FILE):
+        return
+    tfile = open(PJOB_TIMING_FILE, "r")
+    for line in tfile:
+        words = line.split()
+        if (len(words) == 3):
+            JOB_TIMING.setdefault(words[0], []).append((int(words[1]), float(words[2])))
+    tfile.close()
 
 #
-# qchem_pjobs: Run QChem jobs in parallel (for last two systems)
-#
+# load_penfcn_cache: Store the P(x) values of a data file in the cache.
 # Input:
-#  var = basis set parameters
+#  flname   = data file (parameters followed by P(x) on each line)
+#  censored = the values are partial (CENSORED_FILE). Points stored with
+#             another value were evaluated again in full, and are kept.
 #
-def qchem_pjobs(var):
-
-    # Create shell script
-    fname = "pjob_submit.sh"
-    create_pjob_shell_script(fname)
+def load_penfcn_cache(flname, censored=False):
 
-    # Create directories for each molecular system
-    for i in range(len(MOLEC_SYS)):
-        create_qchem_file(MOLEC_SYS[i][0], var)
-        create_nbox_files(MOLEC_SYS[i][0])
-
-        # Copy files into directory
-        command_line("mkdir -p "+MOLEC_SYS[i][0])
-        command_line("cp "+MOLEC_SYS[i][0]+".input "+MOLEC_SYS[i][0]+"/")
-        command_line("cp nbox_*.txt "+MOLEC_SYS[i][0]+"/")
+    if not (EVAL_CACHE and os.path.isfile(flname)):
+        return
 
-    # Execute pjob shell script
-    command_line("./pjob_submit.sh")
+    data = np.atleast_2d(np.loadtxt(flname, usecols=range(NUM_PARAM + 1)))
+    for i in range(data.shape[0]):
+        if (censored):
+            stored = cache_lookup(data[i,0:NUM_PARAM])
+            if (stored is not None and abs(stored[0] - data[i,NUM_PARAM]) > 1.0e-6):
+                continue
+        cache_store(data[i,0:NUM_PARAM], data[i,NUM_PARAM], None, censored)
 
-    # Get data from each molecule
-    for i in range(len(MOLEC_SYS)):
-        molec = MOLEC_SYS[i][0]
-        qfile = open(molec+".output", "r")
-        qf_lines = (qfile.read().splitlines())
-        qfile.close()
-        nlines = len(qf_lines)
-        estart_line = 0
-        for j in range(nlines):
-            # Loop through qchem output file to find the Final CI Energy
-            if "==== Final CI Energy ====" in str(qf_lines[j]):
-                estart_line = j
-                break
 
-        estart_line = estart_line + 1 # Adjust for first entry
-        # Now read data for each state
-        energy = []
-        nstates = MOLEC_SYS[i][3]
-        for j in range(nstates):
-            e_line = qf_lines[estart_line + j]
-            e_line = e_line.replace(" CI Energy (au) Root #   "+str(j),"").strip()
-            energy.append(e_line)
-                
-        efile = open(molec+"_states.data", "w")
-        for j in range(nstates):
-            efile.write("%s\n" % energy[j])
+#
+# load_training_cache: Store the P(x) values of the training data in the
+# cache, with their components and censored flags when TRAINING_STORE is
+# used.
+#
+def load_training_cache():
 
-        efile.close()
+    if (TRAINING_STORE == ""):
+        load_penfcn_cache("training.dat")
+        return
+    if not (EVAL_CACHE):
+        return
+    store = load_training_store()
+    if store is None:
+        return
 
-        # Save logs
-        command_line("cat "+molec+".output >> qc."+molec+".log")
-        
+    for row in training_store.read_rows(store):
+        comp = {}
+        for i in range(len(PENFCN_COMPONENTS)):
+            if not np.isnan(row[NUM_PARAM+2+i]):
+                comp[PENFCN_COMPONENTS[i]] = row[NUM_PARAM+2+i]
+        if (len(comp) == 0):
+            comp = None
+        cache_store(np.array(row[0:NUM_PARAM]), row[NUM_PARAM], comp, row[NUM_PARAM+1] > 0.0)
 
 #
-# save_var_to_indexed_file: Save the current coefficients to a file.
-# This routine is used for processing inputs that were submitted as batch jobs
-# and not computed during program execution.
+# load_training_store: Open TRAINING_STORE. It is built from training.dat
+# when it does not exist, or when training.dat was changed by another
+# program (see restore_training_rows). If training.dat is behind the store
+# (an interrupted export), it is rewritten from the store.
 # Input:
-#  var = parameters
-#    i = file index
+#  create = create an empty store if there is no training data
+# Output:
+#  store = store (see training_store.py), None if there is no training data
 #
-def save_var_to_indexed_file(var, i):
-    f = open("var."+str(i), "w")
-    for j in range(NUM_PARAM):
-        f.write(" %.5f" % var[j])
-    f.write("\n")
-    f.close()
+def load_training_store(create=False):
+
+    global TRAIN_STORE
+    if TRAIN_STORE is not None:
+        return TRAIN_STORE
+
+    f_training = "training.dat"
+    ncomp = len(PENFCN_COMPONENTS)
+    store = None
+    if os.path.isfile(TRAINING_STORE):
+        store = training_store.open_store(TRAINING_STORE)
+        if (store is not None and (store["nparam"] != NUM_PARAM or store["ncomp"] != ncomp)):
+            store = None
+        if store is None:
+            print("Ignoring "+TRAINING_STORE+" (not a store of "+str(NUM_PARAM)+" parameters)")
+
+    if (store is not None and os.path.isfile(f_training)):
+        tfile = open(f_training, "rb")
+        text = tfile.read()
+        tfile.close()
+        if (len(text) < store["text_size"]):
+            store = None
+        elif (len(text) > store["text_size"] or store["text_rows"] != store["nrows"]):
+            # Export of committed rows interrupted, or rows added by another
+            # program
+            full = "".join(training_store.text_lines(training_store.read_rows(store), NUM_PARAM)).encode()
+            if (full.startswith(text)):
+                write_training_text(store)
+            else:
+                store = None
+        elif (zlib.crc32(text) != store["text_crc"]):
+            store = None
+        if store is None:
+            print(f_training+" was changed, rebuilding "+TRAINING_STORE)
+
+    if store is None and os.path.isfile(f_training):
+        data = np.atleast_2d(np.loadtxt(f_training, usecols=range(NUM_PARAM + 1)))
+        rows = np.full((data.shape[0], NUM_PARAM + 2 + ncomp), np.nan)
+        rows[:,0:NUM_PARAM+1] = data
+        rows[:,NUM_PARAM+1] = 0.0
+        restore_training_rows(rows)
+        store = training_store.create_store(TRAINING_STORE, NUM_PARAM, ncomp)
+        training_store.append_rows(store, rows)
+        tfile = open(f_training, "rb")
+        text = tfile.read()
+        tfile.close()
+        training_store.set_text_size(store, len(text), store["nrows"], zlib.crc32(text))
+    elif store is None and create:
+        store = training_store.create_store(TRAINING_STORE, NUM_PARAM, ncomp)
+    elif (store is not None and not os.path.isfile(f_training)):
+        write_training_text(store)
+
+    TRAIN_STORE = store
+    return store
 
 #
-# train_gp_and_return_opt: Train the GP model and return optimized parameters and
-# GP results.
+# load_trust_regions: Read the trust regions from TR_STATE_FILE, and update
+# them with the values of the points they proposed in the last iteration
+# (see TRUST_REGIONS). Regions are added up to TRUST_REGIONS: the first
+# around the best training point, the others around random points.
+# Input:
+#  X = training points
+#  Y = training values (scaled)
 # Output:
-#  var = parameters
-#  result = result of GP
+#  regions = list of dictionaries with "id", "length" (side), "nsucc",
+#            "nfail" (iterations with and without improvement), "best"
+#            (best value), "center" (parameters of the best point) and
+#            "pending" (points proposed in this iteration)
 #
-def train_gp_and_return_opt(var, result):
-    
-    start_time = time.time()
-    
-    training_data_file = "training.dat"
-    testing_data_file  = "testing.dat"
-    gp_test_output     = "test.output"
-    
-    # Ensure training and testing files are present
-    if not os.path.isfile(training_data_file):
-        print("ERROR: Missing training data file!\n")
-        sys.exit("Error message")
-    if not os.path.isfile(testing_data_file):
-        print("ERROR: Missing testing data file!\n")
+def load_trust_regions(X, Y):
+
+    regions = []
+    if os.path.isfile(TR_STATE_FILE):
+        tfile = open(TR_STATE_FILE, "r")
+        for line in tfile:
+            words = line.split()
+            if (len(words) > 6 and words[0] == "region"):
+                regions.append({"id" : int(words[1]), "length" : float(words[2]), "nsucc" : int(words[3]),
+                                "nfail" : int(words[4]), "best" : float(words[5]),
+                                "center" : np.array(words[6:], dtype=float), "pending" : [], "proposed" : []})
+            elif (len(words) > 1 and words[0] == "point" and len(regions) > 0):
+                regions[-1]["proposed"].append(np.array(words[1:], dtype=float))
+        tfile.close()
+
+    failtol = TR_FAIL_TOL
+    if (failtol <= 0):
+        failtol = int(np.ceil(max(4.0, NUM_PARAM) / max(1, BATCH_SIZE)))
+    values = {}
+    for i in range(len(Y)):
+        values[cache_key(X[i])] = Y[i]
+    bnds = np.array(get_param_bounds(), dtype=float)
+    for region in regions:
+        found = [(values[cache_key(x)], i) for i, x in enumerate(region["proposed"]) if cache_key(x) in values]
+        if (len(found) == 0):
+            continue
+        val, i = min(found)
+        if (not np.isfinite(region["best"]) or val < region["best"] - 1.0e-3 * abs(region["best"])):
+            region["nsucc"] = region["nsucc"] + 1
+            region["nfail"] = 0
+            region["best"] = val
+            region["center"] = region["proposed"][i]
+        else:
+            region["nsucc"] = 0
+            region["nfail"] = region["nfail"] + 1
+        if (region["nsucc"] >= TR_SUCC_TOL):
+            region["length"] = min(2.0 * region["length"], TR_LENGTH_MAX)
+            region["nsucc"] = 0
+        elif (region["nfail"] >= failtol):
+            region["length"] = region["length"] / 2.0
+            region["nfail"] = 0
+        if (region["length"] < TR_LENGTH_MIN):
+            print(" Trust region %d converged at %15.8f, restarting" % (region["id"], region["best"]))
+            region.update({"length" : TR_LENGTH_INIT, "nsucc" : 0, "nfail" : 0, "best" : np.inf,
+                           "center" : np.random.uniform(bnds[:,0], bnds[:,1])})
+
+    while (len(regions) < TRUST_REGIONS):
+        region = {"id" : len(regions), "length" : TR_LENGTH_INIT, "nsucc" : 0, "nfail" : 0, "best" : np.inf,
+                  "center" : np.random.uniform(bnds[:,0], bnds[:,1]), "pending" : [], "proposed" : []}
+        if (len(regions) == 0):
+            region["best"] = np.min(Y)
+            region["center"] = np.array(X[np.argmin(Y)], dtype=float)
+        regions.append(region)
+    return regions[0:TRUST_REGIONS]
+
+#
+# load_run_journal: Read RUN_JOURNAL. Computed P(x) values are stored in the
+# cache if they were computed with the current configuration (see
+# config_fingerprint), and the state of each QChem work directory and the last unfinished
+# proposal are kept in JOURNAL.
+#
+def load_run_journal():
+
+    global JOURNAL
+    if JOURNAL is not None:
+        return
+
+    JOURNAL = {"jobs" : {}, "proposal" : None}
+    if (RUN_JOURNAL == ""):
+        return
+
+    nresult = 0
+    nother = 0
+    for words in run_journal.read_events(RUN_JOURNAL):
+        try:
+            if (words[0] == "job"):
+                JOURNAL["jobs"][(words[2], words[3])] = (words[1], words[4], words[5:])
+            elif (words[0] == "result"):
+                if (len(words) != NUM_PARAM + 4 or words[3] != config_fingerprint()):
+                    nother = nother + 1
+                    continue
+                if (EVAL_CACHE):
+                    cache_store(np.array(words[4:], dtype=float), float(words[1]), None, words[2] == "1")
+                nresult = nresult + 1
+            elif (words[0] == "iter"):
+                JOURNAL["proposal"] = {"train" : words[1], "gp" : float(words[2]), "nbatch" : int(words[3]),
+                                       "var" : [float(v) for v in words[4:]], "batch" : []}
+            elif (words[0] == "point" and JOURNAL["proposal"] is not None):
+                JOURNAL["proposal"]["batch"].append(([float(v) for v in words[2:]], float(words[1])))
+            elif (words[0] == "append"):
+                JOURNAL["proposal"] = None
+        except (IndexError, ValueError):
+            print("Skipping journal line: "+" ".join(words))
+
+    if (nresult > 0):
+        print("Read %d P(x) values from %s" % (nresult, RUN_JOURNAL))
+    if (nother > 0):
+        print("Skipped %d P(x) values of another configuration in %s" % (nother, RUN_JOURNAL))
+
+#
+# get_penalty_cutoff: P(x) above which the remaining QChem jobs of a point
+# are stopped (see EARLY_ABORT).
+# Output:
+#  cutoff = P(x) cutoff, None if jobs are never stopped
+#
+def get_penalty_cutoff():
+
+    if (EARLY_ABORT == "incumbent" and ABORT_FACTOR <= 1.0):
+        print("ERROR: ABORT_FACTOR must be larger than 1.0 (got "+str(ABORT_FACTOR)+")\n")
         sys.exit("Error message")
-        
-    # Read in training points and testing points
-    X  = np.loadtxt(training_data_file, usecols=range(NUM_PARAM))
-    Xt = np.loadtxt(testing_data_file,  usecols=range(NUM_PARAM))
-    
-    Y  = np.loadtxt(training_data_file, usecols=(NUM_PARAM, ))
-    Yt = np.loadtxt(testing_data_file,  usecols=(NUM_PARAM, ))
-    # Scale
-    Y = np.multiply(Y, YSCALE)
-    Yt = np.multiply(Yt, YSCALE)
-    
-    Xinv  = np.divide(1, X)
-    Xtinv = np.divide(1, Xt)
-    
-    XMor  = np.exp(-X  /10.0)
-    XtMor = np.exp(-Xt /10.0) 
-    
-    npoints_training = X.shape[0]
-    npoints_testing  = Xt.shape[0]
+    if (EARLY_ABORT == "none" or not EVAL_CACHE):
+        return None
 
-    print("--------------------------------------------\n")
-    print("Training data:\n")
-    print(" Number of parameters (dimensions): %10d\n" % NUM_PARAM)
-    print(" Number of training points: %10d\n" % npoints_training)
-    print("Testing data:\n")
-    print(" Number of testing points: %10d\n" % npoints_testing)
-    print("--------------------------------------------\n")
+    # A partial P(x) is only a lower bound if no weighted component can be negative
+    wt = PENFCN_WEIGHTS
+    for name in wt:
+        if (wt[name] < 0.0):
+            return None
+    if (MINIMIZE_ABSE and (wt["ground state"] > 0.0 or wt["states"] > 0.0)):
+        return None
+
+    vals = []
+    for key in PENFCN_CACHE["index"]:
+        if key not in PENFCN_CACHE["censored"]:
+            vals.append(PENFCN_CACHE["val"][PENFCN_CACHE["index"][key]])
+    if (len(vals) < ABORT_MIN_POINTS):
+        return None
+
+    if (EARLY_ABORT == "worst"):
+        return max(vals)
+    elif (EARLY_ABORT == "incumbent"):
+        if (min(vals) <= 0.0):
+            return None
+        return ABORT_FACTOR * min(vals)
+    else:
+        print("Unknown EARLY_ABORT: "+str(EARLY_ABORT))
+        sys.exit("Error message")
 
-    print("\n Total time: %s seconds\n" % (time.time() - start_time))
+#
+# get_param_bounds: Get lower and upper bounds for each parameter.
+#
+def get_param_bounds():
+    return PBOUNDS
 
-    # Kernel selection
-    d = NUM_PARAM
-    ck = C(1.0, (1e-5, 1e+5))
-    kernels_m = [RBF(length_scale=np.ones(d), length_scale_bounds=(1e-5, 1e+5)),
-                 RQ(length_scale=1.0, alpha=0.1,length_scale_bounds=(1e-5, 1e+5), alpha_bounds=(1e-5, 1e+5)),
-                 Matern(length_scale=np.ones(d), length_scale_bounds=(1e-5, 1e+5),nu=2.5)]
-    ks = kernel_user()
-    if ks == "mat":
-        k = ck * kernels_m[2]
-    elif ks == "rbf":
-        k = ck * kernels_m[0]
-    elif ks == "rq":
-        k = ck * kernels_m[1]
-    wk_bool = "no"
-    if wk_bool == "yes" or wk_bool == "YES":
-        k = k + ck * WhiteKernel(0.1)
+#
+# get_pjob_cores: Get the number of cores shared by parallel QChem jobs.
+#
+def get_pjob_cores():
+    if (PJOB_CORES > 0):
+        return PJOB_CORES
+    if NTHREADS is not None:
+        return int(NTHREADS)
+    return os.cpu_count()
 
-    # Train model
-    optdat_file = open("opt.dat", "w")
-    result_file = open("result",  "w")
-    print("Training GP model")
-    gp = GaussianProcessRegressor(kernel = k, n_restarts_optimizer = 12, normalize_y = True)
-    if not (USE_XINV):
-        gp.fit(np.atleast_2d(X), Y)
+#
+# qchem_command: Command line running the electronic structure program
+# selected by QC_ENGINE on <molec>.input. With GUESS_REUSE the scratch
+# files are saved to $QCSCRATCH/<molec>.save, and the program writes
+# <molec>.output itself.
+# Input:
+#  molec    = molecule
+#  nthreads = number of threads
+# Output:
+#  cmd = command as list of arguments
+#
+def qchem_command(molec, nthreads):
+    if (QC_ENGINE == "mock"):
+        cmd = [sys.executable, PROGRAM_HOME+"/source/mock_qchem.py",
+               "-nt", str(nthreads), "-l", str(MOCK_LATENCY)]
+    elif (QC_ENGINE == "qchem"):
+        cmd = ["qchem", "-nt", str(nthreads)]
     else:
-        gp.fit(np.atleast_2d(Xinv), Y)
-    
-    print("Log-marginal-likelihood (GP): %.3f" % gp.log_marginal_likelihood(gp.kernel_.theta))
+        print("Unknown QC_ENGINE: "+str(QC_ENGINE))
+        sys.exit("Error message")
 
-    f_coef = "coeff.dat"
-    np.savetxt(f_coef,gp.kernel_.theta,fmt="%.16f")
-    np.savetxt("k.dat",gp.L_,fmt="%.16f")
-    np.savetxt("alpha.dat",gp.alpha_,fmt="%.16f")
+    if (GUESS_REUSE):
+        return cmd + ["-save", molec+".input", molec+".output", molec+".save"]
+    return cmd + [molec+".input"]
+
+#
+# qchem_env: Environment of a QChem job
+# Input:
+#  nthreads = number of threads (None to keep OMP_NUM_THREADS)
+#  wdir     = work directory of the job
+# Output:
+#  env = environment variables
+#
+def qchem_env(nthreads, wdir):
+    env = dict(os.environ)
+    if nthreads is not None:
+        env["OMP_NUM_THREADS"] = str(nthreads)
+        env["QCTHREADS"] = str(nthreads)
+    if (GUESS_REUSE):
+        env["QCSCRATCH"] = os.path.abspath(wdir)+"/qcscratch"
+    return env
+
+#
+# qchem_stdout: File receiving the standard output of a QChem job
+# Input:
+#  molec = molecule
+#
+def qchem_stdout(molec):
+    if (GUESS_REUSE):
+        return molec+".stdout"
+    return molec+".output"
+
+#
+# qchem_input_text: Text of a qchem input file. The input deck is read
+# once, and the basis set information is appended to it.
+# Input:
+#  molec = molecule
+#  var   = parameters
+# Output:
+#  text = input file contents
+#
+def qchem_input_text(molec, var):
+
+    if molec not in DECK_CACHE:
+        deck_file = open(molec+".input_deck", "r")
+        DECK_CACHE[molec] = deck_file.read()
+        deck_file.close()
+
+    lines = [DECK_CACHE[molec], BASBEGINSTR]
+
+    if EVEN_TEMPERED_BASIS == False:
+
+        for i in range(len(var)):
+            lines.append(str(ORBITAL_TYPE[i])+"   1   1.0\n")
+            lines.append(" %.5f   1.0000D+00\n" % var[i])
 
-    
-    print("Prediction with GP model")
-    if not (USE_XINV):
-        y_pred, sigma = gp_prediction(gp, Xt)
     else:
-        y_pred, sigma = gp_prediction(gp, Xtinv)
-    
-    ygp = np.column_stack((Yt, y_pred, sigma))
-    dpred = np.column_stack((Xt, ygp))
-    print("Save predicted points")
-    np.savetxt(gp_test_output, ygp)
-    rmse = np.sqrt(mse(Yt, y_pred))
-    print("RMSE = ", rmse)
-    print(" ----------------------------------\n")
+
+        vix = 0 # start var indexing, we will jump by two for each a,b pair
+        for i in range(len(ET_BASIS_NUM_FCNS)):
+            for j in range(ET_BASIS_NUM_FCNS[i]):
+                expcoef = var[vix]*math.pow(var[vix+1],j) # j = n-1 = 0 .. n-1
+                lines.append(str(ORBITAL_TYPE[i])+"   1   1.0\n")
+                lines.append(" %.5f   1.0000D+00\n" % expcoef)
+
+            vix = vix + 2 # increment to next a,b pair
+
+    lines.append("****\n$end\n")
+    return "".join(lines)
+
+#
+# qchem_job: Compute a QChem job with basis set parameters given by
+# input. 
+#
+# This function also handles processing file for density / excited states
+#
+# Input:
+#  var = basis set parameters
+#  molec = moelcule to run Qchem for
+#  cjobtype = cubedata_into*x jobetype (1=x, 2=x+z, 3=xyz)
+#
+def qchem_job(var, molec, cjobtype, nstates):
+    # Create the input file and run QChem. Then extract the
+    # density information (see save_density_data)
+    # After this, get energy information and save it to '*_states.data'
+    create_qchem_file(molec, var)
+    create_nbox_files(molec)
+    stage_guess(molec, var, ".")
+
+    if journal_job_done(molec, ".", var):
+        print("Using finished QChem output of "+molec)
+    else:
+        journal_job("start", molec, ".", var)
+        status = run_qchem(molec, NTHREADS)
+        journal_job_end(molec, ".", var)
+        check_qchem_job(molec, ".", status)
+    save_density_data(molec, cjobtype)
+    save_states_data(molec, nstates)
+    store_guess(molec, var, ".")
+
+    # Save logs
+    archive_qchem_output(molec, ".", var)
+
+#
+# process_pjob_dir: Process the output of a parallel QChem job and copy
+# the data files to the parent directory. The output is archived the first
+# time only.
+# Input:
+#  job = job description from create_pjob_dir
+#
+def process_pjob_dir(job):
+
+    molec = job["molec"]
+    curr_dir = os.getcwd()
+
+    check_qchem_job(molec, job["dir"], job.get("status", 0))
+
+    # Extract density and state information in the work directory
+    os.chdir(job["dir"])
+    process_qchem_job(molec, PENFCN_WEIGHTS, job["cjobtype"], job["nstates"])
+    os.chdir(curr_dir)
+
+    # Copy data files and output to the parent directory
+    for fname in [molec+"_dens.data", molec+"_states.data", molec+".output"]:
+        if os.path.isfile(job["dir"]+"/"+fname):
+            shutil.copy(job["dir"]+"/"+fname, fname)
+
+    # Save logs
+    if not job.get("logged", False):
+        archive_qchem_output(molec, job["dir"], job["var"])
+        job["logged"] = True
+
+#
+# qchem_pjobs: Run QChem jobs for all systems of one or more points in
+# parallel, and compute P(x) of each point.
+#
+# Each system runs in its own directory (<molec>, or batch.<k>/<molec> for
+# more than one point). The cores given by get_pjob_cores are shared between
+# the jobs. With a cutoff, the remaining jobs of a point are stopped once
+# its finished systems give P(x) > cutoff.
+#
+# Input:
+#  batch_var = list of basis set parameters
+#  cutoff    = P(x) cutoff (None to run every job), or a list with the
+#              cutoff of each point
+#  systems   = systems to run (None = MOLEC_SYS)
+# Output:
+#  results = (P(x), components, censored) for each point
+#
+def qchem_pjobs(batch_var, cutoff=None, systems=None):
+
+    full = systems is None
+    if (full):
+        systems = MOLEC_SYS
+    if not isinstance(cutoff, list):
+        cutoff = [cutoff] * len(batch_var)
+
+    # Create directories for each point and molecular system
+    jobs = []
+    for k in range(len(batch_var)):
+        for i in range(len(systems)):
+            wdir = systems[i][0]
+            if (len(batch_var) > 1):
+                wdir = "batch."+str(k)+"/"+wdir
+            job = create_pjob_dir(batch_var[k], systems[i], wdir)
+            job["point"] = k
+            if journal_job_done(job["molec"], wdir, batch_var[k]):
+                print("Using finished QChem output of "+job["molec"]+" in "+wdir)
+                job["time"] = 0.0
+            jobs.append(job)
+
+    partial = [None] * len(batch_var)
+    loaded = None
+
+    # Compute the partial P(x) of the point of a finished job. Returns the
+    # jobs to stop.
+    def check_partial(j):
+        nonlocal loaded
+        k = jobs[j]["point"]
+        done = [job for job in jobs if job["point"] == k and "time" in job]
+        if (cutoff[k] is None or len(done) == len(systems)):
+            return []
+
+        # The data files of the last point checked are in the current directory
+        if (loaded == k):
+            process_pjob_dir(jobs[j])
+        else:
+            for job in done:
+                process_pjob_dir(job)
+        loaded = k
+
+        val, comp = penalty_function_from_files(batch_var[k], [job["msys"] for job in done])
+        if (val <= cutoff[k]):
+            return []
+        partial[k] = (val, comp)
+        print("Partial P(x) = %15.8f > %15.8f after %d of %d systems" % (val, cutoff[k], len(done), len(systems)))
+        return [i for i in range(len(jobs)) if jobs[i]["point"] == k and "time" not in jobs[i]]
+
+    # Run QChem
+    if (cutoff.count(None) == len(cutoff)):
+        run_pjobs(jobs, get_pjob_cores())
+    else:
+        run_pjobs(jobs, get_pjob_cores(), check_partial)
+
+    # Evaluate each point from its data files
+    results = []
+    for k in range(len(batch_var)):
+        if partial[k] is not None:
+            results.append((partial[k][0], partial[k][1], True))
+            continue
+        for job in jobs:
+            if (job["point"] == k):
+                process_pjob_dir(job)
+        val, comp = penalty_function_from_files(batch_var[k], systems)
+        if (full):
+            record_fidelity_values(batch_var[k])
+            record_component_values(batch_var[k])
+        results.append((val, comp, False))
+
+    return results
+
+#
+# record_job_timing: Save the wall time of a finished QChem job. The job
+# time printed in the output is used when available. Failed jobs are
+# not recorded.
+# Input:
+#  molec    = molecule
+#  nthreads = number of threads
+#  flname   = QChem output file
+#  wall     = measured wall time (seconds)
+#
+def record_job_timing(molec, nthreads, flname, wall):
+
+    qout = qchem_output.parse_qchem_output(flname)
+    if (qout["error"] or not qout["normal_termination"]):
+        return
+    if qout["wall_time"] is not None:
+        wall = qout["wall_time"]
+
+    load_job_timing()
+    JOB_TIMING.setdefault(molec, []).append((nthreads, wall))
+    tfile = open(PJOB_TIMING_FILE, "a")
+    tfile.write("%s %d %.2f\n" % (molec, nthreads, wall))
+    tfile.close()
+
+#
+# read_fidelity_data: Training data of a cheaper fidelity
+# Input:
+#  level = index in FIDELITIES
+# Output:
+#  data = dictionary with "X" (list of parameters), "Y" (list of P(x)) and
+#         "keys" (cache keys of the parameters)
+#
+def read_fidelity_data(level):
+
+    if level in FIDELITY_DATA:
+        return FIDELITY_DATA[level]
+
+    data = {"X" : [], "Y" : [], "keys" : set()}
+    flname = fidelity_data_file(level)
+    if (os.path.isfile(flname) and os.path.getsize(flname) > 0):
+        values = np.atleast_2d(np.loadtxt(flname, usecols=range(NUM_PARAM + 1)))
+        for row in values:
+            data["X"].append(list(row[0:NUM_PARAM]))
+            data["Y"].append(row[NUM_PARAM])
+            data["keys"].add(cache_key(row[0:NUM_PARAM]))
+    FIDELITY_DATA[level] = data
+    return data
+
+#
+# record_fidelity_values: Compute the cheaper fidelities of P(x) from the
+# data files of a full evaluation, and add them to their training data
+# Input:
+#  var = parameters
+#
+def record_fidelity_values(var):
+    for level in range(len(FIDELITIES)):
+        val, comp = penalty_function_from_files(var, FIDELITIES[level]["systems"])
+        append_fidelity_data(level, [var], [val])
+
+#
+# read_component_data: Components of P(x) at the evaluated points, from
+# COMPONENT_FILE. The first line of the file names the components. If the
+# current components (see component_terms) are not all in the file, it is
+# moved to COMPONENT_FILE_prev and a new one is started.
+# Output:
+#  data = dictionary with "names" (components), "X" (list of parameters),
+#         "Y" (list of component values, nan if not computed) and "keys"
+#         (cache keys of the parameters)
+#
+def read_component_data():
+
+    global COMPONENT_DATA
+    if COMPONENT_DATA is not None:
+        return COMPONENT_DATA
+
+    data = {"names" : component_terms(), "X" : [], "Y" : [], "keys" : set()}
+    if (os.path.isfile(COMPONENT_FILE) and os.path.getsize(COMPONENT_FILE) > 0):
+        cfile = open(COMPONENT_FILE, "r")
+        names = cfile.readline().split()[1:]
+        cfile.close()
+        if all(name in names for name in data["names"]):
+            data["names"] = names
+            values = np.loadtxt(COMPONENT_FILE, usecols=range(NUM_PARAM + len(names)), ndmin=2)
+            for row in values:
+                data["X"].append(list(row[0:NUM_PARAM]))
+                data["Y"].append(list(row[NUM_PARAM:]))
+                data["keys"].add(cache_key(row[0:NUM_PARAM]))
+        else:
+            print(COMPONENT_FILE+" does not have the components "+" ".join(data["names"])+
+                  ", moving it to "+COMPONENT_FILE+"_prev")
+            os.replace(COMPONENT_FILE, COMPONENT_FILE+"_prev")
+    COMPONENT_DATA = data
+    return data
+
+#
+# record_component_values: Compute the components of P(x) of each system
+# from the data files of an evaluation, and add them to COMPONENT_FILE
+# (with SURROGATE = components)
+# Input:
+#  var = parameters
+#
+def record_component_values(var):
+
+    if (SURROGATE != "components"):
+        return
+    data = read_component_data()
+    key = cache_key(var[0:NUM_PARAM])
+    if key in data["keys"]:
+        return
+
+    fcns = {"density" : objective_function_value_density,
+            "excited states" : objective_function_value_excited_states,
+            "ground state" : objective_function_value_groundstate,
+            "states" : objective_function_value_all_states}
+    systems = {}
+    for msys in MOLEC_SYS:
+        systems[msys[0]] = msys
+    vals = []
+    for name in data["names"]:
+        molec, comp = name.split(":")
+        comp = comp.replace("_", " ")
+        if (molec in systems and PENFCN_WEIGHTS[comp] != 0.0):
+            vals.append(fcns[comp](var, [systems[molec]]))
+        else:
+            vals.append(np.nan)
+
+    new = not os.path.isfile(COMPONENT_FILE) or os.path.getsize(COMPONENT_FILE) == 0
+    cfile = open(COMPONENT_FILE, "a")
+    if (new):
+        cfile.write("# "+" ".join(data["names"])+"\n")
+    cfile.write("".join(" %10.5f" % v for v in var[0:NUM_PARAM]) + "".join(" %15.8f" % v for v in vals)+"\n")
+    cfile.flush()
+    os.fsync(cfile.fileno())
+    cfile.close()
+    data["X"].append(list(var[0:NUM_PARAM]))
+    data["Y"].append(vals)
+    data["keys"].add(key)
+
+#
+# read_training_data: Read the training data. A point added more than once
+# (a censored point evaluated again in full, see EARLY_ABORT) keeps its last
+# value.
+# Output:
+#  X = training points (empty if there is no training data)
+#  Y = P(x) of the training points
+#
+def read_training_data():
+    if (TRAINING_STORE == ""):
+        if not os.path.isfile("training.dat"):
+            return np.zeros((0, NUM_PARAM)), np.zeros(0)
+        data = np.atleast_2d(np.loadtxt("training.dat", usecols=range(NUM_PARAM + 1)))
+    else:
+        store = load_training_store()
+        if store is None:
+            return np.zeros((0, NUM_PARAM)), np.zeros(0)
+        data = training_store.read_rows(store)[:,0:NUM_PARAM+1]
+    last = {}
+    for i in range(data.shape[0]):
+        last[cache_key(data[i,0:NUM_PARAM])] = i
+    if (len(last) < data.shape[0]):
+        data = data[sorted(last.values())]
+    return np.array(data[:,0:NUM_PARAM]), np.array(data[:,NUM_PARAM])
+
+#
+# restore_training_rows: Set the censored flags and components of training
+# store rows rebuilt from training.dat. A row is censored if CENSORED_FILE
+# has the point with the same P(x). Each component is the sum over the
+# systems of its values in COMPONENT_FILE, if every system has one.
+# Input:
+#  rows = store rows (see TRAINING_STORE), changed in place
+#
+def restore_training_rows(rows):
+
+    if os.path.isfile(CENSORED_FILE):
+        partial = {}
+        for row in np.loadtxt(CENSORED_FILE, usecols=range(NUM_PARAM + 1), ndmin=2):
+            partial.setdefault(cache_key(row[0:NUM_PARAM]), []).append(row[NUM_PARAM])
+        for row in rows:
+            for val in partial.get(cache_key(row[0:NUM_PARAM]), []):
+                if (abs(val - row[NUM_PARAM]) <= 1.0e-6):
+                    row[NUM_PARAM+1] = 1.0
+
+    if not (os.path.isfile(COMPONENT_FILE) and os.path.getsize(COMPONENT_FILE) > 0):
+        return
+    cfile = open(COMPONENT_FILE, "r")
+    names = cfile.readline().split()[1:]
+    cfile.close()
+    comps = {}
+    for row in np.loadtxt(COMPONENT_FILE, usecols=range(NUM_PARAM + len(names)), ndmin=2):
+        comps[cache_key(row[0:NUM_PARAM])] = row[NUM_PARAM:]
+    molecs = set(msys[0] for msys in MOLEC_SYS)
+    for i in range(len(PENFCN_COMPONENTS)):
+        cols = [j for j in range(len(names))
+                if names[j].split(":")[-1].replace("_", " ") == PENFCN_COMPONENTS[i]]
+        if (set(names[j].split(":")[0] for j in cols) != molecs or len(cols) != len(molecs)):
+            continue
+        for row in rows:
+            key = cache_key(row[0:NUM_PARAM])
+            if key in comps and row[NUM_PARAM+1] == 0.0:
+                row[NUM_PARAM+2+i] = np.sum(comps[key][cols])
+
+#
+# run_pjobs: Run QChem jobs concurrently, in the lanes given by
+# allocate_job_threads.
+# Input:
+#  jobs      = list of jobs from create_pjob_dir. On return each job holds
+#              its thread count ("nthreads"), wall time ("time") and exit
+#              status ("status"), or "cancelled" if it was stopped or never
+#              started. Jobs that
+#              already hold a time are not run.
+#  ncores    = number of cores available
+#  on_finish = function called with the index of each finished job. It
+#              returns the indices of jobs to stop. Lanes then run their
+#              jobs shortest first.
+#
+def run_pjobs(jobs, ncores, on_finish=None):
+
+    todo = [i for i in range(len(jobs)) if "time" not in jobs[i]]
+    if (len(todo) == 0):
+        return
+    lanes, nthreads = allocate_job_threads([jobs[i] for i in todo], ncores, on_finish is not None)
+    lanes = [[todo[j] for j in lane] for lane in lanes]
+    print("Running %d QChem jobs in %d lanes" % (len(todo), len(lanes)))
+    for l in range(len(lanes)):
+        print("  %3d threads: " % nthreads[l] + " ".join(jobs[i]["molec"] for i in lanes[l]))
     sys.stdout.flush()
 
-    # Optimization
+    nstarted = [0] * len(lanes)
+    running = {}
+
+    while True:
+
+        # Start the next job of each idle lane
+        for l in range(len(lanes)):
+            while (l not in running and nstarted[l] < len(lanes[l])):
+                i = lanes[l][nstarted[l]]
+                nstarted[l] = nstarted[l] + 1
+                if jobs[i].get("cancelled", False):
+                    continue
+                journal_job("start", jobs[i]["molec"], jobs[i]["dir"], jobs[i]["var"])
+                proc, outf = start_qchem_process(jobs[i], nthreads[l])
+                running[l] = (i, proc, outf)
+
+        if (len(running) == 0):
+            break
+
+        time.sleep(PJOB_POLL_TIME)
+
+        # Release the lanes of finished jobs
+        for l in list(running.keys()):
+            if l not in running:
+                continue
+            i, proc, outf = running[l]
+            if proc.poll() is None:
+                continue
+            outf.close()
+            jobs[i]["time"] = time.time() - jobs[i]["start"]
+            jobs[i]["status"] = proc.returncode
+            del running[l]
+            record_job_timing(jobs[i]["molec"], nthreads[l], jobs[i]["dir"]+"/"+jobs[i]["molec"]+".output",
+                              jobs[i]["time"])
+            journal_job_end(jobs[i]["molec"], jobs[i]["dir"], jobs[i]["var"])
+            store_guess(jobs[i]["molec"], jobs[i]["var"], jobs[i]["dir"])
+            print("Finished "+jobs[i]["molec"]+" (%d threads) in %.1f seconds" % (nthreads[l], jobs[i]["time"]))
+            sys.stdout.flush()
+
+            if on_finish is None:
+                continue
+            for c in on_finish(i):
+                jobs[c]["cancelled"] = True
+                for lc in list(running.keys()):
+                    if (running[lc][0] == c):
+                        running[lc][1].kill()
+                        running[lc][1].wait()
+                        running[lc][2].close()
+                        del running[lc]
+                        print("Stopped "+jobs[c]["molec"]+" in "+jobs[c]["dir"])
+            sys.stdout.flush()
+
+#
+# run_qchem: Run the electronic structure program in the current directory
+# and wait for it to finish. Output is written to <molec>.output.
+# Input:
+#  molec    = molecule
+#  nthreads = number of threads (None for 1)
+# Output:
+#  status = exit status of the program
+#
+def run_qchem(molec, nthreads):
+    if nthreads is None:
+        nthreads = 1
+    start_time = time.time()
+    with open(qchem_stdout(molec), "w") as outf:
+        status = subprocess.call(qchem_command(molec, nthreads), stdout=outf, stderr=subprocess.STDOUT,
+                                 env=qchem_env(nthreads, "."))
+    record_job_timing(molec, int(nthreads), molec+".output", time.time() - start_time)
+    return status
+
+#
+# save_censored_point: Add a point with a partial P(x) to CENSORED_FILE
+# Input:
+#  var    = parameters
+#  val    = partial P(x)
+#  cutoff = P(x) cutoff that was exceeded
+#
+def save_censored_point(var, val, cutoff):
+    print("Stopped early. Censored P(x) = %15.8f (cutoff %15.8f)" % (val, cutoff))
+    cfile = open(CENSORED_FILE, "a")
+    for i in range(len(var)):
+        cfile.write(" %10.5f" % var[i])
+    cfile.write(" %15.8f %15.8f\n" % (val, cutoff))
+    cfile.close()
+
+#
+# save_density_data: Extract the density from den_p_0.cube in the current
+# directory. It is kept in DENS_DATA, and saved to '<molec>_dens.data' if
+# SAVE_DENS_DATA is set.
+# Input:
+#  molec    = molecular system
+#  cjobtype = cubedata jobtype (1=x, 2=x+z, 3=xyz, 4=xyz grid)
+#
+def save_density_data(molec, cjobtype):
+
+    # Offset of x and y density lines, if given in MOLEC_SYS
+    xy_disp = 0
+    for msys in MOLEC_SYS:
+        if (msys[0] == molec and len(msys) > 4):
+            xy_disp = msys[4]
+
+    DENS_DATA[molec] = cubedata.cube_training_data("den_p_0.cube", cjobtype, xy_disp)
+    if (SAVE_DENS_DATA):
+        cubedata.write_training_data(molec+"_dens.data", DENS_DATA[molec])
+
+#
+# save_states_data: Save the CI root energies of '<molec>.output' in the
+# current directory to '<molec>_states.data'
+# Input:
+#  molec   = molecular system
+#  nstates = number of states
+#
+def save_states_data(molec, nstates):
+    energies = qchem_output.parse_qchem_output(molec+".output")["energies"]
+    if (len(energies) < nstates):
+        print("Missing CI energies in "+molec+".output")
+        sys.exit("Error message")
+    qchem_output.write_states_file(molec+"_states.data", energies[0:nstates])
+
+#
+# save_gp_model: Save the GP model (GP_STATE) to GP_MODEL_FILE, unless it
+# was read from there
+# Input:
+#  kernel = kernel (initial hyperparameters)
+#
+def save_gp_model(kernel):
+
+    if (GP_STATE is None or GP_STATE["saved"]):
+        return
+    gp = GP_STATE["gp"]
+    data = {"version" : GP_MODEL_VERSION, "backend" : GP_BACKEND, "kernel" : str(kernel),
+            "theta" : gp.kernel_.theta, "fingerprint" : GP_STATE["fingerprint"],
+            "iters" : GP_STATE["iters"], "nfit" : GP_STATE["nfit"], "lml" : GP_STATE["lml"]}
+    for attr in GP_MODEL_ATTRS[GP_BACKEND]:
+        data[attr] = getattr(gp, attr)
+
+    mfile = open(GP_MODEL_FILE+".new", "wb")
+    np.savez(mfile, **data)
+    mfile.close()
+    os.replace(GP_MODEL_FILE+".new", GP_MODEL_FILE)
+    GP_STATE["saved"] = True
+
+#
+# save_var_to_indexed_file: Save the current coefficients to a file.
+# This routine is used for processing inputs that were submitted as batch jobs
+# and not computed during program execution.
+# Input:
+#  var  = parameters
+#    i  = file index
+#  wdir = directory of the file
+#
+def save_var_to_indexed_file(var, i, wdir="."):
+    f = open(wdir+"/var."+str(i), "w")
+    for j in range(NUM_PARAM):
+        f.write(" %.5f" % var[j])
+    f.write("\n")
+    f.close()
+
+#
+# search_gp_minimum: Search for the minimum of the GP model.
+# Input:
+#  gp    = trained GP model
+#  X     = training points (starting points for the search)
+#  Y     = training values
+#  start = local search starts from the training point with the start-th
+#          lowest value (0 = minimum of data set)
+# Output:
+#  xmin = parameters at minimum
+#  ymin = GP prediction at minimum
+#
+def search_gp_minimum(gp, X, Y, start=0):
+
+    X = np.array(X)
     nsearch = NMIN_SEARCH # Number of guess searches
     var_loc = [0.0] * NUM_PARAM * nsearch
     res_loc = [0.0] * nsearch
+    acq_loc = [0.0] * nsearch
     xrows, xcols = X.shape
     # Starting points
     sg = np.random.randint(0, xrows, nsearch)
@@ -1175,23 +3596,24 @@ def train_gp_and_return_opt(var, result):
     print(" Minimum in training data: "+str(datamin)+" , "+str(Y[datamin]))
     if (START_FROM_MIN):
         sg[0] = datamin
+
+    # Reference values of the acquisition function
+    set_acquisition_state(Y, xcols)
         
     if (MINTYPE == "global"):
+        # Searches run in parallel
+        xs = basinhopping_searches(gp, [X[sg[j],:] for j in range(nsearch)])
         for j in range(nsearch):
-            # Get lower/upper bounds for each parameter
-            bnds = get_param_bounds()
-            minimizer = {"method": "L-BFGS-B", "args":gp,"bounds":bnds}
-            res = basinhopping(gp_objfcn,X[sg[j],:],minimizer_kwargs=minimizer,niter=1000)
-
             for i in range(NUM_PARAM):
-                var_loc[NUM_PARAM*j+i] = res.x[i]
+                var_loc[NUM_PARAM*j+i] = xs[j][i]
                 if (USE_XINV):
-                    X[0,i] = np.divide(1,res.x[i])
+                    X[0,i] = np.divide(1,xs[j][i])
                 else:
-                    X[0,i] = res.x[i]
+                    X[0,i] = xs[j][i]
 
             out, sigma = gp_prediction(gp,X[0,:])
             res_loc[j]=out[0]
+            acq_loc[j]=acquisition_value(out, sigma)[0]
 
         print(" Starting guesses:")
         for j in range(nsearch):
@@ -1206,12 +3628,12 @@ def train_gp_and_return_opt(var, result):
         min_val = 1000000.0
         min_idx = 0
         for j in range(nsearch):
-            if (res_loc[j] < min_val):
+            if (acq_loc[j] < min_val):
                 # if we are rejecting P(x) = 0.0 edge cases
                 if (NOEDGE_MINIMA and res_loc[j] <= 0.0001):
                     continue
                 min_idx = j
-                min_val = res_loc[j]
+                min_val = acq_loc[j]
             
         # Print this minimum
         for i in range(NUM_PARAM):
@@ -1219,25 +3641,816 @@ def train_gp_and_return_opt(var, result):
         print(" %15.8f" % res_loc[min_idx])
     
         # Return this minimum
-        var[0:NUM_PARAM] = var_loc[(NUM_PARAM * min_idx):(NUM_PARAM * min_idx) + NUM_PARAM]
-        result[0] = res_loc[min_idx] * YSCALE
+        xmin = var_loc[(NUM_PARAM * min_idx):(NUM_PARAM * min_idx) + NUM_PARAM]
+        ymin = res_loc[min_idx] * YSCALE
 
     else:
         # Local search from minimum
         bnds = get_param_bounds()
-        res = minimize(gp_objfcn,X[datamin,:],method="L-BFGS-B",bounds=bnds,args=gp)
-        var[0:NUM_PARAM] = res.x
-        out, sigma = gp_prediction(gp, var)
-        result[0] = out[0]
+        x0 = X[np.argsort(Y)[min(start, xrows - 1)],:]
+        fun, jac = gp_search_objective(gp)
+        res = minimize(fun,x0,method="L-BFGS-B",jac=jac,bounds=bnds,args=gp)
+        xmin = list(res.x)
+        out, sigma = gp_prediction(gp, xmin)
+        ymin = out[0]
         # Print this minimum
         for i in range(NUM_PARAM):
-            print(" %10.5f" % var[i])
-        print(" %15.8f" % result[0])
-        
+            print(" %10.5f" % xmin[i])
+        print(" %15.8f" % ymin)
+
+    return xmin, ymin
+
+#
+# select_kernel: Select the kernel from KERNEL_CANDIDATES, by fitting each
+# to the training data (see kernel_select.py). The selection is read from
+# KERNEL_SELECT_FILE if the training data have not changed since, and
+# made again when they have.
+# Output:
+#  k = selected kernel, with its initial hyperparameters. The fitted
+#      hyperparameters are kept in KERNEL_CHOICE.
+#
+def select_kernel():
+
+    global KERNEL_CHOICE
+    fingerprint = training_fingerprint()
+    if (KERNEL_CHOICE is not None and KERNEL_CHOICE["fingerprint"] != fingerprint):
+        KERNEL_CHOICE = None
+    if (KERNEL_CHOICE is None and os.path.isfile(KERNEL_SELECT_FILE)):
+        sfile = open(KERNEL_SELECT_FILE, "r")
+        for line in sfile:
+            words = line.split()
+            if (len(words) == 3 and words[0] == "selected" and words[2] == fingerprint):
+                KERNEL_CHOICE = {"name" : words[1], "theta" : None, "fingerprint" : fingerprint}
+            elif (len(words) > 1 and words[0] == "theta" and KERNEL_CHOICE is not None):
+                KERNEL_CHOICE["theta"] = np.array(words[1:], dtype=float)
+        sfile.close()
+        if KERNEL_CHOICE is not None:
+            print("Kernel "+KERNEL_CHOICE["name"]+" (selected in "+KERNEL_SELECT_FILE+")")
+
+    if KERNEL_CHOICE is None:
+        X, Y = read_training_data()
+        # Partial P(x) values (see EARLY_ABORT) are left out
+        full = np.array([not cache_censored(x) for x in X], dtype=bool)
+        X, Y = X[full], Y[full]
+        nproc = GP_FIT_PROCS
+        if (nproc <= 0):
+            nproc = os.cpu_count()
+        print("Selecting kernel from %d candidates (%d points)" % (len(KERNEL_CANDIDATES), len(Y)))
+        try:
+            specs = [kernel_select.parse_kernel(name, NUM_PARAM) for name in KERNEL_CANDIDATES]
+        except ValueError as err:
+            print("ERROR: "+str(err)+"\n")
+            sys.exit("Error message")
+        results = kernel_select.select_kernels(gp_input(X), np.multiply(Y, YSCALE), KERNEL_CANDIDATES, nproc,
+                                               KERNEL_SELECT_RESTARTS)
+        if (KERNEL_SCORE == "lml"):
+            best = max(range(len(results)), key=lambda i: results[i]["lml"])
+        else:
+            best = max(range(len(results)), key=lambda i: results[i]["lpd"])
+        theta = kernel_select.sklearn_kernel(specs[best], results[best]["theta"]).theta
+
+        sfile = open(KERNEL_SELECT_FILE+".new", "w")
+        sfile.write("# %-28s %15s %15s %15s\n" % ("kernel", "lml", "loo lpd", "loo rmse"))
+        print(" %-28s %15s %15s %15s" % ("kernel", "lml", "loo lpd", "loo rmse"))
+        for r in results:
+            line = " %-28s %15.6f %15.6f %15.8f" % (r["name"], r["lml"], r["lpd"], r["rmse"])
+            sfile.write("#"+line+"\n")
+            print(line)
+        sfile.write("selected "+results[best]["name"]+" "+fingerprint+"\n")
+        sfile.write("theta"+"".join(" %.16g" % v for v in theta)+"\n")
+        sfile.close()
+        run_journal.replace_file(KERNEL_SELECT_FILE+".new", KERNEL_SELECT_FILE)
+        KERNEL_CHOICE = {"name" : results[best]["name"], "theta" : theta, "fingerprint" : fingerprint}
+        print("Selected kernel "+KERNEL_CHOICE["name"]+" ("+KERNEL_SCORE+")")
+
+    spec = kernel_select.parse_kernel(KERNEL_CHOICE["name"], NUM_PARAM)
+    return kernel_select.sklearn_kernel(spec, kernel_select.initial_theta(spec))
+
+#
+# set_acquisition_state: Set the reference values of the acquisition
+# function (ACQ_STATE) for a set of training values
+# Input:
+#  Y     = training values
+#  ncols = number of parameters
+#
+def set_acquisition_state(Y, ncols):
+    ACQ_STATE["ybest"] = np.min(Y)
+    if (LCB_SCHEDULE == "gpucb"):
+        ACQ_STATE["kappa"] = np.sqrt(2.0 * np.log(len(Y)**(ncols / 2.0 + 2.0) * np.pi**2 / (3.0 * LCB_DELTA)))
+    else:
+        ACQ_STATE["kappa"] = LCB_KAPPA
+    if (ACQUISITION == "lcb"):
+        print(" Acquisition function: lcb, kappa = %.3f" % ACQ_STATE["kappa"])
+    elif (ACQUISITION != "mean"):
+        print(" Acquisition function: "+ACQUISITION)
+
+#
+# stage_guess: Copy the stored scratch files of the nearest point into the
+# QChem scratch directory of a job, and have QChem read its guess.
+# Input:
+#  molec = molecule
+#  var   = parameters of the job
+#  wdir  = work directory of the job (holding <molec>.input)
+#
+def stage_guess(molec, var, wdir):
+
+    if not (GUESS_REUSE):
+        return
+
+    savedir = wdir+"/qcscratch/"+molec+".save"
+    if os.path.isdir(savedir):
+        shutil.rmtree(savedir)
+
+    load_guess_store()
+    stored = GUESS_STORE.get(molec, [])
+    if (len(stored) == 0):
+        return
+
+    dist = [np.linalg.norm(np.log(stored[i][1]) - np.log(var)) for i in range(len(stored))]
+    i = int(np.argmin(dist))
+    if not add_rem_variable(wdir+"/"+molec+".input", "scf_guess", "read"):
+        return
+    shutil.copytree(GUESS_STORE_DIR+"/"+molec+"/"+str(stored[i][0]), savedir)
+    print("Guess for "+molec+" from stored point %d (distance %.5f)" % (stored[i][0], dist[i]))
+
+    # Most recently used last
+    stored.append(stored.pop(i))
+    write_guess_store_index()
+
+#
+# start_qchem_process: Launch QChem in the work directory of a job without
+# waiting for it to finish.
+# Input:
+#  job      = job description from create_pjob_dir
+#  nthreads = number of threads for the job
+# Output:
+#  proc = running process
+#  outf = open output file of the process
+#
+def start_qchem_process(job, nthreads):
+
+    molec = job["molec"]
+
+    outf = open(job["dir"]+"/"+qchem_stdout(molec), "w")
+    proc = subprocess.Popen(qchem_command(molec, nthreads),
+                            stdout=outf, stderr=subprocess.STDOUT,
+                            cwd=job["dir"], env=qchem_env(nthreads, job["dir"]))
+    job["nthreads"] = nthreads
+    job["start"] = time.time()
+
+    return proc, outf
+
+#
+# store_guess: Keep the scratch files of a finished QChem job. The least
+# recently used points are removed once there are GUESS_STORE_SIZE points.
+# Input:
+#  molec = molecule
+#  var   = parameters of the job
+#  wdir  = work directory of the job
+#
+def store_guess(molec, var, wdir):
+
+    if not (GUESS_REUSE):
+        return
+
+    savedir = wdir+"/qcscratch/"+molec+".save"
+    qout = qchem_output.parse_qchem_output(wdir+"/"+molec+".output")
+    if (qout["error"] or not qout["normal_termination"] or not os.path.isdir(savedir)):
+        return
+
+    load_guess_store()
+    stored = GUESS_STORE.setdefault(molec, [])
+    gid = 0
+    for entry in stored:
+        gid = max(gid, entry[0] + 1)
+    while (len(stored) >= GUESS_STORE_SIZE):
+        shutil.rmtree(GUESS_STORE_DIR+"/"+molec+"/"+str(stored[0][0]), ignore_errors=True)
+        stored.pop(0)
+
+    os.makedirs(GUESS_STORE_DIR+"/"+molec, exist_ok=True)
+    shutil.move(savedir, GUESS_STORE_DIR+"/"+molec+"/"+str(gid))
+    stored.append((gid, np.array(var, dtype=float)))
+    write_guess_store_index()
+
+#
+# training_fingerprint: Number of lines and checksum of training.dat
+#
+def training_fingerprint():
+    if (TRAINING_STORE != "" and load_training_store() is not None):
+        return training_store.fingerprint(load_training_store())
+    if not os.path.isfile("training.dat"):
+        return "none"
+    tfile = open("training.dat", "rb")
+    data = tfile.read()
+    tfile.close()
+    return "%d:%08x" % (data.count(b"\n"), zlib.crc32(data))
+
+#
+# train_component_model: Train the GP model of each component of P(x) (see
+# SURROGATE), on the training points of COMPONENT_FILE where the current
+# components are known. As in train_gp_model, points are added to the model of a
+# component without refitting the hyperparameters for GP_REFIT_EVERY - 1
+# iterations.
+# Input:
+#  X      = training points of P(x) (transformed as the GP input)
+#  Y      = training values of P(x) (scaled)
+#  kernel = kernel
+# Output:
+#  gp = component model (see component_gp.py), None if fewer than
+#       COMPONENT_MIN_COVERAGE of the training points (or fewer than two)
+#       have all components
+#
+def train_component_model(X, Y, kernel):
+
+    data = read_component_data()
+    terms = component_terms()
+    cols = [data["names"].index(name) for name in terms]
+    Xt = np.array(data["X"]).reshape(-1, NUM_PARAM)
+    Yt = np.array(data["Y"]).reshape(-1, len(data["names"]))[:,cols]
+    train = set(cache_key(x) for x in read_training_data()[0])
+    known = np.all(np.isfinite(Yt), axis=1) & np.array([cache_key(x) in train for x in Xt], dtype=bool)
+    Xt = Xt[known]
+    Yt = Yt[known]
+    if (Xt.shape[0] < 2 or Xt.shape[0] < COMPONENT_MIN_COVERAGE * X.shape[0]):
+        print("Components of %d of %d training points in %s, training the GP model of P(x)" %
+              (Xt.shape[0], X.shape[0], COMPONENT_FILE))
+        return None
+    if (USE_XINV):
+        Xt = np.divide(1, Xt)
+
+    models = []
+    for j in range(len(terms)):
+        fingerprint = gp_data_fingerprint(Xt, Yt[:,j])
+        state = COMPONENT_MODELS.get(terms[j])
+        if (state is not None and state["fingerprint"] != fingerprint):
+            gp = None
+            if (state["iters"] + 1 < GP_REFIT_EVERY):
+                gp = gp_extend(state["gp"], Xt, Yt[:,j])
+            if gp is not None:
+                state = {"fingerprint" : fingerprint, "iters" : state["iters"] + 1, "gp" : gp}
+            else:
+                print("Training GP model of component "+terms[j])
+                gp = fit_gp_hyperparameters(Xt, Yt[:,j], kernel, state["gp"].kernel_.theta)
+                state = {"fingerprint" : fingerprint, "iters" : 0, "gp" : gp}
+        elif state is None:
+            print("Training GP model of component "+terms[j])
+            state = {"fingerprint" : fingerprint, "iters" : 0, "gp" : fit_gp_hyperparameters(Xt, Yt[:,j], kernel)}
+        COMPONENT_MODELS[terms[j]] = state
+        models.append(state["gp"])
+
+    weights = [YSCALE * PENFCN_WEIGHTS[name.split(":")[1].replace("_", " ")] for name in terms]
+    print("Component GP model: %d components, %d of %d training points" % (len(terms), Xt.shape[0], X.shape[0]))
+    return component_gp.ComponentSumGP(models, terms, weights, X, Xt, Yt)
+
+#
+# train_gp_model: Train the GP model on the training data. The hyperparameters
+# are optimized every GP_REFIT_EVERY calls, or when the log marginal
+# likelihood per point drops by more than GP_LML_DRIFT. Otherwise the model
+# of the last call is extended with the new points (see gp_extend). With
+# GP_BACKEND = "sparse" the hyperparameters and noise are fit to the sparse
+# model's bound from the last hyperparameters and GP_RESTARTS other starts.
+# The model of the last call is read from GP_MODEL_FILE at the first call,
+# and used as it is if the training data has not changed.
+# Input:
+#  X      = training points
+#  Y      = training values
+#  kernel = kernel (initial hyperparameters)
+# Output:
+#  gp = trained GP model
+#
+def train_gp_model(X, Y, kernel):
+
+    global GP_STATE
+    n = X.shape[0]
+    fingerprint = gp_data_fingerprint(X, Y)
+
+    # A model of another kernel (see select_kernel) is not extended
+    if (GP_STATE is not None and GP_STATE["kernel"] != str(kernel)):
+        print("Kernel changed, refitting the GP model")
+        GP_STATE = None
+
+    if GP_STATE is None:
+        GP_STATE = load_gp_model(kernel)
+        if (GP_STATE is not None and GP_STATE["fingerprint"] == fingerprint):
+            print("Read GP model from "+GP_MODEL_FILE+" (training data unchanged)")
+            return GP_STATE["gp"]
+
+    if (GP_STATE is not None and GP_STATE["iters"] + 1 < GP_REFIT_EVERY):
+        gp = gp_extend(GP_STATE["gp"], X, Y)
+        if gp is not None:
+            lml = gp_log_marginal_likelihood(gp) / n
+            if (lml >= GP_STATE["lml"] - GP_LML_DRIFT):
+                GP_STATE["gp"] = gp
+                GP_STATE["iters"] = GP_STATE["iters"] + 1
+                GP_STATE["fingerprint"] = fingerprint
+                GP_STATE["saved"] = False
+                print("Added %d points to GP model (hyperparameters fit %d iterations ago)" %
+                      (n - GP_STATE["nfit"], GP_STATE["iters"]))
+                return gp
+            print("Log-marginal-likelihood per point dropped from %.3f to %.3f" % (GP_STATE["lml"], lml))
+
+    # Start from the hyperparameters of a selection made on the current
+    # training data, or from the last hyperparameters
+    theta0 = None
+    if (KERNEL_CHOICE is not None and KERNEL_CHOICE["theta"] is not None
+        and KERNEL_CHOICE["fingerprint"] == training_fingerprint()):
+        theta0 = KERNEL_CHOICE["theta"]
+    elif GP_STATE is not None:
+        theta0 = GP_STATE["gp"].kernel_.theta
+    elif os.path.isfile("coeff.dat"):
+        theta0 = np.atleast_1d(np.loadtxt("coeff.dat"))
+
+    if (GP_BACKEND == "sparse"):
+        gp = sparse_gp.SparseGPRegressor(kernel, n_inducing = SPARSE_GP_INDUCING, chunk_size = SPARSE_GP_CHUNK,
+                                           n_restarts = GP_RESTARTS)
+        gp.fit(X, Y, theta0)
+        print("Sparse GP model: %d inducing points, noise variance %.3e" % (gp.Z_.shape[0], gp.noise_))
+    else:
+        gp = fit_gp_hyperparameters(X, Y, kernel, theta0)
+    GP_STATE = {"gp" : gp, "kernel" : str(kernel), "iters" : 0, "nfit" : n,
+                "lml" : gp_log_marginal_likelihood(gp) / n, "fingerprint" : fingerprint, "saved" : False}
+    return gp
+
+#
+# train_gp_and_return_opt: Train the GP model and return optimized parameters and
+# GP results.
+# Output:
+#  var = parameters
+#  result = result of GP
+#  batch_var    = (optional) parameters of all BATCH_SIZE proposed points
+#  batch_result = (optional) GP prediction at each proposed point
+#
+def train_gp_and_return_opt(var, result, batch_var=None, batch_result=None):
+    
+    start_time = time.time()
+    
+    training_data_file = "training.dat"
+    testing_data_file  = "testing.dat"
+    gp_test_output     = "test.output"
+    
+    # Ensure training and testing files are present
+    if not (os.path.isfile(training_data_file) or (TRAINING_STORE != "" and os.path.isfile(TRAINING_STORE))):
+        print("ERROR: Missing training data file!\n")
+        sys.exit("Error message")
+    if not os.path.isfile(testing_data_file):
+        print("ERROR: Missing testing data file!\n")
+        sys.exit("Error message")
         
+    # Read in training points and testing points
+    X, Y = read_training_data()
+    test_data = np.atleast_2d(np.loadtxt(testing_data_file, usecols=range(NUM_PARAM + 1)))
+    # Partial P(x) values (see EARLY_ABORT) are not test values
+    full = [i for i in range(test_data.shape[0]) if not cache_censored(test_data[i,0:NUM_PARAM])]
+    if (len(full) < test_data.shape[0]):
+        print("Skipping %d censored testing points" % (test_data.shape[0] - len(full)))
+        test_data = test_data[full]
+    Xt = test_data[:,0:NUM_PARAM]
+    Yt = test_data[:,NUM_PARAM]
+    # Scale
+    Y = np.multiply(Y, YSCALE)
+    Yt = np.multiply(Yt, YSCALE)
+    
+    Xinv  = np.divide(1, X)
+    Xtinv = np.divide(1, Xt)
+    
+    XMor  = np.exp(-X  /10.0)
+    XtMor = np.exp(-Xt /10.0) 
+    
+    npoints_training = X.shape[0]
+    npoints_testing  = Xt.shape[0]
+
+    print("--------------------------------------------\n")
+    print("Training data:\n")
+    print(" Number of parameters (dimensions): %10d\n" % NUM_PARAM)
+    print(" Number of training points: %10d\n" % npoints_training)
+    print("Testing data:\n")
+    print(" Number of testing points: %10d\n" % npoints_testing)
+    print("--------------------------------------------\n")
+
+    print("\n Total time: %s seconds\n" % (time.time() - start_time))
+
+    # Kernel selection
+    k = build_kernel()
+
+    # Censored points are fit as lower bounds
+    Y = impute_censored_values(X, Y, k)
+
+    # Search the trust regions with their own GP models
+    if (TRUST_REGIONS > 0):
+        trust_region_search(np.atleast_2d(X), Y, k, var, result, batch_var, batch_result)
+        print("--- %s seconds ---" % (time.time() - start_time))
+        return
+
+    # Train model
+    optdat_file = open("opt.dat", "w")
+    result_file = open("result",  "w")
+    print("Training GP model")
+    Xfit = np.atleast_2d(X)
+    if (USE_XINV):
+        Xfit = np.atleast_2d(Xinv)
+    gp = None
+    if (SURROGATE == "components"):
+        gp = train_component_model(Xfit, Y, k)
+    if gp is None:
+        gp = train_mf_model(Xfit, Y, k)
+    
+    print("Log-marginal-likelihood (GP): %.3f" % gp_log_marginal_likelihood(gp))
+
+    f_coef = "coeff.dat"
+    np.savetxt(f_coef,gp.kernel_.theta,fmt="%.16f")
+    save_gp_model(k)
+    if (GP_TEXT_DUMP and isinstance(gp, GaussianProcessRegressor)):
+        np.savetxt("k.dat",gp.L_,fmt="%.16f")
+        np.savetxt("alpha.dat",gp.alpha_,fmt="%.16f")
+
+    
+    print("Prediction with GP model")
+    if not (USE_XINV):
+        y_pred, sigma = gp_prediction(gp, Xt)
+    else:
+        y_pred, sigma = gp_prediction(gp, Xtinv)
+    
+    ygp = np.column_stack((Yt, y_pred, sigma))
+    dpred = np.column_stack((Xt, ygp))
+    print("Save predicted points")
+    np.savetxt(gp_test_output, ygp)
+    rmse = np.sqrt(mse(Yt, y_pred))
+    print("RMSE = ", rmse)
+    print(" ----------------------------------\n")
+    sys.stdout.flush()
+
+    # Optimization
+    xmin, ymin = search_gp_minimum(gp, X, Y)
+    var[0:NUM_PARAM] = xmin
+    result[0] = ymin
+
+    # Choose the rest of the batch. Each proposed point is added to the
+    # training data with an assumed value, and the search is repeated. The
+    # believer value and the prediction at each point are those of the model
+    # with the earlier points of the batch. Xb holds the model inputs (see
+    # USE_XINV), Xs the parameters the searches start from.
+    if (batch_var is not None and BATCH_SIZE > 1):
+        batch_var.append(list(var))
+        batch_result.append(result[0])
+        Xb = Xfit
+        Xs = np.atleast_2d(X)
+        Yb = Y
+        gpb = gp
+        xb = np.atleast_2d(xmin)
+        if (USE_XINV):
+            xb = np.divide(1, xb)
+        for j in range(1, BATCH_SIZE):
+            if (BATCH_LIAR == "believer"):
+                lie = gp_prediction(gpb, xb)[0][0]
+            else:
+                lie = np.max(Y)
+            Xb = np.vstack((Xb, xb))
+            Xs = np.vstack((Xs, xmin))
+            Yb = np.append(Yb, lie)
+            gpb = gp_extend(gp, Xb, Yb)
+            if (gpb is None and isinstance(gp, component_gp.ComponentSumGP)):
+                Xterms = np.vstack((gp.X_terms_, xb))
+                Yterms = np.vstack((gp.Y_terms_, gp.split_values(xb, [lie])))
+                models = []
+                for i in range(len(gp.models)):
+                    model = GaussianProcessRegressor(kernel = gp.models[i].kernel_, optimizer = None,
+                                                     normalize_y = True)
+                    models.append(model.fit(Xterms, Yterms[:,i]))
+                gpb = component_gp.ComponentSumGP(models, gp.names, gp.weights, Xb, Xterms, Yterms)
+            elif (gpb is None and isinstance(gp, multi_fidelity.AutoregressiveGP)):
+                top = GaussianProcessRegressor(kernel = gp.kernel_, optimizer = None, normalize_y = True)
+                gpb = gp.with_top(top.fit(Xb, Yb - gp.rhos[-1] * gp.predict_level(Xb, len(gp.models) - 2)))
+            elif gpb is None:
+                gpb = GaussianProcessRegressor(kernel = gp.kernel_, optimizer = None, normalize_y = True)
+                gpb.fit(Xb, Yb)
+            print("Searching for batch point %d" % (j + 1))
+            xmin, ymin = search_gp_minimum(gpb, Xs, Yb, j)
+            xb = np.atleast_2d(xmin)
+            if (USE_XINV):
+                xb = np.divide(1, xb)
+            out, sigma = gp_prediction(gpb, xb)
+            batch_var.append(list(xmin))
+            batch_result.append(out[0])
+
     print("--- %s seconds ---" % (time.time() - start_time))
 
-        
+#
+# train_mf_model: Train the GP model of P(x) from all fidelities (see
+# FIDELITIES), as f_l(x) = rho_l f_(l-1)(x) + delta_l(x). The models of f_0
+# and of each delta_l are fit in turn, rho_l by least squares on the
+# training points of f_l. The model of delta at full P(x) is trained with
+# train_gp_model; those of the cheaper fidelities are kept in MF_LEVELS and
+# refit when their data change. Fidelities with fewer than two points are
+# left out. Without FIDELITIES this is train_gp_model.
+# Input:
+#  X      = training points (transformed as the GP input)
+#  Y      = training values (scaled)
+#  kernel = kernel
+# Output:
+#  gp = trained GP model
+#
+def train_mf_model(X, Y, kernel):
+
+    global MF_MODEL
+    models = []
+    rhos = []
+    levels = []
+    for level in range(len(FIDELITIES)):
+        data = read_fidelity_data(level)
+        if (len(data["Y"]) < 2):
+            continue
+        Xl = np.array(data["X"])
+        if (USE_XINV):
+            Xl = np.divide(1, Xl)
+        Yl = np.multiply(data["Y"], YSCALE)
+        if (len(models) > 0):
+            lower = multi_fidelity.AutoregressiveGP(models, rhos, levels).predict(Xl)
+            rhos.append(mf_scale(lower, Yl))
+            Yl = Yl - rhos[-1] * lower
+
+        fingerprint = gp_data_fingerprint(Xl, Yl)
+        state = MF_LEVELS.get(level)
+        if (state is None or state["fingerprint"] != fingerprint):
+            print("Training GP model of fidelity "+FIDELITIES[level]["name"]+" (%d points)" % len(Yl))
+            theta0 = None
+            if state is not None:
+                theta0 = state["gp"].kernel_.theta
+            state = {"fingerprint" : fingerprint, "gp" : fit_gp_hyperparameters(Xl, Yl, kernel, theta0)}
+            MF_LEVELS[level] = state
+        models.append(state["gp"])
+        levels.append(level)
+
+    if (len(models) == 0):
+        MF_MODEL = None
+        return train_gp_model(X, Y, kernel)
+
+    lower = multi_fidelity.AutoregressiveGP(models, rhos, levels).predict(X)
+    rhos.append(mf_scale(lower, Y))
+    top = train_gp_model(X, Y - rhos[-1] * lower, kernel)
+    MF_MODEL = multi_fidelity.AutoregressiveGP(models + [top], rhos, levels + [len(FIDELITIES)])
+    print("Multi-fidelity GP model: fidelities "+", ".join(fidelity_name(l) for l in MF_MODEL.levels)+
+          ", rho = "+", ".join("%.4f" % rho for rho in rhos))
+    return MF_MODEL
+
+#
+# trust_region_minimum: Minimum of the acquisition function of a GP model
+# within a box, by L-BFGS-B from the center of the box and NMIN_SEARCH - 1
+# random points in it
+# Input:
+#  gp     = trained GP model
+#  center = center of the box (GP input)
+#  bnds   = bounds of the box (GP input)
+# Output:
+#  umin = minimum (GP input)
+#  acq  = acquisition function at the minimum
+#
+def trust_region_minimum(gp, center, bnds):
+
+    fun, jac = gp_search_objective(gp)
+    starts = [center]
+    for j in range(1, max(1, NMIN_SEARCH)):
+        starts.append(np.random.uniform(bnds[:,0], bnds[:,1]))
+    umin = None
+    acq = np.inf
+    for u0 in starts:
+        res = minimize(fun, u0, method="L-BFGS-B", jac=jac, bounds=bnds, args=gp)
+        if (res.fun < acq or umin is None):
+            umin = res.x
+            acq = float(np.ravel(res.fun)[0])
+    return umin, acq
+
+#
+# trust_region_model: GP model and search box of a trust region
+# Input:
+#  region = trust region (see load_trust_regions)
+#  U      = training points (GP input)
+#  Y      = training values (scaled)
+#  ubnds  = bounds of the GP input
+#  kernel = kernel
+# Output:
+#  gp   = GP model of the training points near the region
+#  bnds = bounds of the box (GP input)
+#
+def trust_region_model(region, U, Y, ubnds, kernel):
+
+    # Points within twice the box, or the TR_MIN_POINTS nearest
+    width = ubnds[:,1] - ubnds[:,0]
+    c = (gp_input(region["center"]) - ubnds[:,0]) / width
+    dist = np.max(np.abs((U - ubnds[:,0]) / width - c), axis=1)
+    near = dist <= region["length"]
+    if (np.sum(near) < min(TR_MIN_POINTS, len(Y))):
+        near = dist <= np.sort(dist)[min(TR_MIN_POINTS, len(Y)) - 1]
+    gp = fit_gp_hyperparameters(U[near], Y[near], kernel)
+
+    # Box sides scaled by the length scales, with the volume of a cube of
+    # side length
+    w = np.ones(NUM_PARAM)
+    base = getattr(gp.kernel_, "k2", None)
+    if (base is not None and np.size(getattr(base, "length_scale", 1.0)) == NUM_PARAM):
+        w = np.asarray(base.length_scale) / width
+        w = w / np.prod(w)**(1.0 / NUM_PARAM)
+    half = 0.5 * region["length"] * w
+    lo = np.clip(c - half, 0.0, 1.0)
+    hi = np.clip(c + half, 0.0, 1.0)
+    bnds = np.column_stack((ubnds[:,0] + lo * width, ubnds[:,0] + hi * width))
+    region["bounds"] = bnds
+    print(" Trust region %d: side %.4f, best %s, %d points" %
+          (region["id"], region["length"], "%.8f" % region["best"] if np.isfinite(region["best"]) else "-",
+           np.sum(near)))
+    return gp, bnds
+
+#
+# trust_region_search: Propose the points of an iteration in the trust
+# regions (see TRUST_REGIONS). Each point is the minimum of the acquisition
+# function in the box whose minimum is lowest; the GP model of that box is
+# then extended with the BATCH_LIAR value at the point, and its minimum
+# searched again.
+# Input:
+#  X      = training points
+#  Y      = training values (scaled)
+#  kernel = kernel
+# Output:
+#  var          = first proposed point
+#  result       = predicted P(x) at var
+#  batch_var    = (optional) parameters of all BATCH_SIZE proposed points
+#  batch_result = (optional) GP prediction at each proposed point
+#
+def trust_region_search(X, Y, kernel, var, result, batch_var=None, batch_result=None):
+
+    regions = load_trust_regions(X, Y)
+    U = gp_input(X)
+    ubnds = np.sort(gp_input(np.array(get_param_bounds(), dtype=float)), axis=1)
+    set_acquisition_state(Y, NUM_PARAM)
+
+    models = []
+    cands = []
+    for region in regions:
+        gp, bnds = trust_region_model(region, U, Y, ubnds, kernel)
+        models.append(gp)
+        cands.append(trust_region_minimum(gp, gp_input(region["center"]), bnds))
+    fits = list(models)
+
+    nbatch = max(1, BATCH_SIZE)
+    for k in range(nbatch):
+        j = int(np.argmin([cand[1] for cand in cands]))
+        gp = models[j]
+        umin = cands[j][0]
+        ymin = gp_prediction(fits[j], umin)[0][0]
+        xmin = list(gp_output(umin))
+        regions[j]["pending"].append(xmin)
+        print(" Point %d from trust region %d: P(x) = %15.8f" % (k + 1, regions[j]["id"], ymin))
+        if (k == 0):
+            var[0:NUM_PARAM] = xmin
+            result[0] = ymin
+        if (batch_var is not None and nbatch > 1):
+            batch_var.append(xmin)
+            batch_result.append(ymin)
+        if (k == nbatch - 1):
+            break
+
+        # Assumed value at the point
+        if (BATCH_LIAR == "believer"):
+            lie = ymin
+        else:
+            lie = np.max(Y)
+        Xb = np.vstack((gp.X_train_, umin))
+        Yb = np.append(gp.y_train_ * gp._y_train_std + gp._y_train_mean, lie)
+        gpb = gp_extend(gp, Xb, Yb)
+        if gpb is None:
+            gpb = GaussianProcessRegressor(kernel = gp.kernel_, optimizer = None, normalize_y = True)
+            gpb.fit(Xb, Yb)
+        models[j] = gpb
+        cands[j] = trust_region_minimum(gpb, umin, regions[j]["bounds"])
+
+    write_trust_regions(regions)
+
+#
+# write_guess_store_index: Write the index of stored guesses
+# (molecule, id, parameters), least recently used first
+#
+def write_guess_store_index():
+    os.makedirs(GUESS_STORE_DIR, exist_ok=True)
+    gfile = open(GUESS_STORE_DIR+"/index.dat", "w")
+    for molec in GUESS_STORE:
+        for entry in GUESS_STORE[molec]:
+            gfile.write("%s %d" % (molec, entry[0]))
+            for v in entry[1]:
+                gfile.write(" %.5f" % v)
+            gfile.write("\n")
+    gfile.close()
+
+#
+# write_trust_regions: Write the trust regions and the points they proposed
+# to TR_STATE_FILE
+# Input:
+#  regions = trust regions (see load_trust_regions)
+#
+def write_trust_regions(regions):
+    tfile = open(TR_STATE_FILE+".new", "w")
+    for region in regions:
+        tfile.write("region %d %.16g %d %d %.16g" % (region["id"], region["length"], region["nsucc"],
+                                                    region["nfail"], region["best"]))
+        tfile.write("".join(" %.16g" % v for v in region["center"])+"\n")
+        for x in region["pending"]:
+            tfile.write("point"+"".join(" %.16g" % v for v in x)+"\n")
+    tfile.close()
+    run_journal.replace_file(TR_STATE_FILE+".new", TR_STATE_FILE)
+
+#
+# write_training_text: Write training.dat from the training data store
+# Input:
+#  store = training data store
+#  start = first row to append to training.dat (None = rewrite all rows)
+#
+def write_training_text(store, start=None):
+
+    f_training = "training.dat"
+    rows = training_store.read_rows(store)
+    if start is None:
+        text = "".join(training_store.text_lines(rows, NUM_PARAM)).encode()
+        tfile = open(f_training+".new", "wb")
+        tfile.write(text)
+        tfile.close()
+        run_journal.replace_file(f_training+".new", f_training)
+        crc = zlib.crc32(text)
+    else:
+        text = "".join(training_store.text_lines(rows[start:], NUM_PARAM)).encode()
+        tfile = open(f_training, "ab")
+        tfile.write(text)
+        tfile.flush()
+        os.fsync(tfile.fileno())
+        tfile.close()
+        crc = zlib.crc32(text, store["text_crc"])
+    training_store.set_text_size(store, os.path.getsize(f_training), rows.shape[0], crc)
+
+#
+# write_training_inputs: Write the QChem inputs of a set of points in one
+# pass. Without MAKE_TRAINING_DIRS the inputs are <molec>.input.<i> and the
+# parameters var.<i>, in the current directory. With MAKE_TRAINING_DIRS
+# they are written to <i>/var.<i> and <i>/<molec>/<molec>.input, with the
+# nbox and benchmark files of each system (read once, or hard-linked with
+# TRAINING_TREE_LINKS).
+# Input:
+#  var = parameters of each point
+#
+def write_training_inputs(var):
+
+    # Files needed in each system directory: (source, name in directory)
+    shared = {}
+    if (MAKE_TRAINING_DIRS):
+        for msys in MOLEC_SYS:
+            molec = msys[0]
+            shared[molec] = []
+            for src, dst in [(molec+".nbox_npts.txt", "nbox_npts.txt"),
+                             (molec+".nbox_data.txt", "nbox_data.txt"),
+                             (molec+"_dens.benchmark.data", molec+"_dens.benchmark.data"),
+                             (molec+"_states.benchmark.data", molec+"_states.benchmark.data"),
+                             (molec+"_excitedstates.data", molec+"_excitedstates.data")]:
+                if not os.path.isfile(src):
+                    continue
+                data = None
+                if not (TRAINING_TREE_LINKS):
+                    sfile = open(src, "rb")
+                    data = sfile.read()
+                    sfile.close()
+                shared[molec].append((src, dst, data))
+
+    for i in range(len(var)):
+        if not (MAKE_TRAINING_DIRS):
+            save_var_to_indexed_file(var[i], i)
+            for msys in MOLEC_SYS:
+                input_file = open(msys[0]+".input."+str(i), "w")
+                input_file.write(qchem_input_text(msys[0], var[i]))
+                input_file.close()
+            continue
+
+        os.makedirs(str(i), exist_ok=True)
+        save_var_to_indexed_file(var[i], i, str(i))
+        for msys in MOLEC_SYS:
+            molec = msys[0]
+            mdir = str(i)+"/"+molec
+            os.makedirs(mdir, exist_ok=True)
+            input_file = open(mdir+"/"+molec+".input", "w")
+            input_file.write(qchem_input_text(molec, var[i]))
+            input_file.close()
+            for src, dst, data in shared[molec]:
+                if os.path.lexists(mdir+"/"+dst):
+                    os.remove(mdir+"/"+dst)
+                if data is None:
+                    try:
+                        os.link(src, mdir+"/"+dst)
+                        continue
+                    except OSError:
+                        sfile = open(src, "rb")
+                        data = sfile.read()
+                        sfile.close()
+                dfile = open(mdir+"/"+dst, "wb")
+                dfile.write(data)
+                dfile.close()
+
+    print("Wrote inputs for %d points" % len(var))
+
+
 
 
 #
@@ -1248,6 +4461,8 @@ def train_gp_and_return_opt(var, result):
 #
 if __name__ == "__main__":
     
+    # Results of an interrupted run
+    load_run_journal()
 
     # Generate initial data set
     if (JOBTYPE == "gen_training" or JOBTYPE == "all"):
@@ -1262,20 +4477,29 @@ if __name__ == "__main__":
     if (JOBTYPE == "collect_training" and MAKE_TRAINING_DIRS == True):
         collect_training_dataset(INIT_DATA_SIZE, NUM_PARAM)
         
+    # Predict with the saved GP model
+    if (JOBTYPE == "predict"):
+        predict_gp_model()
+
     # Fit GP model and obtain optimized parameters from these results.
     if (JOBTYPE == "run_gpr" or JOBTYPE == "all"):
         var = [0.0] * NUM_PARAM
         result = [0.0] * 1
         rmse = [0.0] * 1
 
-        # Check penalty function evaluation
+        # Points that were already evaluated
+        if data_config_matches():
+            load_training_cache()
+            load_penfcn_cache("testing.dat")
+            load_penfcn_cache(CENSORED_FILE, True)
+
+        # Check penalty function evaluation. (QChem is always run here.)
         if (CHECK_PENFCN):
-            X_test = np.loadtxt("training.dat", usecols=range(NUM_PARAM))
-            Y_test = np.loadtxt("training.dat", usecols=(NUM_PARAM,))
+            X_test, Y_test = read_training_data()
             pt = np.random.randint(0, Y_test.shape)
             test_val = [0.0] * 1
             test_var = X_test[pt,0:NUM_PARAM].tolist()
-            test_val[0] = objective_function_value(test_var[0])
+            test_val[0] = evaluate_penalty_function(test_var[0], use_cache=False, full=True)[0]
             print("Penalty function test at point "+str(pt))
             print("Parameters: "+str(test_var[0]))
             print("  P(x) = %15.8f\n" % test_val[0])
@@ -1283,27 +4507,79 @@ if __name__ == "__main__":
             print("\n")
          
         
+        check_fidelities()
+        if (SURROGATE == "components" and len(FIDELITIES) > 0):
+            print("ERROR: SURROGATE = components is not used with FIDELITIES!\n")
+            sys.exit("Error message")
+
         gpr_reliable = False
         iter = 1
         while (iter < MAX_ITER):
             
             # Train GP and return minimzation results and RMSE.
             # If the RMSE is good, this is our minimum. Leave loop.
-            train_gp_and_return_opt(var, result)
+            batch_var = []
+            batch_gp = []
+            proposal = journal_pending_proposal()
+            if proposal is not None:
+                print("Evaluating points proposed before the restart (see "+RUN_JOURNAL+")")
+                var[0:NUM_PARAM] = proposal["var"]
+                result[0] = proposal["gp"]
+                for point in proposal["batch"]:
+                    batch_var.append(point[0])
+                    batch_gp.append(point[1])
+            else:
+                train_gp_and_return_opt(var, result, batch_var, batch_gp)
+                journal_proposal(var, result[0], batch_var, batch_gp)
+
+                # Evaluate the proposed points at a cheaper fidelity while
+                # the model is uncertain there
+                if (BUILD_SURFACE and MF_MODEL is not None):
+                    level = choose_fidelity(MF_MODEL, var)
+                    if (level < len(FIDELITIES)):
+                        if (len(batch_var) > 1):
+                            evaluate_penalty_fidelity(batch_var, level)
+                        else:
+                            evaluate_penalty_fidelity([list(var)], level)
+                        journal_commit()
+                        iter = iter + 1
+                        continue
 
             # Save the GP predicted minimum, and compute the objective
             # function at this point. Compute difference and print to
             # stdout.
             gpmin = result[0]
-            if (BUILD_SURFACE):
+            if (BUILD_SURFACE and len(batch_var) > 1):
+                # Evaluate the whole batch, and keep the lowest point
+                # where the GP prediction is reliable.
+                batch_val = evaluate_penalty_batch(batch_var)
+                append_training_data(batch_var, batch_val)
+                for k in range(len(batch_var)):
+                    diff = batch_gp[k] - batch_val[k]
+                    print("Batch point %d" % (k + 1))
+                    print("GP predicted minimum = %15.8f\n" % batch_gp[k])
+                    print("Computed minimum     = %15.8f\n" % batch_val[k])
+                    print("Difference           = %15.8f\n" % diff)
+                    # A partial P(x) (see EARLY_ABORT) is only a lower bound
+                    if (abs(diff) < PF_TOL and not cache_censored(batch_var[k])
+                        and (not gpr_reliable or batch_val[k] < result[0])):
+                        gpr_reliable = True
+                        var[0:NUM_PARAM] = batch_var[k]
+                        result[0] = batch_val[k]
+                if (gpr_reliable):
+                    break
+            elif (BUILD_SURFACE):
                 result[0] = objective_function_value(var)
                 diff = gpmin - result[0]
                 print("GP predicted minimum = %15.8f\n" % gpmin)
                 print("Computed minimum     = %15.8f\n" % result[0])
                 print("Difference           = %15.8f\n" % diff)
-                if ((abs(diff) < PF_TOL)):
+                if ((abs(diff) < PF_TOL and not cache_censored(var))):
                     gpr_reliable = True
                     break
+
+                # Update training data set
+                append_training_data([var], [result[0]])
             else:
                 # Create new input files
                 for i in range(len(MOLEC_SYS)):
@@ -1311,31 +4587,6 @@ if __name__ == "__main__":
                 
                 break
             
-            # Update training and testing data sets. (They are the same)
-            f_training = "training.dat"
-            f_testing  = "testing.dat"
-            X = np.loadtxt(f_training, usecols=range(NUM_PARAM))
-            Y = np.loadtxt(f_training, usecols=(NUM_PARAM,))
-            n_points_data, n_parameters_data = X.shape
-            # Add new parameters and results
-            a = np.array([var])
-            X = np.concatenate((X, a), axis=0)
-            b = np.array([result[0]])
-            Y = np.concatenate((Y, b), axis=0)
-            data = np.column_stack((X,Y))
-            # Build format string
-            fmtstr = ""
-            for v in range(NUM_PARAM):
-                fmtstr = fmtstr+" %10.5f"
-            
-            fmtstr = fmtstr+" %12.8f"
-            # save old training and testing data files
-            command_line("cp training.dat training.dat_prev")
-            #command_line("cp testing.dat testing.dat_prev")
-            # save results
-            np.savetxt(f_training, data, fmt=fmtstr)
-            #np.savetxt(f_testing,  data, fmt=fmtstr)
-            
             # Increment
             iter = iter + 1
         
@@ -1346,31 +4597,12 @@ if __name__ == "__main__":
                 print(" %10.5f" % var[i], end="")
             print(" %12.8f\n" % result[0])
 
-            # Update training and testing data sets
-            f_training = "training.dat"
-            f_testing  = "testing.dat"
-            X = np.loadtxt(f_training, usecols=range(NUM_PARAM))
-            Y = np.loadtxt(f_training, usecols=(NUM_PARAM,))
-            n_points_data, n_parameters_data = X.shape
-            # Add new parameters and results
-            a = np.array([var])
-            X = np.concatenate((X, a), axis=0)
-            b = np.array([result[0]])
-            Y = np.concatenate((Y, b), axis=0)
-            data = np.column_stack((X,Y))
-            # Build format string
-            fmtstr = ""
-            for v in range(NUM_PARAM):
-                fmtstr = fmtstr+" %10.5f"
-            
-            fmtstr = fmtstr+" %12.8f"
-            # save old training and testing data files
-            command_line("cp training.dat training.dat_prev")
-            #command_line("cp testing.dat testing.dat_prev")
-            # save results
-            np.savetxt(f_training, data, fmt=fmtstr)
+            # Update training data set (batch points are already saved)
+            if (BATCH_SIZE <= 1):
+                append_training_data([var], [result[0]])
             
         else:
             print("Need more points.\n")
 
+    print_cache_stats()
     print("Job complete.")
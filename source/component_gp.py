@@ -0,0 +1,87 @@
+import numpy as np
+
+#
+# GP model of a weighted sum of independent terms,
+#
+#  f(x) = sum_j w_j t_j(x)
+#
+# with one GP model of each term t_j. The prediction of f has mean
+# sum_j w_j m_j(x) and variance sum_j w_j^2 s_j(x)^2. The weights are only
+# used at prediction, so a model with other weights needs no retraining.
+#
+# The model has the attributes of GaussianProcessRegressor used by
+# basis_optimization.py (X_train_, kernel_, log_marginal_likelihood_value_,
+# predict). X_train_ are the training points of f, kernel_ is the kernel of
+# the first term.
+#
+
+class ComponentSumGP:
+
+    #
+    # Input:
+    #  models  = trained GP models of the terms
+    #  names   = name of each term
+    #  weights = weight of each term
+    #  X       = training points of f
+    #  Xt      = training points of the terms
+    #  Yt      = values of the terms at Xt, one column per term
+    #
+    def __init__(self, models, names, weights, X, Xt, Yt):
+        self.models = models
+        self.names = names
+        self.weights = np.asarray(weights, dtype=float)
+        self.X_train_ = X
+        self.X_terms_ = Xt
+        self.Y_terms_ = Yt
+        self.kernel_ = models[0].kernel_
+        self.log_marginal_likelihood_value_ = sum(m.log_marginal_likelihood_value_ for m in models)
+
+    #
+    # predict_terms: Prediction of each term
+    # Input:
+    #  X = points
+    # Output:
+    #  y_mean = mean of each term, one column per term
+    #  y_std  = standard deviation of each term, one column per term
+    #
+    def predict_terms(self, X):
+        X = np.atleast_2d(X)
+        y_mean = np.zeros((X.shape[0], len(self.models)))
+        y_std = np.zeros((X.shape[0], len(self.models)))
+        for j in range(len(self.models)):
+            y_mean[:,j], y_std[:,j] = self.models[j].predict(X, return_std=True)
+        return y_mean, y_std
+
+    #
+    # predict: Prediction of the weighted sum
+    # Input:
+    #  X          = points
+    #  return_std = also return the standard deviation
+    #
+    def predict(self, X, return_std=False):
+        y_mean, y_std = self.predict_terms(X)
+        if (return_std):
+            return y_mean @ self.weights, np.sqrt((y_std**2) @ (self.weights**2))
+        return y_mean @ self.weights
+
+    #
+    # split_values: Values of the terms at points where the weighted sum is
+    # known: the mean of the terms given the sum, t_j = m_j + w_j s_j^2 r /
+    # sum_k w_k^2 s_k^2, with r the difference of the sum from the predicted
+    # mean.
+    # Input:
+    #  X = points
+    #  Y = values of the weighted sum
+    # Output:
+    #  Yt = values of the terms, one column per term
+    #
+    def split_values(self, X, Y):
+        y_mean, y_std = self.predict_terms(X)
+        var = y_std**2 * self.weights**2
+        total = np.sum(var, axis=1)
+        share = np.full(var.shape, 1.0 / len(self.models))
+        known = total > 0.0
+        share[known] = var[known] / total[known][:, np.newaxis]
+        r = np.asarray(Y) - y_mean @ self.weights
+        wt = np.where(self.weights != 0.0, self.weights, np.inf)
+        return y_mean + r[:, np.newaxis] * share / wt
@@ -5,6 +5,7 @@ import sys
 import time
 import subprocess
 import shlex
+import shutil
 import numpy as np
 
 from sklearn.gaussian_process import GaussianProcessRegressor
@@ -99,6 +100,10 @@ PROGRAM_HOME = "/home/clm96/pi_project/software/basis_opt/malbon_optimizer/ml_ba
 
 # Number of OMP Threads
 NTHREADS = os.getenv("OMP_NUM_THREADS")
+
+# Modules from source/
+sys.path.insert(0, PROGRAM_HOME+"/source")
+import qchem_output
 #---------------------------------------------------------------------
 
 
@@ -125,10 +130,8 @@ def command_line(command):
 #  molec = System  
 #
 def create_nbox_files(molec):
-    cmdl_arg = "cp "+molec+".nbox_npts.txt nbox_npts.txt"
-    command_line(cmdl_arg)
-    cmdl_arg = "cp "+molec+".nbox_data.txt nbox_data.txt"
-    command_line(cmdl_arg)
+    shutil.copy(molec+".nbox_npts.txt", "nbox_npts.txt")
+    shutil.copy(molec+".nbox_data.txt", "nbox_data.txt")
 
 
 #
@@ -148,8 +151,10 @@ def create_qchem_file(molec, var):
     deck_fname = molec+".input_deck"
     qcin_fname = molec+".input"
     
-    command_line('''cp '''+deck_fname+''' '''+qcin_fname)
-    input_file = open(qcin_fname, "a")
+    deck_file = open(deck_fname, "r")
+    input_file = open(qcin_fname, "w")
+    input_file.write(deck_file.read())
+    deck_file.close()
     
     input_file.write("$neo_basis\nH    3\n")
     
@@ -217,7 +222,7 @@ def generate_initial_dataset(init_data_size, num_param, run):
             save_var_to_indexed_file(var[i], i)
             for j in range(len(MOLEC_SYS)):
                 create_qchem_file(MOLEC_SYS[j][0], var[i])
-                command_line("cp "+MOLEC_SYS[j][0]+".input "+MOLEC_SYS[j][0]+".input."+str(i))
+                shutil.copy(MOLEC_SYS[j][0]+".input", MOLEC_SYS[j][0]+".input."+str(i))
         
 
     # If all we require is inputs, leave
@@ -537,28 +542,11 @@ def qchem_job(var, molec, cjobtype, nstates):
     command_line(cdxz_prog+" den_p_0.cube "+str(cjobtype)+" > "+molec+"_dens.data")    
     
 
-    qfile = open(molec+".output", "r")
-    qf_lines = (qfile.read().splitlines())
-    qfile.close()
-    nlines = len(qf_lines)
-    estart_line = 0
-    for i in range(nlines):
-        # Loop through qchem output file to find the Final CI Energy
-        if "==== Final CI Energy ====" in str(qf_lines[i]):
-            estart_line = i
-            break
-    estart_line = estart_line + 1 # Adjust for first entry
-    # Now read data for each state
-    energy = []
-    for i in range(nstates):
-        e_line = qf_lines[estart_line + i]
-        e_line = e_line.replace(" CI Energy (au) Root #   "+str(i),"").strip()
-        energy.append(e_line)
-
-    efile = open(molec+"_states.data", "w")
-    for i in range(nstates):
-        efile.write("%s\n" % energy[i])
-    efile.close()
+    energies = qchem_output.parse_qchem_output(molec+".output")["energies"]
+    if (len(energies) < nstates):
+        print("Missing CI energies in "+molec+".output")
+        sys.exit("Error message")
+    qchem_output.write_states_file(molec+"_states.data", energies[0:nstates])
 
     # Save logs
     command_line("cat "+molec+".output >> qc."+molec+".log")
@@ -0,0 +1,163 @@
+import sys
+import numpy as np
+
+#
+# Read QChem cube files into NumPy arrays. This is the in-process version of
+# cubedata_into_training_data.x and returns the same data.
+#
+# Usage: cubedata.py [cube file name] [jobtype] [xy_disp]
+#  jobtype = 1 : x
+#          = 2 : x and z
+#          = 3 : x and y and z
+#          = 4 : xyz grid
+#
+
+#
+# read_cube_file: Read header and volumetric data of a cube file
+# Input:
+#  flname = cube file name
+# Output:
+#  start     = grid origin (3)
+#  disp_size = grid step along each axis (3)
+#  cubedata  = density, indexed [x, y, z]
+#
+def read_cube_file(flname):
+
+    cfile = open(flname, "r")
+
+    # Skip the two comment lines
+    cfile.readline()
+    cfile.readline()
+
+    # Number of atoms and grid origin
+    words = cfile.readline().split()
+    natoms = int(words[0])
+    start = np.array(words[1:4], dtype=float)
+
+    # Number of points and step along each axis
+    ndisps = np.zeros(3, dtype=int)
+    disp_size = np.zeros(3)
+    for i in range(3):
+        words = cfile.readline().split()
+        ndisps[i] = int(words[0])
+        disp_size[i] = float(words[i + 1])
+
+    # Skip the atom lines. (A negative atom count is followed by an extra line.)
+    for i in range(abs(natoms) + (1 if natoms < 0 else 0)):
+        cfile.readline()
+
+    # Volumetric data (x outermost, z innermost)
+    vals = np.array(cfile.read().split(), dtype=float)
+    cfile.close()
+
+    npts = ndisps[0] * ndisps[1] * ndisps[2]
+    if (len(vals) < npts):
+        print("Cube file is missing data: "+flname)
+        sys.exit("Error message")
+    cubedata = vals[0:npts].reshape(ndisps)
+
+    return start, disp_size, cubedata
+
+#
+# axis_density: Density along a line through the grid center
+# Input:
+#  cubedata  = density from read_cube_file
+#  axis      = 0 (x), 1 (y) or 2 (z)
+#  start     = grid origin
+#  disp_size = grid step
+#  xy_disp   = offset of the line from the center, in grid points
+# Output:
+#  dens = array of (coordinate, density)
+#
+def axis_density(cubedata, axis, start, disp_size, xy_disp):
+
+    n = cubedata.shape[axis]
+    mid = (n + 1) // 2 + xy_disp - 1
+
+    if (axis == 0):
+        line = cubedata[:, mid, mid]
+    elif (axis == 1):
+        line = cubedata[mid, :, mid]
+    else:
+        line = cubedata[mid, mid, :]
+
+    coord = start[axis] + disp_size[axis] * np.arange(n)
+    return np.column_stack((coord, line))
+
+#
+# cube_training_data: Density data used to train the model
+# Input:
+#  flname  = cube file name
+#  jobtype = 1 (x), 2 (x, z), 3 (x, y, z) or 4 (xyz grid)
+#  xy_disp = offset of the x and y lines from the grid center
+# Output:
+#  dens = array of (coordinate, density) for jobtypes 1-3, and of
+#         (x, y, z, density) for jobtype 4. The first grid point of each
+#         axis is dropped, and values are rounded to the precision of the
+#         text output of cubedata_into_training_data.x.
+#
+def cube_training_data(flname, jobtype, xy_disp=0):
+
+    start, disp_size, cubedata = read_cube_file(flname)
+
+    if (jobtype == 1):
+        dens = axis_density(cubedata, 0, start, disp_size, xy_disp)[1:]
+    elif (jobtype == 2):
+        dens = np.vstack((axis_density(cubedata, 0, start, disp_size, xy_disp)[1:],
+                          axis_density(cubedata, 2, start, disp_size, 0)[1:]))
+    elif (jobtype == 3):
+        dens = np.vstack((axis_density(cubedata, 0, start, disp_size, xy_disp)[1:],
+                          axis_density(cubedata, 1, start, disp_size, xy_disp)[1:],
+                          axis_density(cubedata, 2, start, disp_size, 0)[1:]))
+    elif (jobtype == 4):
+        axes = []
+        for i in range(3):
+            axes.append(round_text(start[i] + disp_size[i] * np.arange(1, cubedata.shape[i]), 5))
+        x, y, z = np.meshgrid(axes[0], axes[1], axes[2], indexing="ij")
+        dens = np.column_stack((x.reshape(-1), y.reshape(-1), z.reshape(-1),
+                                cubedata[1:, 1:, 1:].reshape(-1)))
+    else:
+        print("Invalid Job Type! "+str(jobtype))
+        sys.exit("Error message")
+
+    if (jobtype != 4):
+        dens[:, 0] = round_text(dens[:, 0], 5)
+    dens[:, -1] = round_text(dens[:, -1], 8)
+    return dens
+
+#
+# round_text: Round values as they are written with a number of decimals.
+# (np.round rounds the scaled value, which can go the other way at a
+# decimal tie, e.g. -0.924075.)
+# Input:
+#  vals = array of values
+#  ndec = number of decimals
+# Output:
+#  vals = rounded values
+#
+def round_text(vals, ndec):
+    return np.char.mod("%."+str(ndec)+"f", vals).astype(float)
+
+#
+# write_training_data: Write density data in the text format of
+# cubedata_into_training_data.x
+# Input:
+#  flname = output file name
+#  dens   = array from cube_training_data
+#
+def write_training_data(flname, dens):
+    fmtstr = "%20.5f" * (dens.shape[1] - 1) + "%20.8f"
+    np.savetxt(flname, dens, fmt=fmtstr)
+
+
+if __name__ == "__main__":
+    flname = "den_p_0.cube"
+    jobtype = 3
+    xy_disp = 0
+    if (len(sys.argv) > 1):
+        flname = sys.argv[1]
+    if (len(sys.argv) > 2):
+        jobtype = int(sys.argv[2])
+    if (len(sys.argv) > 3):
+        xy_disp = int(sys.argv[3])
+    write_training_data(sys.stdout, cube_training_data(flname, jobtype, xy_disp))
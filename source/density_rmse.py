@@ -0,0 +1,95 @@
+import sys
+import math
+import numpy as np
+
+#
+# RMS error between densities. This is the in-process version of
+# compute_rmse_density.x and compute_rmse_density_3D.x.
+#
+# Usage: density_rmse.py [qc file] [fgh file] [npoints]
+#
+
+# Reference densities and weights, read once per file name
+BENCHMARK_CACHE = {}
+
+#
+# create_weight_vector: Create weight vector based on value
+#  w(x) = 1 + tanh{(Max[f] - f(x))/ Max[f]} - tanh{(Max[f]-Min[f])/Max[f]}
+# Input:
+#  ref          = reference density
+#  tanh_weights = use w(x) above. Otherwise all weights are one, as in
+#                 compute_rmse_density.x.
+# Output:
+#  wts = weights
+#
+def create_weight_vector(ref, tanh_weights=False):
+
+    if not (tanh_weights):
+        return np.ones(ref.shape)
+
+    # As in find_max / find_min of compute_rmse_density.f90, the search
+    # starts from zero
+    max_val = max(np.max(ref), 0.0)
+    min_val = min(np.min(ref), 0.0)
+    return 1.0 + np.tanh((max_val - ref) / max_val) - math.tanh((max_val - min_val) / max_val)
+
+#
+# compute_rms_error: Compute the RMS error between densities and a
+# reference density.
+# Input:
+#  dens = density (npts), or a batch of densities (nbatch x npts)
+#  ref  = reference density (npts)
+#  wts  = weights (npts)
+# Output:
+#  rmse = RMS error (one per density of the batch)
+#
+def compute_rms_error(dens, ref, wts):
+    diff = np.asarray(dens) - ref
+    return np.sqrt(np.sum(wts * diff * diff, axis=-1) / ref.shape[0])
+
+#
+# read_density_file: Read the density (last column) of a density file
+# Input:
+#  flname = density file
+#  npts   = number of points
+# Output:
+#  dens = density
+#
+def read_density_file(flname, npts):
+    data = np.loadtxt(flname, ndmin=2, max_rows=npts)
+    if (data.shape[0] < npts):
+        print("Error reading density file: "+flname)
+        sys.exit("Error message")
+    return data[:, -1]
+
+#
+# get_benchmark: Get the reference density and weights, reading the file
+# only the first time.
+# Input:
+#  flname       = benchmark density file
+#  npts         = number of points
+#  tanh_weights = see create_weight_vector
+# Output:
+#  ref = reference density
+#  wts = weights
+#
+def get_benchmark(flname, npts, tanh_weights=False):
+    key = (flname, npts, tanh_weights)
+    if key not in BENCHMARK_CACHE:
+        ref = read_density_file(flname, npts)
+        BENCHMARK_CACHE[key] = (ref, create_weight_vector(ref, tanh_weights))
+    return BENCHMARK_CACHE[key]
+
+
+if __name__ == "__main__":
+    qcden_file = "fhf_dens.data"
+    fghden_file = "fhf_dens.fgh.data"
+    npts = 64
+    if (len(sys.argv) > 1):
+        qcden_file = sys.argv[1]
+    if (len(sys.argv) > 2):
+        fghden_file = sys.argv[2]
+    if (len(sys.argv) > 3):
+        npts = int(sys.argv[3])
+    ref, wts = get_benchmark(fghden_file, npts)
+    print("%20.8f" % compute_rms_error(read_density_file(qcden_file, npts), ref, wts))
@@ -0,0 +1,324 @@
+import numpy as np
+import concurrent.futures
+import multiprocessing
+from scipy.linalg import cholesky, cho_solve
+from scipy.optimize import minimize
+from sklearn.gaussian_process.kernels import Matern, RBF, WhiteKernel, ConstantKernel as C, \
+    RationalQuadratic as RQ
+
+#
+# Automatic selection of the GP kernel.
+#
+# Each candidate kernel is named by a sum of terms, each a product of base
+# kernels, optionally with white noise:
+#
+#  rbf, rbf_ard, matern15, matern15_ard, matern25, matern25_ard, rq
+#  e.g. "matern25_ard+white", "rbf_ard+rq", "rbf_ard*rq"
+#
+# Each term has its own constant factor. The hyperparameters of all
+# candidates are fit in parallel processes, from one array of squared
+# differences of the training points (n (n - 1) / 2 pairs by parameter),
+# shared by the processes. The kernel matrix of a candidate and the
+# gradient of the log marginal likelihood are computed from it, without
+# recomputing distances. The candidates are scored by log marginal
+# likelihood and by the closed-form leave-one-out predictive probability
+# (Rasmussen and Williams, sec. 5.4.2).
+#
+
+# Bounds of the hyperparameters
+BOUNDS = (1.0e-5, 1.0e+5)
+
+# Noise added to the diagonal, as GaussianProcessRegressor
+JITTER = 1.0e-10
+
+# Base kernels: initial value of the extra hyperparameter (RQ alpha)
+FAMILIES = {"rbf" : None, "matern15" : None, "matern25" : None, "rq" : 0.1}
+
+# Training data shared with the processes of select_kernels
+DATA = None
+
+#
+# parse_kernel: Structure of a candidate kernel
+# Input:
+#  name = kernel name
+#  d    = number of parameters
+# Output:
+#  spec = dictionary with "name", "terms" (list of terms, each a list of
+#         (family, ard)), "white" and "d"
+#
+def parse_kernel(name, d):
+    spec = {"name" : name, "terms" : [], "white" : False, "d" : d}
+    for term in name.split("+"):
+        if (term == "white"):
+            spec["white"] = True
+            continue
+        factors = []
+        for factor in term.split("*"):
+            family = factor
+            ard = factor.endswith("_ard")
+            if (ard):
+                family = factor[:-4]
+            if (family not in FAMILIES or (ard and family == "rq")):
+                raise ValueError("unknown kernel "+factor+" in "+name)
+            factors.append((family, ard))
+        spec["terms"].append(factors)
+    if (len(spec["terms"]) == 0):
+        raise ValueError("no kernel terms in "+name)
+    return spec
+
+#
+# initial_theta: Initial hyperparameters of a kernel (log): for each term
+# the constant, then for each factor the length scales and RQ alpha; then
+# the noise
+#
+def initial_theta(spec):
+    theta = []
+    for term in spec["terms"]:
+        theta.append(0.0)
+        for family, ard in term:
+            theta.extend([0.0] * (spec["d"] if ard else 1))
+            if FAMILIES[family] is not None:
+                theta.append(np.log(FAMILIES[family]))
+    if (spec["white"]):
+        theta.append(np.log(0.1))
+    return np.array(theta)
+
+#
+# sklearn_kernel: sklearn kernel of a candidate
+# Input:
+#  spec  = kernel structure from parse_kernel
+#  theta = hyperparameters (log, as initial_theta)
+#
+def sklearn_kernel(spec, theta):
+    p = np.exp(theta)
+    i = 0
+    kernel = None
+    for term in spec["terms"]:
+        k = C(p[i], BOUNDS)
+        i = i + 1
+        for family, ard in term:
+            nl = spec["d"] if ard else 1
+            ls = p[i:i + nl] if ard else p[i]
+            i = i + nl
+            if (family == "rbf"):
+                k = k * RBF(length_scale=ls, length_scale_bounds=BOUNDS)
+            elif (family == "matern15"):
+                k = k * Matern(length_scale=ls, length_scale_bounds=BOUNDS, nu=1.5)
+            elif (family == "matern25"):
+                k = k * Matern(length_scale=ls, length_scale_bounds=BOUNDS, nu=2.5)
+            else:
+                k = k * RQ(length_scale=ls, alpha=p[i], length_scale_bounds=BOUNDS, alpha_bounds=BOUNDS)
+                i = i + 1
+        if kernel is None:
+            kernel = k
+        else:
+            kernel = kernel + k
+    if (spec["white"]):
+        kernel = kernel + WhiteKernel(p[i], BOUNDS)
+    return kernel
+
+#
+# set_data: Set the training data shared by the fits (squared differences
+# of each pair of points, by parameter, and normalized values)
+# Input:
+#  X = training points
+#  y = training values
+#
+def set_data(X, y):
+    global DATA
+    X = np.atleast_2d(X)
+    n = X.shape[0]
+    iu = np.triu_indices(n, 1)
+    D2 = np.empty((len(iu[0]), X.shape[1]))
+    for j in range(X.shape[1]):
+        D2[:,j] = (X[iu[0],j] - X[iu[1],j])**2
+    y = np.asarray(y, dtype=float)
+    ystd = np.std(y)
+    if (ystd == 0.0):
+        ystd = 1.0
+    DATA = {"n" : n, "iu" : iu, "D2" : D2, "S" : np.sum(D2, axis=1), "y" : (y - np.mean(y)) / ystd,
+            "ystd" : ystd}
+
+#
+# base_kernel: Base kernel of the pairs of points, and its derivatives
+# Input:
+#  family = base kernel
+#  ard    = one length scale per parameter
+#  p      = its hyperparameters (log)
+# Output:
+#  k    = kernel of each pair
+#  dr2  = derivative of k by r^2 (squared distance scaled by length scales)
+#  r2   = r^2
+#  dalp = (rq) derivative of k by log alpha, None otherwise
+#
+def base_kernel(family, ard, p):
+    if (ard):
+        r2 = DATA["D2"] @ np.exp(-2.0 * p[0:DATA["D2"].shape[1]])
+    else:
+        r2 = DATA["S"] * np.exp(-2.0 * p[0])
+    dalp = None
+    if (family == "rbf"):
+        k = np.exp(-0.5 * r2)
+        dr2 = -0.5 * k
+    elif (family == "matern15"):
+        r = np.sqrt(3.0 * r2)
+        e = np.exp(-r)
+        k = (1.0 + r) * e
+        dr2 = -1.5 * e
+    elif (family == "matern25"):
+        r = np.sqrt(5.0 * r2)
+        e = np.exp(-r)
+        k = (1.0 + r + r**2 / 3.0) * e
+        dr2 = -5.0 / 6.0 * (1.0 + r) * e
+    else:
+        alpha = np.exp(p[-1])
+        b = 1.0 + r2 / (2.0 * alpha)
+        k = b**(-alpha)
+        dr2 = -0.5 * b**(-alpha - 1.0)
+        dalp = k * alpha * (-np.log(b) + r2 / (2.0 * alpha * b))
+    return k, dr2, r2, dalp
+
+#
+# log_marginal_likelihood: Log marginal likelihood of a candidate and its
+# gradient, from the data of set_data
+# Input:
+#  theta = hyperparameters (log)
+#  spec  = kernel structure from parse_kernel
+#  loo   = also return the leave-one-out scores
+# Output:
+#  lml  = log marginal likelihood
+#  grad = gradient by theta
+#  (loo) lpd  = leave-one-out log predictive probability
+#  (loo) rmse = leave-one-out RMSE (of the values given to set_data)
+#
+def log_marginal_likelihood(theta, spec, loo=False):
+
+    n = DATA["n"]
+    iu = DATA["iu"]
+    d = spec["d"]
+
+    # Kernel of the pairs, and the contributions to the gradient:
+    # (index in theta, pair derivative, diagonal derivative) or, for
+    # length scales, (index, pair factor, ard, diagonal 0)
+    kp = np.zeros(len(iu[0]))
+    diag = JITTER
+    parts = []
+    i = 0
+    for term in spec["terms"]:
+        c = np.exp(theta[i])
+        ic = i
+        i = i + 1
+        bases = []
+        for family, ard in term:
+            nl = d if ard else 1
+            nb = nl + (1 if FAMILIES[family] is not None else 0)
+            bases.append((i, ard, nl) + base_kernel(family, ard, theta[i:i + nb]))
+            i = i + nb
+        t = c * np.prod([b[3] for b in bases], axis=0)
+        kp = kp + t
+        diag = diag + c
+        parts.append(("c", ic, t, c))
+        for j in range(len(bases)):
+            ib, ard, nl, k, dr2, r2, dalp = bases[j]
+            rest = c * np.prod([bases[m][3] for m in range(len(bases)) if m != j], axis=0)
+            parts.append(("l", ib, rest * dr2, (ard, nl, r2)))
+            if dalp is not None:
+                parts.append(("a", ib + nl, rest * dalp, 0.0))
+    if (spec["white"]):
+        noise = np.exp(theta[i])
+        diag = diag + noise
+        parts.append(("w", i, None, noise))
+
+    K = np.zeros((n, n))
+    K[iu] = kp
+    K = K + K.T
+    K[np.diag_indices(n)] = diag
+    try:
+        L = cholesky(K, lower=True, check_finite=False)
+    except np.linalg.LinAlgError:
+        if (loo):
+            return -np.inf, np.zeros(len(theta)), -np.inf, np.inf
+        return -np.inf, np.zeros(len(theta))
+    y = DATA["y"]
+    alpha = cho_solve((L, True), y, check_finite=False)
+    Kinv = cho_solve((L, True), np.eye(n), check_finite=False)
+    lml = -0.5 * np.dot(y, alpha) - np.sum(np.log(np.diag(L))) - 0.5 * n * np.log(2.0 * np.pi)
+
+    # d lml / d theta = tr(A dK) / 2, A = alpha alpha^T - K^-1
+    A = np.outer(alpha, alpha) - Kinv
+    Ap = A[iu]
+    Ad = np.trace(A)
+    grad = np.zeros(len(theta))
+    for kind, it, dp, extra in parts:
+        if (kind == "c"):
+            grad[it] = np.dot(Ap, dp) + 0.5 * Ad * extra
+        elif (kind == "a"):
+            grad[it] = np.dot(Ap, dp)
+        elif (kind == "w"):
+            grad[it] = 0.5 * Ad * extra
+        else:
+            ard, nl, r2 = extra
+            if (ard):
+                # d r2 / d log l_j = -2 D2_j / l_j^2
+                grad[it:it + nl] = -2.0 * ((Ap * dp) @ DATA["D2"]) * np.exp(-2.0 * theta[it:it + nl])
+            else:
+                grad[it] = -2.0 * np.dot(Ap * dp, r2)
+
+    if not (loo):
+        return lml, grad
+    kd = np.diag(Kinv)
+    r = alpha / kd
+    lpd = np.sum(0.5 * np.log(kd) - 0.5 * r**2 * kd - 0.5 * np.log(2.0 * np.pi))
+    return lml, grad, lpd, DATA["ystd"] * np.sqrt(np.mean(r**2))
+
+#
+# fit_candidate: Fit the hyperparameters of a candidate, from its initial
+# hyperparameters and random restarts
+# Input:
+#  args = (name, d, restarts, seed)
+# Output:
+#  result = dictionary with "name", "theta" (log, as initial_theta), "lml",
+#           "lpd" and "rmse" (see log_marginal_likelihood)
+#
+def fit_candidate(args):
+    name, d, restarts, seed = args
+    spec = parse_kernel(name, d)
+    theta0 = initial_theta(spec)
+    bounds = np.log(np.array([BOUNDS] * len(theta0)))
+    rng = np.random.default_rng(seed)
+    starts = [theta0] + [rng.uniform(bounds[:,0], bounds[:,1]) for j in range(restarts)]
+
+    best = None
+    for start in starts:
+        res = minimize(lambda t: tuple(-v for v in log_marginal_likelihood(t, spec)), start, jac=True,
+                       method="L-BFGS-B", bounds=bounds)
+        if (np.isfinite(res.fun) and (best is None or res.fun < best.fun)):
+            best = res
+    if best is None:
+        return {"name" : name, "theta" : theta0, "lml" : -np.inf, "lpd" : -np.inf, "rmse" : np.inf}
+    lml, grad, lpd, rmse = log_marginal_likelihood(best.x, spec, True)
+    return {"name" : name, "theta" : best.x, "lml" : lml, "lpd" : lpd, "rmse" : rmse}
+
+#
+# select_kernels: Fit and score candidate kernels
+# Input:
+#  X        = training points
+#  y        = training values
+#  names    = candidate kernels
+#  nproc    = number of processes
+#  restarts = random restarts of each fit
+# Output:
+#  results = result of fit_candidate for each candidate
+#
+def select_kernels(X, y, names, nproc, restarts):
+    set_data(X, y)
+    args = [(names[i], np.atleast_2d(X).shape[1], restarts, i) for i in range(len(names))]
+    nproc = max(1, min(nproc, len(names)))
+    if (nproc == 1):
+        return [fit_candidate(a) for a in args]
+    # Forked processes share DATA
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers = nproc,
+                                                  mp_context = multiprocessing.get_context("fork"))
+    results = list(pool.map(fit_candidate, args))
+    pool.shutdown()
+    return results
@@ -0,0 +1,278 @@
+import sys, getopt
+import os
+import math
+import time
+import zlib
+import numpy as np
+
+#
+# Synthetic stand-in for QChem. Used with QC_ENGINE = "mock" to exercise the
+# optimization pipeline without a QChem installation.
+#
+# Usage: mock_qchem.py [-nt nthreads] [-l latency] [-g npts] [-save] input [output [savename]]
+#
+#  nthreads = number of threads (only changes the artificial latency)
+#  latency  = single thread wall time in seconds
+#  npts     = number of cube grid points along each axis
+#  output   = output file (default: standard output)
+#  savename = scratch directory in $QCSCRATCH, kept with -save
+#
+# The output has a "==== Final CI Energy ====" block and den_p_0.cube is
+# written to the current directory. Both are smooth, deterministic functions
+# of the basis exponents in the $neo_basis section of the input.
+#
+# With -save the exponents are written to guess.dat in the scratch
+# directory. If the input has SCF_GUESS = READ and a guess.dat is found, the
+# latency is shortened the closer the guess exponents are to the input.
+#
+
+# Fraction of the latency that does not scale with threads
+SERIAL_FRACTION = 0.1
+
+# Number of CI roots printed
+NROOTS = 10
+
+# Smallest fraction of the latency left with a guess of the same exponents
+GUESS_SPEEDUP = 0.3
+
+# Half width of the cube grid (bohr)
+BOX_HALF_WIDTH = 1.6
+
+#
+# get_arguments_from_cmdl: Read command line arguments
+#
+def get_arguments_from_cmdl(argv):
+    nthreads = 1
+    latency = 0.0
+    npts = 50
+    save = False
+    # QChem takes "-nt" and "-save", which getopt sees as "-n" with
+    # argument "t" and "-s" with argument "ave"
+    argv = list(argv)
+    for i in range(len(argv)):
+        if (argv[i] == "-nt"):
+            argv[i] = "-n"
+        elif (argv[i] == "-save"):
+            argv[i] = "-s"
+    opts, args = getopt.getopt(argv,"n:l:g:s")
+    for opt, arg in opts:
+        if (opt == "-n"):
+            nthreads = int(arg)
+        elif (opt == "-l"):
+            latency = float(arg)
+        elif (opt == "-g"):
+            npts = int(arg)
+        elif (opt == "-s"):
+            save = True
+        else:
+            print ("Unknown option")
+            sys.exit()
+    if (len(args) < 1 or len(args) > 3):
+        print ("Missing input file")
+        sys.exit(1)
+    outname = None
+    savename = None
+    if (len(args) > 1):
+        outname = args[1]
+    if (len(args) > 2):
+        savename = args[2]
+    return (args[0], outname, savename, save, nthreads, latency, npts)
+
+#
+# read_neo_basis: Read the protonic basis from a QChem input file
+# Input:
+#  flname = QChem input file
+# Output:
+#  shells = list of (orbital type, [exponents])
+#
+def read_neo_basis(flname):
+    qfile = open(flname, "r")
+    qf_lines = (qfile.read().splitlines())
+    qfile.close()
+
+    shells = []
+    in_basis = False
+    i = 0
+    while i < len(qf_lines):
+        words = qf_lines[i].split()
+        i = i + 1
+        if (len(words) == 0):
+            continue
+        if (words[0].lower() == "$neo_basis"):
+            in_basis = True
+            continue
+        if not (in_basis):
+            continue
+        if (words[0].lower() == "$end" or words[0] == "****"):
+            break
+        # Shell header: type, number of primitives, scale
+        if (words[0].upper() in ["S", "P", "D", "F", "G", "H"] and len(words) == 3):
+            nprim = int(words[1])
+            exps = []
+            for j in range(nprim):
+                exps.append(float(qf_lines[i + j].replace("D", "E").split()[0]))
+            i = i + nprim
+            shells.append((words[0].upper(), exps))
+
+    return shells
+
+#
+# read_guess_option: True if the input has SCF_GUESS = READ in $rem
+#
+def read_guess_option(flname):
+    qfile = open(flname, "r")
+    qf_lines = (qfile.read().splitlines())
+    qfile.close()
+
+    in_rem = False
+    for line in qf_lines:
+        words = line.replace("=", " ").lower().split()
+        if (len(words) == 0):
+            continue
+        if (words[0] == "$rem"):
+            in_rem = True
+        elif (words[0] == "$end"):
+            in_rem = False
+        elif (in_rem and len(words) > 1 and words[0] == "scf_guess" and words[1] == "read"):
+            return True
+    return False
+
+#
+# guess_latency_factor: Fraction of the latency left when starting from the
+# exponents of a guess
+# Input:
+#  shells = protonic basis from read_neo_basis
+#  guess  = exponents of the guess
+#
+def guess_latency_factor(shells, guess):
+    exps = []
+    for shell in shells:
+        exps.extend(shell[1])
+    if (len(exps) != len(guess)):
+        return 1.0
+    dist = np.linalg.norm(np.log(np.array(exps)) - np.log(np.array(guess)))
+    return GUESS_SPEEDUP + (1.0 - GUESS_SPEEDUP) * min(1.0, dist)
+
+#
+# reference_exponent: Exponent about which the synthetic surface of a
+# molecule is centered. Depends only on the molecule name.
+#
+def reference_exponent(molec):
+    return 2.0 + (zlib.crc32(molec.encode()) % 1000) / 200.0
+
+#
+# compute_energies: Synthetic CI root energies (au)
+# Input:
+#  molec  = molecule name
+#  shells = protonic basis from read_neo_basis
+# Output:
+#  energy = list of NROOTS energies
+#
+def compute_energies(molec, shells):
+    alpha0 = reference_exponent(molec)
+
+    # Basis error: log distance of each exponent (sorted within its
+    # angular momentum) from an even tempered reference set
+    err = {"S" : 0.0, "P" : 0.0, "D" : 0.0, "F" : 0.0, "G" : 0.0, "H" : 0.0}
+    for ltype in err:
+        exps = []
+        for shell in shells:
+            if (shell[0] == ltype):
+                exps.extend(shell[1])
+        exps = np.sort(np.array(exps))
+        for j in range(len(exps)):
+            ref = alpha0 * math.pow(2.5, j) * (1.0 + 0.5 * "SPDFGH".index(ltype))
+            err[ltype] = err[ltype] + (math.log(max(exps[j], 1.0e-8)) - math.log(ref))**2
+
+    e0 = -0.5 + 0.002 * err["S"] + 0.001 * (err["P"] + err["D"])
+    energy = [e0]
+    for k in range(1, NROOTS):
+        # Excited states are more sensitive to the higher angular momentum
+        energy.append(e0 + 0.02 * k + 0.002 * k * (err["P"] + err["D"] + err["F"]))
+
+    return energy
+
+#
+# write_cube_file: Write a synthetic proton density cube file
+# Input:
+#  flname = cube file name
+#  shells = protonic basis from read_neo_basis
+#  npts   = number of grid points along each axis
+#
+def write_cube_file(flname, shells, npts):
+    step = 2.0 * BOX_HALF_WIDTH / (npts - 1)
+    r = -BOX_HALF_WIDTH + step * np.arange(npts)
+    x, y, z = np.meshgrid(r, r, r, indexing="ij")
+    r2 = x * x + y * y + z * z
+
+    dens = np.zeros(r2.shape)
+    n = 0
+    for shell in shells:
+        for a in shell[1]:
+            n = n + 1
+            dens = dens + (1.0 / n) * math.pow(2.0 * a / math.pi, 1.5) * np.exp(-2.0 * a * r2)
+    if (n > 0):
+        dens = dens / np.sum(dens * step**3)
+
+    cfile = open(flname, "w")
+    cfile.write("Cube file generation utility\n")
+    cfile.write("outermost -> innermost: x, y, z\n")
+    cfile.write("%6d%13.8f%13.8f%13.8f\n" % (3, -BOX_HALF_WIDTH, -BOX_HALF_WIDTH, -BOX_HALF_WIDTH))
+    cfile.write("%6d%13.8f%13.8f%13.8f\n" % (npts, step, 0.0, 0.0))
+    cfile.write("%6d%13.8f%13.8f%13.8f\n" % (npts, 0.0, step, 0.0))
+    cfile.write("%6d%13.8f%13.8f%13.8f\n" % (npts, 0.0, 0.0, step))
+    cfile.write("%6d%13.8f%13.8f%13.8f%13.8f\n" % (2, 0.0, 0.0, 0.0, 1.7))
+    cfile.write("%6d%13.8f%13.8f%13.8f%13.8f\n" % (2, 0.0, 0.0, 0.0, -1.7))
+    cfile.write("%6d%13.8f%13.8f%13.8f%13.8f\n" % (1, 0.0, 0.0, 0.0, 0.0))
+    # x outermost, z innermost; four values per line
+    vals = dens.reshape(-1)
+    nfull = (len(vals) // 4) * 4
+    np.savetxt(cfile, vals[0:nfull].reshape(-1, 4), fmt="%20.8e", delimiter="")
+    if (nfull < len(vals)):
+        np.savetxt(cfile, vals[nfull:].reshape(1, -1), fmt="%20.8e", delimiter="")
+    cfile.close()
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    flname, outname, savename, save, nthreads, latency, npts = get_arguments_from_cmdl(sys.argv[1:])
+    molec = flname.split("/")[-1].split(".")[0]
+
+    shells = read_neo_basis(flname)
+
+    if outname is not None:
+        sys.stdout = open(outname, "w")
+
+    savedir = None
+    if savename is not None:
+        savedir = os.getenv("QCSCRATCH", ".")+"/"+savename
+
+    # Start from the guess exponents
+    if (savedir is not None and read_guess_option(flname) and os.path.isfile(savedir+"/guess.dat")):
+        latency = latency * guess_latency_factor(shells, np.loadtxt(savedir+"/guess.dat", ndmin=1))
+
+    # Artificial latency, scaled with threads (Amdahl's law)
+    time.sleep(latency * (SERIAL_FRACTION + (1.0 - SERIAL_FRACTION) / nthreads))
+
+    energy = compute_energies(molec, shells)
+    write_cube_file("den_p_0.cube", shells, npts)
+
+    if (save and savedir is not None):
+        os.makedirs(savedir, exist_ok=True)
+        exps = []
+        for shell in shells:
+            exps.extend(shell[1])
+        np.savetxt(savedir+"/guess.dat", np.array(exps))
+
+    print("                  Welcome to Q-Chem (mock engine)")
+    print(" Input file: "+flname)
+    print(" Number of threads: %d" % nthreads)
+    print(" Number of protonic basis functions: %d" % sum(len(s[1]) for s in shells))
+    print("")
+    print(" ==== Final CI Energy ====")
+    for k in range(NROOTS):
+        print(" CI Energy (au) Root #%4d %20.10f" % (k, energy[k]))
+    print("")
+    wall = time.time() - start_time
+    print(" Total job time:  %.2fs(wall), %.2fs(cpu) " % (wall, time.process_time()))
+    print(" Thank you very much for using Q-Chem.  Have a nice day.")
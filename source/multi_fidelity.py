@@ -0,0 +1,63 @@
+import numpy as np
+
+#
+# Autoregressive multi-fidelity GP model (Kennedy and O'Hagan 2000, fit
+# recursively as in Le Gratiet 2013). Level l of the model is
+#
+#  f_l(x) = rho_l f_{l-1}(x) + delta_l(x)
+#
+# with independent GP models of f_0 and of each delta_l. The levels are
+# ordered from the cheapest fidelity to the most expensive one, whose
+# prediction is that of the model.
+#
+# The model has the attributes of GaussianProcessRegressor used by
+# basis_optimization.py (X_train_, kernel_, log_marginal_likelihood_value_,
+# predict), taken from the most expensive level.
+#
+
+class AutoregressiveGP:
+
+    #
+    # Input:
+    #  models = trained GP models of f_0, delta_1, delta_2, ...
+    #  rhos   = rho_1, rho_2, ...
+    #  levels = fidelity of each model
+    #
+    def __init__(self, models, rhos, levels):
+        self.models = models
+        self.rhos = rhos
+        self.levels = levels
+        self.X_train_ = models[-1].X_train_
+        self.kernel_ = models[-1].kernel_
+        self.log_marginal_likelihood_value_ = sum(m.log_marginal_likelihood_value_ for m in models)
+
+    #
+    # predict_level: Prediction of level l
+    # Input:
+    #  X          = points
+    #  level      = level (index in models)
+    #  return_std = also return the standard deviation
+    #
+    def predict_level(self, X, level, return_std=False):
+        X = np.atleast_2d(X)
+        y_mean, y_std = self.models[0].predict(X, return_std=True)
+        y_var = y_std**2
+        for l in range(1, level + 1):
+            m, s = self.models[l].predict(X, return_std=True)
+            y_mean = self.rhos[l - 1] * y_mean + m
+            y_var = self.rhos[l - 1]**2 * y_var + s**2
+        if (return_std):
+            return y_mean, np.sqrt(y_var)
+        return y_mean
+
+    #
+    # predict: Prediction of the most expensive level
+    #
+    def predict(self, X, return_std=False):
+        return self.predict_level(X, len(self.models) - 1, return_std)
+
+    #
+    # with_top: Model with another GP model of the most expensive level
+    #
+    def with_top(self, model):
+        return AutoregressiveGP(self.models[:-1] + [model], self.rhos, self.levels)
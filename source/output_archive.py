@@ -0,0 +1,273 @@
+import os
+import sys
+import gzip
+
+#
+# Compressed, indexed archive of QChem outputs.
+#
+# Each entry (an output, or a cube file) is stored as one gzip member in
+# the pack file of its molecule, <dir>/<molec>.pack until the archive is
+# compacted. The pack files can be read with zcat. <dir>/index.dat has one
+# line per entry:
+#
+#  add <run id> <molec> <kind> <offset> <length> <parameters>
+#
+# a "del <molec> <offset>" line for each entry removed, and a
+# "pack <molec> <file>" line for each molecule whose pack file has been
+# compacted. Entries are found by molecule, kind and parameters, and read
+# with a single seek.
+#
+# Compaction writes new pack files under new names (<molec>.<n>.pack) and
+# then replaces the index, so that an interrupted compaction leaves the old
+# index and pack files in place.
+#
+# Usage: output_archive.py dir                 : list entries
+#        output_archive.py dir molec [kind] p1 p2 ... : print the last entry
+#                                                 for the parameters
+#
+
+# Open archives, keyed by directory
+ARCHIVES = {}
+
+#
+# open_archive: Read the index of an archive
+# Input:
+#  dirname = archive directory
+# Output:
+#  archive = dictionary with "dir", "entries" (list of entries, oldest
+#            first), "index" (last entry for each molecule, kind and
+#            parameters), "packs" (pack file of each compacted molecule)
+#            and "dead" (removed bytes of each pack file)
+#
+def open_archive(dirname):
+
+    if dirname in ARCHIVES:
+        return ARCHIVES[dirname]
+
+    archive = {"dir" : dirname, "entries" : [], "index" : {}, "packs" : {}, "dead" : {}}
+    flname = dirname+"/index.dat"
+    if os.path.isfile(flname):
+        removed = set()
+        entries = []
+        ifile = open(flname, "r")
+        for line in ifile:
+            words = line.split()
+            if (len(words) > 6 and words[0] == "add"):
+                entries.append({"run" : words[1], "molec" : words[2], "kind" : words[3],
+                                "offset" : int(words[4]), "length" : int(words[5]),
+                                "key" : " ".join(words[6:])})
+            elif (len(words) == 3 and words[0] == "del"):
+                removed.add((words[1], int(words[2])))
+            elif (len(words) == 3 and words[0] == "pack"):
+                archive["packs"][words[1]] = words[2]
+        ifile.close()
+        for entry in entries:
+            if (entry["molec"], entry["offset"]) in removed:
+                archive["dead"][entry["molec"]] = archive["dead"].get(entry["molec"], 0) + entry["length"]
+            else:
+                archive["entries"].append(entry)
+                archive["index"][(entry["molec"], entry["kind"], entry["key"])] = entry
+
+    ARCHIVES[dirname] = archive
+    return archive
+
+#
+# add_entry: Compress and add an entry
+# Input:
+#  archive = archive from open_archive
+#  run_id  = run id
+#  molec   = molecule
+#  kind    = output or cube
+#  key     = parameters, as a string
+#  data    = contents (bytes)
+#
+def add_entry(archive, run_id, molec, kind, key, data):
+
+    os.makedirs(archive["dir"], exist_ok=True)
+    packname = pack_file(archive, molec)
+    offset = 0
+    if os.path.isfile(packname):
+        offset = os.path.getsize(packname)
+
+    blob = gzip.compress(data, compresslevel=6)
+    pfile = open(packname, "ab")
+    pfile.write(blob)
+    pfile.close()
+
+    entry = {"run" : run_id, "molec" : molec, "kind" : kind,
+             "offset" : offset, "length" : len(blob), "key" : key}
+    archive["entries"].append(entry)
+    archive["index"][(molec, kind, key)] = entry
+    ifile = open(archive["dir"]+"/index.dat", "a")
+    ifile.write("add %s %s %s %d %d %s\n" % (run_id, molec, kind, offset, len(blob), key))
+    ifile.close()
+
+#
+# find_entry: Last entry for a molecule and parameters
+# Input:
+#  archive = archive from open_archive
+#  molec   = molecule
+#  key     = parameters, as written by add_entry
+#  kind    = output or cube
+# Output:
+#  entry = entry, None if not found
+#
+def find_entry(archive, molec, key, kind="output"):
+    return archive["index"].get((molec, kind, key))
+
+#
+# read_entry: Read and decompress an entry
+# Input:
+#  archive = archive from open_archive
+#  entry   = entry from find_entry
+# Output:
+#  data = contents (bytes)
+#
+def read_entry(archive, entry):
+    pfile = open(pack_file(archive, entry["molec"]), "rb")
+    pfile.seek(entry["offset"])
+    blob = pfile.read(entry["length"])
+    pfile.close()
+    return gzip.decompress(blob)
+
+#
+# evict_entries: Remove the oldest entries until the archive is no larger
+# than max_bytes. The pack files are rewritten once more than half of one
+# of them has been removed.
+# Input:
+#  archive   = archive from open_archive
+#  max_bytes = maximum compressed size of the entries
+#
+def evict_entries(archive, max_bytes):
+
+    total = 0
+    for entry in archive["entries"]:
+        total = total + entry["length"]
+    if (total <= max_bytes):
+        return
+
+    ifile = open(archive["dir"]+"/index.dat", "a")
+    while (total > max_bytes and len(archive["entries"]) > 0):
+        entry = archive["entries"].pop(0)
+        total = total - entry["length"]
+        if archive["index"].get((entry["molec"], entry["kind"], entry["key"])) is entry:
+            del archive["index"][(entry["molec"], entry["kind"], entry["key"])]
+        archive["dead"][entry["molec"]] = archive["dead"].get(entry["molec"], 0) + entry["length"]
+        ifile.write("del %s %d\n" % (entry["molec"], entry["offset"]))
+    ifile.close()
+
+    for molec in archive["dead"]:
+        packname = pack_file(archive, molec)
+        if (os.path.isfile(packname) and 2 * archive["dead"][molec] > os.path.getsize(packname)):
+            compact_archive(archive)
+            break
+
+#
+# compact_archive: Rewrite the pack files without removed entries, and
+# rewrite the index. The new pack files are written under new names and
+# synced, the index that refers to them replaces the old one, and only
+# then are the old pack files deleted.
+# Input:
+#  archive = archive from open_archive
+#
+def compact_archive(archive):
+
+    packs = dict(archive["packs"])
+    offsets = {}
+    for molec in archive["dead"]:
+        packname = pack_file(archive, molec)
+        if not os.path.isfile(packname):
+            continue
+        # <molec>.pack is generation 0, <molec>.<n>.pack generation n. A
+        # pack of the next generation left by an interrupted compaction is
+        # not in the index and is overwritten.
+        gen = 1
+        words = os.path.basename(packname).split(".")
+        if (len(words) > 2 and words[-2].isdigit()):
+            gen = int(words[-2]) + 1
+        packs[molec] = molec+"."+str(gen)+".pack"
+        old = open(packname, "rb")
+        new = open(archive["dir"]+"/"+packs[molec], "wb")
+        offset = 0
+        for entry in archive["entries"]:
+            if (entry["molec"] != molec):
+                continue
+            old.seek(entry["offset"])
+            new.write(old.read(entry["length"]))
+            offsets[id(entry)] = offset
+            offset = offset + entry["length"]
+        old.close()
+        new.flush()
+        os.fsync(new.fileno())
+        new.close()
+
+    ifile = open(archive["dir"]+"/index.dat.new", "w")
+    for molec in packs:
+        ifile.write("pack %s %s\n" % (molec, packs[molec]))
+    for entry in archive["entries"]:
+        ifile.write("add %s %s %s %d %d %s\n" % (entry["run"], entry["molec"], entry["kind"],
+                                                offsets.get(id(entry), entry["offset"]),
+                                                entry["length"], entry["key"]))
+    ifile.flush()
+    os.fsync(ifile.fileno())
+    ifile.close()
+    os.replace(archive["dir"]+"/index.dat.new", archive["dir"]+"/index.dat")
+    sync_dir(archive["dir"])
+
+    # The index now refers to the new pack files
+    old_packs = []
+    for molec in archive["dead"]:
+        if (packs.get(molec) != archive["packs"].get(molec)):
+            old_packs.append(pack_file(archive, molec))
+    for entry in archive["entries"]:
+        entry["offset"] = offsets.get(id(entry), entry["offset"])
+    archive["packs"] = packs
+    archive["dead"] = {}
+    for packname in old_packs:
+        os.remove(packname)
+
+#
+# pack_file: Path of the pack file of a molecule
+# Input:
+#  archive = archive from open_archive
+#  molec   = molecule
+# Output:
+#  packname = path of the pack file
+#
+def pack_file(archive, molec):
+    return archive["dir"]+"/"+archive["packs"].get(molec, molec+".pack")
+
+#
+# sync_dir: Flush the entries of a directory (renames) to disk
+# Input:
+#  dirname = directory
+#
+def sync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 2):
+        print("Usage: output_archive.py dir [molec [kind] p1 p2 ...]")
+        sys.exit(1)
+    archive = open_archive(sys.argv[1])
+    if (len(sys.argv) == 2):
+        for entry in archive["entries"]:
+            print("%-12s %-10s %-6s %10d %s" % (entry["run"], entry["molec"], entry["kind"],
+                                                entry["length"], entry["key"]))
+        sys.exit(0)
+    molec = sys.argv[2]
+    words = sys.argv[3:]
+    kind = "output"
+    if (len(words) > 0 and words[0] in ["output", "cube"]):
+        kind = words[0]
+        words = words[1:]
+    entry = find_entry(archive, molec, " ".join("%.5f" % float(w) for w in words), kind)
+    if entry is None:
+        print("No entry for "+molec+" at "+" ".join(words))
+        sys.exit(1)
+    sys.stdout.buffer.write(read_entry(archive, entry))
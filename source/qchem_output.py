@@ -0,0 +1,96 @@
+import os
+import re
+import mmap
+
+#
+# Parse QChem output files. The output is memory-mapped and scanned once
+# for the CI root energies, error markers, the normal termination banner
+# and the job time.
+#
+
+# Markers scanned for in the output
+QCHEM_OUTPUT_MARKERS = re.compile(
+    rb"(?P<ci>==== Final CI Energy ====)"
+    rb"|(?P<error>Error: in the serial run)"
+    rb"|(?P<banner>Thank you very much for using Q-Chem)"
+    rb"|Total job time:\s*(?P<wall>[0-9.]+)s\(wall\),\s*(?P<cpu>[0-9.]+)s\(cpu\)")
+
+# CI root energy line following the Final CI Energy marker
+CI_ENERGY_LINE = re.compile(rb"\s*CI Energy \(au\) Root #\s*(\d+)\s+(\S+)")
+
+# Parsed outputs, keyed by file name, modification time and size
+OUTPUT_CACHE = {}
+
+#
+# parse_qchem_output: Parse a QChem output file
+# Input:
+#  flname = QChem output file
+# Output:
+#  result = dictionary with
+#   "energies"           = CI root energies (au) of the first Final CI
+#                          Energy block, in root order
+#   "error"              = True if an error marker was found
+#   "normal_termination" = True if the closing banner was found
+#   "wall_time"          = total job wall time (s), None if not found
+#   "cpu_time"           = total job cpu time (s), None if not found
+#
+def parse_qchem_output(flname):
+
+    result = {"energies" : [], "error" : False, "normal_termination" : False,
+              "wall_time" : None, "cpu_time" : None}
+
+    if not os.path.isfile(flname):
+        return result
+
+    st = os.stat(flname)
+    key = (os.path.abspath(flname), st.st_mtime_ns, st.st_size)
+    if key in OUTPUT_CACHE:
+        return OUTPUT_CACHE[key]
+    if (st.st_size == 0):
+        return result
+
+    qfile = open(flname, "rb")
+    mm = mmap.mmap(qfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    found_ci = False
+    for m in QCHEM_OUTPUT_MARKERS.finditer(mm):
+        if m.group("ci") is not None:
+            if (found_ci):
+                continue
+            found_ci = True
+            # Read root energies from the lines after the marker
+            pos = mm.find(b"\n", m.end()) + 1
+            while pos > 0:
+                eol = mm.find(b"\n", pos)
+                if (eol < 0):
+                    eol = len(mm)
+                e = CI_ENERGY_LINE.match(mm[pos:eol])
+                if e is None:
+                    break
+                result["energies"].append(float(e.group(2)))
+                pos = eol + 1
+        elif m.group("error") is not None:
+            result["error"] = True
+        elif m.group("banner") is not None:
+            result["normal_termination"] = True
+        else:
+            result["wall_time"] = float(m.group("wall"))
+            result["cpu_time"] = float(m.group("cpu"))
+
+    mm.close()
+    qfile.close()
+
+    OUTPUT_CACHE[key] = result
+    return result
+
+#
+# write_states_file: Write CI root energies, one per line
+# Input:
+#  flname   = file name
+#  energies = energies to write
+#
+def write_states_file(flname, energies):
+    efile = open(flname, "w")
+    for e in energies:
+        efile.write("%s\n" % e)
+    efile.close()
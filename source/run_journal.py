@@ -0,0 +1,69 @@
+import os
+
+#
+# Append-only run journal. Each event is one line of words. Lines are
+# flushed and synced to disk before append_event returns, so an interrupted
+# run loses at most the event being written. Events that are no longer
+# needed are dropped by rewriting the journal (see rewrite_events).
+#
+
+#
+# append_event: Append an event to the journal
+# Input:
+#  flname = journal file
+#  words  = event, as a list of strings
+#
+def append_event(flname, words):
+    jfile = open(flname, "a")
+    jfile.write(" ".join(words)+"\n")
+    jfile.flush()
+    os.fsync(jfile.fileno())
+    jfile.close()
+
+#
+# read_events: Read the events of a journal. A last line without a newline
+# (a write that was interrupted) is ignored.
+# Input:
+#  flname = journal file
+# Output:
+#  events = list of events, each a list of strings
+#
+def read_events(flname):
+    events = []
+    if not os.path.isfile(flname):
+        return events
+    jfile = open(flname, "r")
+    for line in jfile:
+        if not line.endswith("\n"):
+            break
+        words = line.split()
+        if (len(words) > 0):
+            events.append(words)
+    jfile.close()
+    return events
+
+#
+# rewrite_events: Replace the events of a journal
+# Input:
+#  flname = journal file
+#  events = list of events, each a list of strings
+#
+def rewrite_events(flname, events):
+    jfile = open(flname+".new", "w")
+    for words in events:
+        jfile.write(" ".join(words)+"\n")
+    jfile.close()
+    replace_file(flname+".new", flname)
+
+#
+# replace_file: Replace a file by a new version once the new version is on
+# disk, so that an interrupted run leaves either the old or the new file
+# Input:
+#  new_flname = new version
+#  flname     = file to replace
+#
+def replace_file(new_flname, flname):
+    nfile = open(new_flname, "r+")
+    os.fsync(nfile.fileno())
+    nfile.close()
+    os.replace(new_flname, flname)
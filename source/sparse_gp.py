@@ -0,0 +1,311 @@
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular
+from scipy.optimize import minimize
+from scipy.spatial.distance import pdist
+from sklearn.cluster import MiniBatchKMeans
+
+#
+# Sparse GP regression with inducing points (variational free energy,
+# Titsias 2009). Used in place of sklearn's GaussianProcessRegressor for
+# large training sets: the cost is O(n m^2) time and O(m^2 + m c) memory
+# for n training points, m inducing points and chunks of c points.
+#
+# The model has the attributes of GaussianProcessRegressor used by
+# basis_optimization.py (kernel_, X_train_, alpha_,
+# log_marginal_likelihood_value_, predict). alpha_ holds the weights of the
+# inducing points Z_ rather than of the training points.
+#
+
+# Jitter added to the diagonal of the inducing point kernel matrix
+JITTER = 1.0e-8
+
+# Bounds of the noise variance (of the normalized values)
+NOISE_BOUNDS = (1.0e-6, 1.0)
+
+class SparseGPRegressor:
+
+    #
+    # Input:
+    #  kernel      = sklearn kernel
+    #  n_inducing  = number of inducing points
+    #  chunk_size  = training points per chunk of the kernel matrix
+    #  noise       = initial noise variance (of the normalized values)
+    #  optimizer   = optimize the hyperparameters in fit
+    #  n_restarts  = random restarts of the optimization
+    #  random_state = seed of the random restarts
+    #
+    def __init__(self, kernel, n_inducing=500, chunk_size=5000, noise=1.0e-3, optimizer=True,
+                 n_restarts=0, random_state=0):
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.chunk_size = chunk_size
+        self.noise = noise
+        self.optimizer = optimizer
+        self.n_restarts = n_restarts
+        self.random_state = random_state
+
+    #
+    # fit: Choose the inducing points (k-means centers of X) and fit the
+    # model. The optimization starts from theta0 and from length scales set
+    # to the median distance between the inducing points, each with the
+    # noise of the points not explained by the inducing points (see
+    # start_noise), and from n_restarts random points. The fit with the largest bound is kept, leaving out fits
+    # with the noise at its upper bound (a constant model) unless all are.
+    # Input:
+    #  X      = training points
+    #  y      = training values
+    #  theta0 = starting hyperparameters (None = those of the kernel)
+    #
+    def fit(self, X, y, theta0=None):
+
+        X = np.atleast_2d(X)
+        if (X.shape[0] <= self.n_inducing):
+            Z = np.copy(X)
+        else:
+            km = MiniBatchKMeans(n_clusters=self.n_inducing, random_state=0, n_init=3)
+            Z = km.fit(X).cluster_centers_
+
+        theta = self.kernel.theta
+        if theta0 is not None and len(theta0) == len(theta):
+            theta = np.clip(theta0, self.kernel.bounds[:,0], self.kernel.bounds[:,1])
+        return self._fit(X, y, Z, theta, self.noise, self.optimizer)
+
+    #
+    # data_theta: Hyperparameters of the kernel with the length scales set
+    # to the median distance between points (per dimension for a length
+    # scale per dimension)
+    # Input:
+    #  Z = points
+    #
+    def data_theta(self, Z):
+        theta = np.copy(self.kernel.theta)
+        i = 0
+        for hp in self.kernel.hyperparameters:
+            if hp.fixed:
+                continue
+            if (hp.name.endswith("length_scale") and Z.shape[0] > 1):
+                if (hp.n_elements == Z.shape[1]):
+                    scale = np.array([np.median(pdist(Z[:,[j]])) for j in range(Z.shape[1])])
+                else:
+                    scale = np.full(hp.n_elements, np.median(pdist(Z)))
+                known = scale > 0.0
+                theta[i:i+hp.n_elements][known] = np.log(scale[known])
+            i = i + hp.n_elements
+        return np.clip(theta, self.kernel.bounds[:,0], self.kernel.bounds[:,1])
+
+    #
+    # with_data: Model with the same hyperparameters and inducing points,
+    # fit to other training data
+    # Input:
+    #  X = training points
+    #  y = training values
+    #
+    def with_data(self, X, y):
+        gp = SparseGPRegressor(self.kernel, self.n_inducing, self.chunk_size, self.noise, self.optimizer)
+        return gp._fit(np.atleast_2d(X), y, self.Z_, self.kernel_.theta, self.noise_, False)
+
+    #
+    # start_noise: Starting noise variance of the optimization, the mean
+    # of diag(Kff - Qff) (at least noise). Starting from a smaller noise, the
+    # first step of the optimization can reach the largest noise and the
+    # smallest kernel variance, where the bound is flat.
+    # Input:
+    #  X     = training points
+    #  theta = kernel hyperparameters
+    #  noise = smallest starting noise variance
+    #
+    def start_noise(self, X, theta, noise):
+        kernel = self.kernel.clone_with_theta(theta)
+        Xc = X[0:self.chunk_size]
+        Kuu = kernel(self.Z_)
+        Kuu[np.diag_indices_from(Kuu)] += JITTER
+        try:
+            Luu = cholesky(Kuu, lower=True, check_finite=False)
+        except np.linalg.LinAlgError:
+            return noise
+        A = solve_triangular(Luu, kernel(self.Z_, Xc), lower=True, check_finite=False)
+        resid = np.mean(kernel.diag(Xc) - np.sum(A * A, axis=0))
+        return np.clip(max(noise, resid), NOISE_BOUNDS[0], NOISE_BOUNDS[1])
+
+    def _fit(self, X, y, Z, theta, noise, optimize):
+
+        y = np.asarray(y, dtype=float)
+        self._y_train_mean = np.mean(y)
+        self._y_train_std = np.std(y)
+        if (self._y_train_std == 0.0):
+            self._y_train_std = 1.0
+        yn = (y - self._y_train_mean) / self._y_train_std
+
+        self.X_train_ = X
+        self.Z_ = Z
+
+        if (optimize and self.kernel.n_dims > 0):
+            bounds = np.vstack((self.kernel.bounds, np.log(np.array([NOISE_BOUNDS]))))
+            starts = [np.append(theta, np.log(self.start_noise(X, theta, noise)))]
+            p = self.data_theta(Z)
+            if not np.allclose(p, theta):
+                starts.append(np.append(p, np.log(self.start_noise(X, p, noise))))
+            rng = np.random.RandomState(self.random_state)
+            for i in range(self.n_restarts):
+                starts.append(rng.uniform(bounds[:,0], bounds[:,1]))
+
+            fits = []
+            for p0 in starts:
+                res = minimize(self._negative_bound, p0, args=(X, yn), method="L-BFGS-B", jac=True,
+                               bounds=bounds)
+                if np.isfinite(res.fun):
+                    fits.append((res.fun, res.x))
+            if (len(fits) == 0):
+                raise np.linalg.LinAlgError("Sparse GP hyperparameter fits failed")
+            free = [fit for fit in fits if fit[1][-1] < bounds[-1,1] - 1.0e-6]
+            if (len(free) == 0):
+                print("WARNING: Sparse GP fit reached the largest noise variance (%g). The model is "
+                      "a constant." % NOISE_BOUNDS[1])
+                free = fits
+            best = min(free, key=lambda fit: fit[0])
+            theta = best[1][:-1]
+            noise = np.exp(best[1][-1])
+
+        self.kernel_ = self.kernel.clone_with_theta(theta)
+        self.noise_ = noise
+        self.log_marginal_likelihood_value_, self.Luu_, self.LB_, self.c_ = \
+            self._bound(X, yn, self.kernel_, noise)
+        # Normalized mean = k(X, Z) alpha_
+        self.alpha_ = solve_triangular(self.Luu_.T, solve_triangular(self.LB_.T, self.c_, lower=False),
+                                       lower=False)
+        return self
+
+    def _negative_bound(self, p, X, y):
+        try:
+            bound, grad = self._bound_gradient(X, y, self.kernel.clone_with_theta(p[:-1]), np.exp(p[-1]))
+            return -bound, -grad
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros(len(p))
+
+    #
+    # _bound: Variational lower bound of the log marginal likelihood
+    #  log N(y | 0, Qff + s I) - tr(Kff - Qff) / (2 s),  Qff = Kfu Kuu^-1 Kuf
+    # Input:
+    #  X      = training points
+    #  y      = normalized training values
+    #  kernel = kernel
+    #  noise  = noise variance s
+    # Output:
+    #  bound = lower bound
+    #  Luu   = Cholesky factor of Kuu
+    #  LB    = Cholesky factor of I + Luu^-1 Kuf Kfu Luu^-T / s
+    #  c     = LB^-1 Luu^-1 Kuf y / s
+    #
+    def _bound(self, X, y, kernel, noise):
+
+        Z = self.Z_
+        m = Z.shape[0]
+        n = X.shape[0]
+
+        Kuu = kernel(Z)
+        Kuu[np.diag_indices_from(Kuu)] += JITTER
+        Luu = cholesky(Kuu, lower=True, check_finite=False)
+
+        AAT = np.zeros((m, m))
+        Ay = np.zeros(m)
+        trK = 0.0
+        for start in range(0, n, self.chunk_size):
+            Xc = X[start:start + self.chunk_size]
+            A = solve_triangular(Luu, kernel(Z, Xc), lower=True, check_finite=False) / np.sqrt(noise)
+            AAT = AAT + A @ A.T
+            Ay = Ay + A @ y[start:start + self.chunk_size]
+            trK = trK + np.sum(kernel.diag(Xc))
+
+        B = AAT
+        B[np.diag_indices_from(B)] += 1.0
+        LB = cholesky(B, lower=True, check_finite=False)
+        c = solve_triangular(LB, Ay, lower=True, check_finite=False) / np.sqrt(noise)
+
+        bound = (-0.5 * n * np.log(2.0 * np.pi) - np.sum(np.log(np.diag(LB))) - 0.5 * n * np.log(noise)
+                 - 0.5 * np.dot(y, y) / noise + 0.5 * np.dot(c, c)
+                 - 0.5 * trK / noise + 0.5 * np.trace(AAT - np.eye(m)))
+        return bound, Luu, LB, c
+
+    #
+    # _bound_gradient: Bound and its gradient with respect to the kernel
+    # hyperparameters (theta) and log(noise). With Sigma = Qff + s I,
+    # a = Sigma^-1 y and P = Kuu^-1 Kuf,
+    #  dF = tr(G dKfu) - tr(H dKuu) / 2 - tr(dKff) / (2 s)
+    # for the kernel, with G = P W, H = P W P^T, W = a a^T + A^T B^-1 A / s,
+    # and
+    #  dF/dlog(s) = s (a^T a - tr Sigma^-1) / 2 + (tr Kff - tr Qff) / (2 s).
+    # The derivatives of k(Z, X) are taken from the kernel of Z and a chunk
+    # of X together, in chunks of no more than m points.
+    # Input:
+    #  X      = training points
+    #  y      = normalized training values
+    #  kernel = kernel
+    #  noise  = noise variance s
+    # Output:
+    #  bound = lower bound
+    #  grad  = gradient (kernel theta, then log(noise))
+    #
+    def _bound_gradient(self, X, y, kernel, noise):
+
+        bound, Luu, LB, c = self._bound(X, y, kernel, noise)
+        Z = self.Z_
+        m = Z.shape[0]
+        n = X.shape[0]
+        sq = np.sqrt(noise)
+        chunk = max(1, min(self.chunk_size, m))
+
+        # a = Sigma^-1 y = (y - sqrt(s) A^T v) / s, v = LB^-T c
+        v = solve_triangular(LB, c, lower=True, trans=1, check_finite=False)
+        alpha = np.zeros(n)
+        Aa = np.zeros(m)
+        AAT = np.zeros((m, m))
+        for start in range(0, n, chunk):
+            A = solve_triangular(Luu, kernel(Z, X[start:start + chunk]), lower=True, check_finite=False) / sq
+            alpha[start:start + chunk] = (y[start:start + chunk] - sq * (A.T @ v)) / noise
+            Aa = Aa + A @ alpha[start:start + chunk]
+            AAT = AAT + A @ A.T
+        Binv_AAT = np.linalg.solve(AAT + np.eye(m), AAT)
+
+        # G = u a^T + M A / sqrt(s), u = sqrt(s) Luu^-T A a, M = Luu^-T A A^T B^-1
+        u = sq * solve_triangular(Luu, Aa, lower=True, trans=1, check_finite=False)
+        M = solve_triangular(Luu, Binv_AAT.T, lower=True, trans=1, check_finite=False)
+        grad = np.zeros(len(kernel.theta) + 1)
+        trK = 0.0
+        for start in range(0, n, chunk):
+            K, dK = kernel(np.vstack((Z, X[start:start + chunk])), eval_gradient=True)
+            A = solve_triangular(Luu, K[:m, m:], lower=True, check_finite=False) / sq
+            G = np.outer(u, alpha[start:start + chunk]) + (M @ A) / sq
+            grad[:-1] = grad[:-1] + np.einsum("ij,ijk->k", G, dK[:m, m:, :])
+            grad[:-1] = grad[:-1] - np.einsum("iik->k", dK[m:, m:, :]) / (2.0 * noise)
+            trK = trK + np.trace(K[m:, m:])
+
+        # H = G P^T = sqrt(s) (u (A a)^T + M A A^T / sqrt(s)) Luu^-1
+        Kuu, dKuu = kernel(Z, eval_gradient=True)
+        H = sq * solve_triangular(Luu, (np.outer(u, Aa) + M @ AAT / sq).T, lower=True, trans=1,
+                                  check_finite=False).T
+        grad[:-1] = grad[:-1] - 0.5 * np.einsum("ij,ijk->k", H, dKuu)
+
+        # log(noise)
+        tr_sinv = (n - np.trace(Binv_AAT)) / noise
+        grad[-1] = 0.5 * noise * (np.dot(alpha, alpha) - tr_sinv) + 0.5 * (trK / noise - np.trace(AAT))
+        return bound, grad
+
+    #
+    # predict: Predicted mean and standard deviation (of the latent function)
+    # Input:
+    #  X          = points
+    #  return_std = also return the standard deviation
+    #
+    def predict(self, X, return_std=False):
+
+        X = np.atleast_2d(X)
+        Kus = self.kernel_(self.Z_, X)
+        t1 = solve_triangular(self.Luu_, Kus, lower=True, check_finite=False)
+        t2 = solve_triangular(self.LB_, t1, lower=True, check_finite=False)
+        y_mean = self._y_train_std * (t2.T @ self.c_) + self._y_train_mean
+        if not (return_std):
+            return y_mean
+
+        y_var = self.kernel_.diag(X) - np.sum(t1 * t1, axis=0) + np.sum(t2 * t2, axis=0)
+        y_var = np.maximum(y_var, 0.0)
+        return y_mean, self._y_train_std * np.sqrt(y_var)
@@ -0,0 +1,170 @@
+import os
+import sys
+import zlib
+import numpy as np
+
+#
+# Append-only binary store of training data.
+#
+# The file starts with a header of HEADER_SIZE bytes:
+#
+#  magic, number of parameters, number of components, number of committed
+#  rows, size, number of rows and checksum of the text export
+#
+# followed by one row of float64 per training point:
+#
+#  parameters, P(x), censored (0/1), components (nan if unknown)
+#
+# Rows are appended at the end of the committed rows, synced to disk, and
+# then committed by updating the row count in the header. Rows written by an
+# interrupted append are not committed and are overwritten by the next one.
+#
+# Usage: training_store.py file [-c] : print the rows as text (-c: also the
+#                                      censored flag and components)
+#
+
+# Header layout
+MAGIC = b"MLBOTRN1"
+HEADER = np.dtype([("magic", "S8"), ("nparam", "<i8"), ("ncomp", "<i8"), ("nrows", "<i8"),
+                   ("text_size", "<i8"), ("text_rows", "<i8"), ("text_crc", "<i8")])
+HEADER_SIZE = 64
+
+#
+# create_store: Create an empty store
+# Input:
+#  flname = store file
+#  nparam = number of parameters
+#  ncomp  = number of components
+# Output:
+#  store = dictionary with "flname", "nparam", "ncomp", "nrows",
+#          "text_size", "text_rows" and "text_crc"
+#
+def create_store(flname, nparam, ncomp):
+    store = {"flname" : flname, "nparam" : nparam, "ncomp" : ncomp, "nrows" : 0, "text_size" : 0,
+             "text_rows" : 0, "text_crc" : 0}
+    sfile = open(flname+".new", "wb")
+    sfile.write(header_bytes(store))
+    sfile.flush()
+    os.fsync(sfile.fileno())
+    sfile.close()
+    os.replace(flname+".new", flname)
+    return store
+
+#
+# open_store: Read the header of a store
+# Input:
+#  flname = store file
+# Output:
+#  store = dictionary as from create_store, None if the file is not a store
+#
+def open_store(flname):
+    sfile = open(flname, "rb")
+    data = sfile.read(HEADER_SIZE)
+    sfile.close()
+    if (len(data) < HEADER.itemsize):
+        return None
+    header = np.frombuffer(data[0:HEADER.itemsize], dtype=HEADER)[0]
+    if (header["magic"] != MAGIC):
+        return None
+    return {"flname" : flname, "nparam" : int(header["nparam"]), "ncomp" : int(header["ncomp"]),
+            "nrows" : int(header["nrows"]), "text_size" : int(header["text_size"]),
+            "text_rows" : int(header["text_rows"]), "text_crc" : int(header["text_crc"])}
+
+#
+# header_bytes: Header of a store
+#
+def header_bytes(store):
+    header = np.zeros(1, dtype=HEADER)
+    header["magic"] = MAGIC
+    for name in ["nparam", "ncomp", "nrows", "text_size", "text_rows", "text_crc"]:
+        header[name] = store[name]
+    return header.tobytes().ljust(HEADER_SIZE, b"\0")
+
+#
+# row_size: Number of values in each row
+#
+def row_size(store):
+    return store["nparam"] + 2 + store["ncomp"]
+
+#
+# read_rows: Committed rows, memory-mapped (read only)
+# Input:
+#  store = store from open_store
+# Output:
+#  rows = array of rows
+#
+def read_rows(store):
+    if (store["nrows"] == 0):
+        return np.zeros((0, row_size(store)))
+    return np.memmap(store["flname"], dtype="<f8", mode="r", offset=HEADER_SIZE,
+                     shape=(store["nrows"], row_size(store)))
+
+#
+# append_rows: Append and commit rows
+# Input:
+#  store = store from open_store
+#  rows  = array of rows
+#
+def append_rows(store, rows):
+    rows = np.ascontiguousarray(np.atleast_2d(rows), dtype="<f8")
+    if (rows.shape[1] != row_size(store)):
+        raise ValueError("rows of %d values in a store of %d" % (rows.shape[1], row_size(store)))
+    fd = os.open(store["flname"], os.O_RDWR)
+    os.pwrite(fd, rows.tobytes(), HEADER_SIZE + store["nrows"] * row_size(store) * 8)
+    os.fsync(fd)
+    store["nrows"] = store["nrows"] + rows.shape[0]
+    os.pwrite(fd, header_bytes(store), 0)
+    os.fsync(fd)
+    os.close(fd)
+
+#
+# set_text_size: Record the size of the text export
+# Input:
+#  store     = store from open_store
+#  text_size = size of the text export (bytes)
+#  text_rows = number of rows in the text export
+#  text_crc  = zlib.crc32 of the text export
+#
+def set_text_size(store, text_size, text_rows, text_crc):
+    store["text_size"] = text_size
+    store["text_rows"] = text_rows
+    store["text_crc"] = text_crc
+    fd = os.open(store["flname"], os.O_RDWR)
+    os.pwrite(fd, header_bytes(store), 0)
+    os.fsync(fd)
+    os.close(fd)
+
+#
+# fingerprint: Number of rows and checksum of the committed rows
+#
+def fingerprint(store):
+    return "%d:%08x" % (store["nrows"], zlib.crc32(np.ascontiguousarray(read_rows(store)).tobytes()))
+
+#
+# text_lines: Rows as text, in the format of training.dat (parameters and P(x))
+# Input:
+#  rows       = array of rows
+#  nparam     = number of parameters
+#  components = also write the censored flag and components
+# Output:
+#  lines = list of lines
+#
+def text_lines(rows, nparam, components=False):
+    lines = []
+    for row in rows:
+        line = "".join(" %10.5f" % v for v in row[0:nparam]) + " %12.8f" % row[nparam]
+        if (components):
+            line = line + " %d" % int(row[nparam + 1]) + "".join(" %15.8f" % v for v in row[nparam + 2:])
+        lines.append(line+"\n")
+    return lines
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 2):
+        print("Usage: training_store.py file [-c]")
+        sys.exit(1)
+    store = open_store(sys.argv[1])
+    if store is None:
+        print(sys.argv[1]+" is not a training data store")
+        sys.exit(1)
+    sys.stdout.writelines(text_lines(read_rows(store), store["nparam"], "-c" in sys.argv[2:]))
@@ -0,0 +1,166 @@
+import os
+import sys
+import subprocess
+import tempfile
+import numpy as np
+
+#
+# Check the in-process ports cubedata.py and density_rmse.py against the
+# Fortran programs on the test cube files.
+#
+# Usage: check_ports.py [directory of the .x programs]
+#
+# The programs are taken from bin/ (or source/) by default. Without
+# cubedata_into_training_data.x, cubedata.py is compared against the saved
+# output of the program in density_matching/hcn_dens_<i>.dat. Checks whose
+# program is missing are skipped. The exit status is 1 if a check fails.
+#
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "source"))
+import cubedata
+import density_rmse
+
+# Largest difference accepted. The programs print 8 decimals.
+TOL = 1.0e-8
+
+# Test cube files
+CUBE_FILES = [os.path.join(TEST_DIR, "cubedata_into_training_data", "den_p.cube")]
+for i in range(7):
+    CUBE_FILES.append(os.path.join(TEST_DIR, "density_matching", "den_p_"+str(i)+".cube"))
+
+#
+# compare: Print the largest difference between two arrays
+# Input:
+#  name = description of the check
+#  val  = values of the port
+#  ref  = values of the Fortran program
+# Output:
+#  ok = arrays have the same shape and differ by no more than TOL
+#
+def compare(name, val, ref):
+    val = np.asarray(val)
+    ref = np.asarray(ref)
+    if (val.shape != ref.shape):
+        print("FAILED  %-60s shape %s, expected %s" % (name, str(val.shape), str(ref.shape)))
+        return False
+    diff = np.max(np.abs(val - ref))
+    ok = diff <= TOL
+    print("%-7s %-60s max difference %.3e" % ("ok" if ok else "FAILED", name, diff))
+    return ok
+
+#
+# find_program: Find a Fortran program
+# Input:
+#  prog_dirs = directories to search
+#  name      = program name
+# Output:
+#  path to the program, None if not found
+#
+def find_program(prog_dirs, name):
+    for pdir in prog_dirs:
+        path = os.path.join(pdir, name)
+        if os.access(path, os.X_OK):
+            return path
+    print("Skipping checks of "+name+" (not found)")
+    return None
+
+#
+# run_program: Run a Fortran program and read the numbers it prints
+# Input:
+#  args = program and arguments
+# Output:
+#  values = array of the printed lines
+#
+def run_program(args):
+    out = subprocess.run(args, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return np.array([line.split() for line in out.splitlines() if len(line.split()) > 0], dtype=float)
+
+#
+# check_cubedata: Compare cubedata.py with cubedata_into_training_data.x
+# (or its saved output)
+# Input:
+#  prog = path to cubedata_into_training_data.x, None to use saved output
+# Output:
+#  ok = all checks passed
+#
+def check_cubedata(prog):
+    ok = True
+    if prog is None:
+        dmdir = os.path.join(TEST_DIR, "density_matching")
+        for i in range(7):
+            name = "den_p_"+str(i)+".cube jobtype 3 (saved output)"
+            ref = np.loadtxt(os.path.join(dmdir, "hcn_dens_"+str(i)+".dat"))
+            ok = compare(name, cubedata.cube_training_data(os.path.join(dmdir, "den_p_"+str(i)+".cube"), 3), ref) and ok
+        return ok
+
+    for flname in CUBE_FILES:
+        for jobtype in range(1, 5):
+            for xy_disp in (0, 1, -2):
+                name = "%s jobtype %d xy_disp %d" % (os.path.relpath(flname, TEST_DIR), jobtype, xy_disp)
+                ref = run_program([prog, flname, str(jobtype), str(xy_disp)])
+                ok = compare(name, cubedata.cube_training_data(flname, jobtype, xy_disp), ref) and ok
+    return ok
+
+#
+# check_density_rmse: Compare density_rmse.py with compute_rmse_density.x
+# (densities along the axes) and compute_rmse_density_3D.x (xyz grid). The
+# densities are written with cubedata.write_training_data.
+# Input:
+#  prog    = path to compute_rmse_density.x
+#  prog_3d = path to compute_rmse_density_3D.x
+# Output:
+#  ok = all checks passed
+#
+def check_density_rmse(prog, prog_3d):
+    ok = True
+    dmdir = os.path.join(TEST_DIR, "density_matching")
+    tmpdir = tempfile.TemporaryDirectory()
+
+    if prog is not None:
+        for i in range(4):
+            fghden_file = os.path.join(dmdir, "hcn_dens_"+str(i)+".fgh.dat")
+            for j in range(7):
+                qcden_file = os.path.join(tmpdir.name, "hcn_dens_"+str(j)+".data")
+                cubedata.write_training_data(qcden_file, cubedata.cube_training_data(
+                    os.path.join(dmdir, "den_p_"+str(j)+".cube"), 3))
+                for npts in (32, 64, 96):
+                    name = "den_p_%d.cube against hcn_dens_%d.fgh.dat, %d points" % (j, i, npts)
+                    ref = run_program([prog, qcden_file, fghden_file, str(npts)])[0,0]
+                    bench, wts = density_rmse.get_benchmark(fghden_file, npts)
+                    val = density_rmse.compute_rms_error(density_rmse.read_density_file(qcden_file, npts),
+                                                         bench, wts)
+                    ok = compare(name, val, ref) and ok
+
+    if prog_3d is not None:
+        files = []
+        for j in range(7):
+            files.append(os.path.join(tmpdir.name, "hcn_dens_"+str(j)+".xyz.data"))
+            cubedata.write_training_data(files[j], cubedata.cube_training_data(
+                os.path.join(dmdir, "den_p_"+str(j)+".cube"), 4))
+        npts = np.loadtxt(files[0]).shape[0]
+        for j in range(1, 7):
+            name = "den_p_%d.cube against den_p_0.cube, xyz grid" % j
+            ref = run_program([prog_3d, files[j], files[0], str(npts)])[0,0]
+            bench, wts = density_rmse.get_benchmark(files[0], npts)
+            val = density_rmse.compute_rms_error(density_rmse.read_density_file(files[j], npts), bench, wts)
+            ok = compare(name, val, ref) and ok
+
+    tmpdir.cleanup()
+    return ok
+
+
+if __name__ == "__main__":
+
+    prog_dirs = [os.path.join(TEST_DIR, "..", "bin"), os.path.join(TEST_DIR, "..", "source")]
+    if (len(sys.argv) > 1):
+        prog_dirs = [sys.argv[1]]
+
+    ok = check_cubedata(find_program(prog_dirs, "cubedata_into_training_data.x"))
+    ok = check_density_rmse(find_program(prog_dirs, "compute_rmse_density.x"),
+                            find_program(prog_dirs, "compute_rmse_density_3D.x")) and ok
+
+    if not (ok):
+        print("Ports differ from the Fortran programs.")
+        sys.exit(1)
+    print("Ports agree with the Fortran programs.")
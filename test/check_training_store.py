@@ -0,0 +1,187 @@
+import os
+import sys
+import tempfile
+import numpy as np
+
+#
+# Check that the training data store (training_store.py) survives an
+# interrupted append, and that basis_optimization.py rebuilds it from
+# training.dat when needed.
+#
+# Usage: check_training_store.py
+#
+# The exit status is 1 if a check fails.
+#
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "source"))
+import training_store
+import basis_optimization as bo
+
+NPARAM = 2
+NCOMP = len(bo.PENFCN_COMPONENTS)
+
+#
+# check: Print the result of a check
+# Input:
+#  name = description of the check
+#  ok   = check passed
+# Output:
+#  ok
+#
+def check(name, ok):
+    print("%-7s %s" % ("ok" if ok else "FAILED", name))
+    return ok
+
+#
+# make_rows: Rows of a store, with the censored flag and components set
+# Input:
+#  n     = number of rows
+#  first = value of the first parameter of the first row
+# Output:
+#  rows = array of rows
+#
+def make_rows(n, first):
+    rows = np.full((n, NPARAM + 2 + NCOMP), np.nan)
+    for i in range(n):
+        rows[i,0:NPARAM] = [first + i, 2.0 * (first + i)]
+        rows[i,NPARAM] = 10.0 + i
+        rows[i,NPARAM+1] = 0.0
+        rows[i,NPARAM+2] = 0.5 * i
+    return rows
+
+#
+# same_rows: Rows are equal, with nan for unknown components
+#
+def same_rows(a, b):
+    return a.shape == b.shape and np.array_equal(np.asarray(a), np.asarray(b), equal_nan=True)
+
+#
+# check_commit: Appended rows are committed with the row count
+# Input:
+#  dirname = work directory
+# Output:
+#  ok = all checks passed
+#
+def check_commit(dirname):
+    flname = dirname+"/commit.bin"
+    store = training_store.create_store(flname, NPARAM, NCOMP)
+    rows = make_rows(3, 1.0)
+    training_store.append_rows(store, rows[0:2])
+    training_store.append_rows(store, rows[2:3])
+
+    reopened = training_store.open_store(flname)
+    ok = check("row count committed", reopened["nrows"] == 3)
+    ok = check("committed rows read back", same_rows(training_store.read_rows(reopened), rows)) and ok
+    return ok
+
+#
+# check_uncommitted_tail: Rows written by an interrupted append (past the
+# committed row count) are not read, and are overwritten by the next append
+# Input:
+#  dirname = work directory
+# Output:
+#  ok = all checks passed
+#
+def check_uncommitted_tail(dirname):
+    flname = dirname+"/tail.bin"
+    store = training_store.create_store(flname, NPARAM, NCOMP)
+    rows = make_rows(2, 1.0)
+    training_store.append_rows(store, rows)
+
+    # Append interrupted before the header is updated
+    tail = make_rows(2, 100.0)
+    sfile = open(flname, "ab")
+    sfile.write(np.ascontiguousarray(tail, dtype="<f8").tobytes()[:-5])
+    sfile.close()
+
+    reopened = training_store.open_store(flname)
+    ok = check("uncommitted tail not counted", reopened["nrows"] == 2)
+    ok = check("uncommitted tail not read", same_rows(training_store.read_rows(reopened), rows)) and ok
+
+    more = make_rows(1, 10.0)
+    training_store.append_rows(reopened, more)
+    reopened = training_store.open_store(flname)
+    ok = check("uncommitted tail overwritten",
+               same_rows(training_store.read_rows(reopened), np.vstack((rows, more)))) and ok
+    return ok
+
+#
+# open_training_store: Open the store of the current directory with
+# basis_optimization.load_training_store, as at the start of a run
+# Output:
+#  store = store, None if there is no training data
+#
+def open_training_store():
+    bo.TRAIN_STORE = None
+    return bo.load_training_store()
+
+#
+# check_rebuild: The store is rebuilt from training.dat when training.dat
+# was changed by another program, keeping the censored flags, and
+# training.dat is rewritten when it is behind the store
+# Input:
+#  dirname = work directory
+# Output:
+#  ok = all checks passed
+#
+def check_rebuild(dirname):
+    curr_dir = os.getcwd()
+    os.chdir(dirname)
+    bo.NUM_PARAM = NPARAM
+    bo.TRAINING_STORE = "training.bin"
+
+    rows = make_rows(3, 1.0)
+    rows[:,NPARAM+2:] = np.nan
+    tfile = open("training.dat", "w")
+    tfile.writelines(training_store.text_lines(rows, NPARAM))
+    tfile.close()
+    cfile = open(bo.CENSORED_FILE, "w")
+    cfile.write(" %10.5f %10.5f %15.8f %15.8f\n" % (rows[1,0], rows[1,1], rows[1,NPARAM], 5.0))
+    cfile.close()
+
+    # Built from training.dat
+    rows[1,NPARAM+1] = 1.0
+    store = open_training_store()
+    ok = check("store built from training.dat", same_rows(training_store.read_rows(store), rows))
+
+    # Changed by another program
+    rows[2,NPARAM] = 20.0
+    tfile = open("training.dat", "w")
+    tfile.writelines(training_store.text_lines(rows, NPARAM))
+    tfile.close()
+    store = open_training_store()
+    ok = check("store rebuilt from changed training.dat",
+               same_rows(training_store.read_rows(store), rows)) and ok
+
+    # Row committed, export to training.dat interrupted
+    more = make_rows(1, 10.0)
+    more[:,NPARAM+2:] = np.nan
+    training_store.append_rows(store, more)
+    rows = np.vstack((rows, more))
+    text = "".join(training_store.text_lines(rows, NPARAM))
+    tfile = open("training.dat", "w")
+    tfile.write(text[0:len(text) - 10])
+    tfile.close()
+    store = open_training_store()
+    tfile = open("training.dat", "r")
+    ok = check("training.dat rewritten from the store", tfile.read() == text) and ok
+    tfile.close()
+    ok = check("store kept", same_rows(training_store.read_rows(store), rows)) and ok
+
+    os.chdir(curr_dir)
+    return ok
+
+
+if __name__ == "__main__":
+
+    tmpdir = tempfile.TemporaryDirectory()
+    ok = check_commit(tmpdir.name)
+    ok = check_uncommitted_tail(tmpdir.name) and ok
+    ok = check_rebuild(tmpdir.name) and ok
+    tmpdir.cleanup()
+
+    if not (ok):
+        print("Training data store checks failed.")
+        sys.exit(1)
+    print("Training data store checks passed.")
@@ -1,4 +1,9 @@
 import sys, getopt
+import os
+
+# Output parser from source/
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))+"/../source")
+import qchem_output
 
 def get_arguments_from_cmdl(argv):
     nstates = 0
@@ -14,34 +19,17 @@ def get_arguments_from_cmdl(argv):
     return (int(nstates), molec)
 
 def create_states_file(molec, nstates):
-    qfile = open(molec+".output", "r")
-    qf_lines = (qfile.read().splitlines())
-    qfile.close()
-    nlines = len(qf_lines)
-    estart_line = 0
-    for i in range(nlines):
-        if "==== Final CI Energy ====" in str(qf_lines[i]):
-            estart_line = i
-            break
-    estart_line = estart_line + 1
+    energies = qchem_output.parse_qchem_output(molec+".output")["energies"]
 
+    # Placeholder energies if the CI block is missing
     energy = []
     for i in range(nstates):
-        if (estart_line > 1):
-            e_line = qf_lines[estart_line + i]
-            if (i < 10):
-                e_line = e_line.replace(" CI Energy (au) Root #   "+str(i),"").strip()
-            else:
-                e_line = e_line.replace(" CI Energy (au) Root #  "+str(i),"").strip()
+        if (i < len(energies)):
+            energy.append(energies[i])
         else:
-            e_line = str(100 * i)
-            
-        energy.append(e_line)
+            energy.append(100 * i)
 
-    efile = open(molec+"_states.data", "w")
-    for i in range(nstates):
-        efile.write("%s\n" % energy[i])
-    efile.close()
+    qchem_output.write_states_file(molec+"_states.data", energy)
 
 if __name__ == "__main__":
     nstates, molec = get_arguments_from_cmdl(sys.argv[1:])